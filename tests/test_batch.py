@@ -0,0 +1,94 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+import io
+import json
+
+import pytest
+
+import usbsdmux.__main__
+from usbsdmux.batch import run_batch
+from usbsdmux.daemon import DeviceManager, handle_request
+from usbsdmux.mqtthelper import Config
+from usbsdmux.simulation import SimulatedTransport, SimulatedUsbSdMux, default_card
+from usbsdmux.usbsdmux import UsbSdMuxFast
+
+
+def test_run_batch(tmp_path):
+    "test that commands are run in order on a single handle per device"
+    configfile = tmp_path / "usbsdmux.config"
+    configfile.write_text("")
+    config = Config(str(configfile))
+    device = SimulatedUsbSdMux(UsbSdMuxFast, card=default_card())
+    opened = []
+
+    def open_device(sg):
+        opened.append(sg)
+        return UsbSdMuxFast(sg, discharge_time=0, transport=SimulatedTransport(device))
+
+    manager = DeviceManager(open_device)
+    commands = [
+        {"id": 1, "sg": "/dev/sg0", "op": "host"},
+        {"id": 2, "sg": "/dev/sg0", "op": "info"},
+        {"op": "sleep", "seconds": 0.01},
+        {"sg": "/dev/sg0", "op": "gpio", "gpio": 0, "action": "low"},
+        {"id": 5, "sg": "/dev/sg0", "op": "dut"},
+        {"id": 6, "sg": "/dev/sg0", "op": "info"},
+        {"id": 7, "sg": "/dev/sg0", "op": "get"},
+    ]
+    infile = io.StringIO("\n".join(json.dumps(command) for command in commands) + "\n\n")
+    outfile = io.StringIO()
+
+    failed = run_batch(infile, outfile, lambda request: handle_request(manager, config, request))
+
+    results = [json.loads(line) for line in outfile.getvalue().splitlines()]
+    assert failed == 1
+    assert len(results) == len(commands)
+    assert results[0] == {"id": 1, "result": {}}
+    assert results[1]["result"]["cid"]["raw"] == "02544d53413034471027b7748500bc00"
+    assert results[2] == {"result": {}}
+    assert results[3] == {"result": {}}
+    assert results[5] == {"id": 6, "error": "Card information is only available in host mode."}
+    assert results[6] == {"id": 7, "result": {"switch-state": "dut"}}
+    assert opened == ["/dev/sg0"]
+
+
+def test_run_batch_unexpected_error(tmp_path):
+    "test that unexpected exceptions are reported without stopping the batch"
+    configfile = tmp_path / "usbsdmux.config"
+    configfile.write_text("")
+    config = Config(str(configfile))
+    device = SimulatedUsbSdMux(UsbSdMuxFast, card=default_card())
+    manager = DeviceManager(lambda sg: UsbSdMuxFast(sg, discharge_time=0, transport=SimulatedTransport(device)))
+    commands = [
+        {"id": 1, "sg": "/dev/sg0", "op": "host", "wait_for_block": True, "timeout": "x"},
+        {"id": 2, "sg": "/dev/sg0", "op": "get"},
+    ]
+    infile = io.StringIO("\n".join(json.dumps(command) for command in commands) + "\n")
+    outfile = io.StringIO()
+
+    failed = run_batch(infile, outfile, lambda request: handle_request(manager, config, request))
+
+    results = [json.loads(line) for line in outfile.getvalue().splitlines()]
+    assert failed == 1
+    assert results[0]["id"] == 1
+    assert results[0]["error"].startswith("Internal error: TypeError")
+    assert results[1] == {"id": 2, "result": {"switch-state": "host"}}
+
+
+def test_batch_cli(tmp_path, capsys, mocker):
+    "test that invalid commands are reported without stopping the batch"
+    configfile = tmp_path / "usbsdmux.config"
+    configfile.write_text("")
+    commandfile = tmp_path / "commands"
+    commandfile.write_text('{"op": "sleep", "seconds": 0}\n{"op": "format"}\nnot json\n{"op": "sleep"}\n')
+
+    mocker.patch("sys.argv", ["usbsdmux", "batch", "--config", str(configfile), str(commandfile)])
+    with pytest.raises(SystemExit):
+        usbsdmux.__main__.main()
+
+    results = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert results[0] == {"result": {}}
+    assert results[1]["error"].startswith("Invalid command.")
+    assert results[2]["error"].startswith("Invalid JSON")
+    assert results[3] == {"error": "Invalid sleep. Expected 'seconds'."}
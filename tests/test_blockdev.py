@@ -0,0 +1,129 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+import ctypes
+import functools
+import mmap
+import os
+import threading
+
+import pytest
+
+from usbsdmux import blockdev, hotplug
+from usbsdmux.blockdev import BlockDeviceBusy, block_devices, flush_card, mountpoints
+from usbsdmux.simulation import SimulatedTransport, SimulatedUsbSdMux
+from usbsdmux.usbsdmux import UsbSdMuxFast
+
+
+@pytest.fixture
+def card(tmp_path):
+    "a USB-SD-Mux with a card with two partitions and device nodes in tmp_path/dev"
+    sysfs = tmp_path / "sys"
+    SimulatedUsbSdMux(UsbSdMuxFast).install_sysfs(sysfs, "sg0", block="sda")
+    disk = sysfs / "class/block/sda"
+    (disk / "size").write_text("31116288\n")
+    for partition in ("sda1", "sda2"):
+        (disk / partition).mkdir()
+        (disk / partition / "partition").write_text("1\n")
+
+    dev = tmp_path / "dev"
+    dev.mkdir()
+    for name in ("sda", "sda1", "sda2"):
+        (dev / name).write_bytes(b"\0" * 512)
+
+    mounts = tmp_path / "mounts"
+    mounts.write_text("sysfs /sys sysfs rw 0 0\n/dev/nvme0n1p2 / ext4 rw 0 0\n")
+    return sysfs, dev, mounts
+
+
+def test_block_devices(card):
+    "test that the disk and its partitions are found, but only with a medium"
+    sysfs, _, _ = card
+    assert block_devices("/dev/sg0", sysfs) == ["sda", "sda1", "sda2"]
+
+    (sysfs / "class/block/sda/size").write_text("0\n")
+    assert block_devices("/dev/sg0", sysfs) == []
+
+
+def test_mountpoints(card):
+    "test that mounts of the card are found"
+    _, dev, mounts = card
+    mounts.write_text(mounts.read_text() + f"{dev}/sda2 /media/my\\040card vfat rw 0 0\n")
+
+    assert mountpoints(["sda", "sda1", "sda2"], mounts) == ["/media/my card"]
+    assert mountpoints(["sdb"], mounts) == []
+
+
+def test_flush_card(card):
+    "test that all devices of the card are flushed, unless it is mounted"
+    sysfs, dev, mounts = card
+    flush_card("/dev/sg0", sysfs=sysfs, mounts=mounts, dev=dev)
+
+    mounts.write_text(mounts.read_text() + f"{dev}/sda1 /boot vfat rw 0 0\n")
+    with pytest.raises(BlockDeviceBusy, match="mounted at /boot"):
+        flush_card("/dev/sg0", sysfs=sysfs, mounts=mounts, dev=dev)
+    flush_card("/dev/sg0", check_mounted=False, sysfs=sysfs, mounts=mounts, dev=dev)
+
+
+def resident_pages(path):
+    "returns the number of pages of the file at path in the page cache"
+    libc = ctypes.CDLL(None, use_errno=True)
+    size = os.path.getsize(path)
+    with open(path, "r+b") as fh, mmap.mmap(fh.fileno(), size) as mapping:
+        address = ctypes.c_char.from_buffer(mapping)
+        pages = (ctypes.c_ubyte * ((size + mmap.PAGESIZE - 1) // mmap.PAGESIZE))()
+        try:
+            if libc.mincore(ctypes.c_void_p(ctypes.addressof(address)), ctypes.c_size_t(size), pages) != 0:
+                raise OSError(ctypes.get_errno(), "mincore() failed")
+        finally:
+            del address
+    return sum(page & 1 for page in pages)
+
+
+def test_mode_host_invalidate(card, mocker):
+    "test that switching to the host drops stale cached pages without waiting for the card"
+    sysfs, dev, mounts = card
+    (dev / "sda").write_bytes(os.urandom(64 * mmap.PAGESIZE))
+    (dev / "sda").read_bytes()
+    if resident_pages(dev / "sda") == 0:
+        pytest.skip("The page cache is not used for the test files")
+
+    wait_for_block = mocker.patch.object(hotplug, "wait_for_block")
+    mocker.patch.object(blockdev, "flush_card", functools.partial(flush_card, sysfs=sysfs, mounts=mounts, dev=dev))
+    ctl = UsbSdMuxFast("/dev/sg0", discharge_time=0, transport=SimulatedTransport(SimulatedUsbSdMux(UsbSdMuxFast)))
+
+    assert ctl.mode_host(invalidate=True) is None
+    assert resident_pages(dev / "sda") == 0
+    wait_for_block.assert_not_called()
+
+    # Without a card there is nothing to invalidate
+    (sysfs / "class/block/sda/size").write_text("0\n")
+    ctl.mode_disconnect()
+    ctl.mode_host(invalidate=True)
+    wait_for_block.assert_not_called()
+
+
+def test_mode_host_wait_and_invalidate(card, mocker):
+    "test that switching to the host drops stale cached pages once the card shows up"
+    sysfs, dev, mounts = card
+    (sysfs / "class/block/sda/size").write_text("0\n")
+    (dev / "sda").write_bytes(os.urandom(64 * mmap.PAGESIZE))
+    (dev / "sda").read_bytes()
+    if resident_pages(dev / "sda") == 0:
+        pytest.skip("The page cache is not used for the test files")
+
+    mocker.patch.object(
+        hotplug, "wait_for_block", functools.partial(hotplug.wait_for_block, sysfs=sysfs, recheck_interval=0.01)
+    )
+    mocker.patch.object(blockdev, "flush_card", functools.partial(flush_card, sysfs=sysfs, mounts=mounts, dev=dev))
+
+    # The card reader detects the card only some time after the switch
+    timer = threading.Timer(0.1, (sysfs / "class/block/sda/size").write_text, ["31116288\n"])
+    timer.start()
+    ctl = UsbSdMuxFast("/dev/sg0", discharge_time=0, transport=SimulatedTransport(SimulatedUsbSdMux(UsbSdMuxFast)))
+    try:
+        assert ctl.mode_host(wait_for_block=True, invalidate=True) == "/dev/sda"
+    finally:
+        timer.join()
+
+    assert resident_pages(dev / "sda") == 0
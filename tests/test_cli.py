@@ -50,3 +50,13 @@ def test_help_in_readme(capsys, mocker):
     output_lines = [f"   {line}".rstrip() for line in captured.out.splitlines()]
 
     assert output_lines == readme_lines, "Output of 'usbsdmux -h' does not match output in README.rst"
+
+
+def test_group_usage(capsys, mocker):
+    "test that switching a group without devices prints the group usage"
+    mocker.patch("sys.argv", ["usbsdmux", "host"])
+    with pytest.raises(SystemExit):
+        usbsdmux.__main__.main()
+    captured = capsys.readouterr()
+    assert captured.err.startswith("usage: usbsdmux host")
+    assert "No USB-SD-Mux given" in captured.err
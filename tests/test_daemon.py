@@ -0,0 +1,123 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+import json
+import threading
+
+import pytest
+
+import usbsdmux.__main__
+import usbsdmux.daemon
+from usbsdmux.daemon import Client, DaemonError, Server
+from usbsdmux.mqtthelper import Config
+from usbsdmux.simulation import SimulatedTransport, SimulatedUsbSdMux, default_card
+from usbsdmux.usbsdmux import UsbSdMuxClassic, UsbSdMuxFast
+
+
+@pytest.fixture
+def daemon(tmp_path):
+    configfile = tmp_path / "usbsdmux.config"
+    configfile.write_text("")
+    devices = {
+        "/dev/sg0": SimulatedUsbSdMux(UsbSdMuxFast, card=default_card()),
+        "/dev/sg1": SimulatedUsbSdMux(UsbSdMuxClassic, card=default_card()),
+    }
+    opened = []
+
+    def open_device(sg):
+        opened.append(sg)
+        device = devices[sg]
+        return device.driver(sg, discharge_time=0, transport=SimulatedTransport(device))
+
+    path = str(tmp_path / "usbsdmuxd.sock")
+    server = Server(path, Config(str(configfile)), open_device=open_device)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+
+    yield path, devices, opened
+
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_commands(daemon):
+    "test that the daemon runs commands on warm handles"
+    path, devices, opened = daemon
+
+    with Client(path) as client:
+        assert client.request("/dev/sg0", "host") == {}
+        assert devices["/dev/sg0"].mode == "host"
+        assert client.request("/dev/sg0", "get") == {"switch-state": "host"}
+        assert client.request("/dev/sg0", "info")["cid"]["raw"] == "02544d53413034471027b7748500bc00"
+        assert client.request("/dev/sg0", "gpio", gpio=1, action="high") == {}
+        assert client.request("/dev/sg0", "gpio", gpio=1, action="get") == {
+            "gpio-state": {"gpio": 1, "state:": "high"}
+        }
+        assert client.request("/dev/sg1", "dut") == {}
+        assert devices["/dev/sg1"].mode == "dut"
+
+        with pytest.raises(DaemonError, match="does not support GPIOs"):
+            client.request("/dev/sg1", "gpio", gpio=0, action="get")
+        with pytest.raises(DaemonError, match="Invalid request"):
+            client.request("/dev/sg0", "calibrate")
+
+    # Every device is only opened once for all connections
+    with Client(path) as client:
+        assert client.request("/dev/sg0", "get") == {"switch-state": "host"}
+    assert opened == ["/dev/sg0", "/dev/sg1"]
+
+
+def test_concurrent_clients(daemon):
+    "test that commands on the same device are serialized"
+    path, devices, _ = daemon
+    errors = []
+
+    def worker(mode):
+        try:
+            with Client(path) as client:
+                for _ in range(10):
+                    client.request("/dev/sg0", mode)
+                    assert client.request("/dev/sg0", "get")["switch-state"] in ("host", "dut")
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(mode,)) for mode in ("host", "dut")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+
+
+def test_cli_client(daemon, capsys, mocker):
+    "test that the usbsdmux tool uses the daemon if a socket is given"
+    path, devices, _ = daemon
+
+    mocker.patch("sys.argv", ["usbsdmux", "--socket", path, "--json", "/dev/sg0", "host"])
+    usbsdmux.__main__.main()
+    assert json.loads(capsys.readouterr().out) == {}
+    assert devices["/dev/sg0"].mode == "host"
+
+    mocker.patch("sys.argv", ["usbsdmux", "--socket", path, "/dev/sg0", "get"])
+    usbsdmux.__main__.main()
+    assert capsys.readouterr().out == "host\n"
+
+    mocker.patch("sys.argv", ["usbsdmux", "--socket", path, "--json", "/dev/sg1", "gpio", "0", "get"])
+    with pytest.raises(SystemExit):
+        usbsdmux.__main__.main()
+    assert json.loads(capsys.readouterr().out) == {"error-message": "This USB-SD-Mux does not support GPIOs."}
+
+
+def test_default_socket(tmp_path, capsys, mocker):
+    "test that the daemon listens on the default socket if none is configured"
+    configfile = tmp_path / "usbsdmux.config"
+    configfile.write_text("")
+    path = str(tmp_path / "run/usbsdmuxd.sock")
+    mocker.patch("usbsdmux.daemon.DEFAULT_SOCKET", path)
+    mocker.patch("sys.argv", ["usbsdmuxd", "--config", str(configfile)])
+    mocker.patch.object(Server, "serve_forever", side_effect=KeyboardInterrupt)
+
+    usbsdmux.daemon.main()
+    assert capsys.readouterr().err == f"Listening on {path}\n"
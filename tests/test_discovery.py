@@ -0,0 +1,64 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+import pytest
+
+from usbsdmux.discovery import DeviceIndex, DeviceNotFound, resolve, scan
+from usbsdmux.simulation import SimulatedUsbSdMux
+from usbsdmux.usbsdmux import UsbSdMuxClassic, UsbSdMuxFast, find_usbsdmuxes
+
+
+@pytest.fixture
+def sysfs(tmp_path):
+    SimulatedUsbSdMux(UsbSdMuxFast, serial="000000000042").install_sysfs(tmp_path, "sg2", block="sdb")
+    SimulatedUsbSdMux(UsbSdMuxClassic, serial="000000000007").install_sysfs(tmp_path, "sg0")
+    other = tmp_path / "class/scsi_generic/sg1/device"
+    other.mkdir(parents=True)
+    (other / "model").write_text("Some Disk\n")
+    return tmp_path
+
+
+def test_find_usbsdmuxes(sysfs):
+    "test that the sg-devices of all USB-SD-Muxes are found in sysfs"
+    assert find_usbsdmuxes(sysfs) == ["/dev/sg0", "/dev/sg2"]
+
+
+def test_scan(sysfs):
+    "test that all USB-SD-Muxes and only them are found in sysfs"
+    devices = scan(sysfs)
+
+    assert [device.to_dict() for device in devices] == [
+        {
+            "sg": "/dev/sg0",
+            "block": None,
+            "model": "UsbSdMuxClassic",
+            "serial": "000000000007",
+            "usb": "1-1",
+            "speed": 480,
+        },
+        {
+            "sg": "/dev/sg2",
+            "block": "sdb",
+            "model": "UsbSdMuxFast",
+            "serial": "000000000042",
+            "usb": "1-3",
+            "speed": 480,
+        },
+    ]
+
+
+def test_resolve(sysfs):
+    "test that devices are found by serial, USB path and labgrid place"
+    places = {"rpi": "serial:000000000042", "bbb": "usb:1-1", "nowhere": "serial:1"}
+
+    assert resolve("/dev/sg5", places, sysfs) == "/dev/sg5"
+    assert resolve("serial:000000000042", places, sysfs) == "/dev/sg2"
+    assert resolve("usb:1-1", places, sysfs) == "/dev/sg0"
+    assert resolve("place:rpi", places, sysfs) == "/dev/sg2"
+    assert resolve("place:bbb", places, sysfs) == "/dev/sg0"
+
+    index = DeviceIndex.scan(sysfs, places)
+    with pytest.raises(DeviceNotFound, match="No USB-SD-Mux with serial '1'"):
+        index.find("place:nowhere")
+    with pytest.raises(DeviceNotFound, match="not configured"):
+        index.find("place:unknown")
@@ -0,0 +1,35 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+import os
+
+import pytest
+
+from usbsdmux.fileutil import read_int, read_text, write_atomic
+
+
+def test_read(tmp_path):
+    "test that values are read and missing or malformed files result in None"
+    (tmp_path / "size").write_text("15523840\n")
+    (tmp_path / "ioerr_cnt").write_text("0x1f\n")
+    (tmp_path / "serial").write_text("\n")
+
+    assert read_text(tmp_path / "size") == "15523840"
+    assert read_int(tmp_path / "size") == 15523840
+    assert read_int(tmp_path / "ioerr_cnt", 16) == 31
+    assert read_int(tmp_path / "serial") is None
+    assert read_text(tmp_path / "missing") is read_int(tmp_path / "missing") is None
+
+
+def test_write_atomic(tmp_path):
+    "test that files are replaced and no temporary files are left behind"
+    filename = tmp_path / "stats.json"
+    write_atomic(filename, "{}")
+    write_atomic(filename, b"[]")
+    assert filename.read_text() == "[]"
+    assert os.stat(filename).st_mode & 0o777 == 0o644
+
+    with pytest.raises(TypeError):
+        write_atomic(filename, None)
+    assert filename.read_text() == "[]"
+    assert os.listdir(tmp_path) == ["stats.json"]
@@ -0,0 +1,133 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+import queue
+import threading
+import time
+
+import pytest
+
+from usbsdmux.hotplug import BlockDeviceTimeout, MuxRegistry, ReattachingTransport, parse_uevent, wait_for_block
+from usbsdmux.simulation import SimulatedUsbSdMux
+from usbsdmux.usbsdmux import UsbSdMuxFast
+
+SCSI_DEVPATH = (
+    "/devices/pci0000:00/0000:00:14.0/usb1/1-{port}/1-{port}:1.0/host{index}/target{index}:0:0/{index}:0:0:0"
+)
+
+
+def uevent(action, subsystem, index, name, **properties):
+    "returns a netlink message as sent by the kernel for the device at index"
+    scsi_devpath = SCSI_DEVPATH.format(port=index + 1, index=index)
+    devpath = f"{scsi_devpath}/{subsystem}/{name}"
+    fields = [f"{action}@{devpath}", f"ACTION={action}", f"DEVPATH={devpath}", f"SUBSYSTEM={subsystem}"]
+    fields += [f"DEVNAME={name}", "SEQNUM=4711"] + [f"{key}={value}" for key, value in properties.items()]
+    return "\0".join(fields).encode() + b"\0"
+
+
+def test_parse_uevent():
+    "test that kernel uevents are parsed and udev messages ignored"
+    event = parse_uevent(uevent("add", "block", 2, "sdc", DEVTYPE="disk"))
+    assert event.action == "add"
+    assert event.subsystem == "block"
+    assert event.name == "sdc"
+    assert event.properties["DEVTYPE"] == "disk"
+    assert event.scsi_devpath == SCSI_DEVPATH.format(port=3, index=2)
+
+    assert parse_uevent(b"libudev\0\xfe\xed\xca\xfe") is None
+
+
+def test_registry(tmp_path):
+    "test that the registry follows a device that is re-enumerated"
+    device = SimulatedUsbSdMux(UsbSdMuxFast, serial="000000000042")
+    device.install_sysfs(tmp_path, "sg0")
+    registry = MuxRegistry(tmp_path)
+    events = []
+    registry.subscribe(lambda event, mux: events.append((event.action, event.name, mux and mux.sg)))
+
+    mux, generation = registry.lookup("000000000042")
+    assert (mux.sg, mux.block, generation) == ("/dev/sg0", None, 0)
+
+    registry.handle(parse_uevent(uevent("add", "block", 0, "sda", DEVTYPE="disk")))
+    registry.handle(parse_uevent(uevent("add", "block", 0, "sda1", DEVTYPE="partition")))
+    assert registry.by_serial("000000000042").block == "sda"
+
+    # The device is re-enumerated as sg1
+    registry.handle(parse_uevent(uevent("remove", "block", 0, "sda", DEVTYPE="disk")))
+    registry.handle(parse_uevent(uevent("remove", "scsi_generic", 0, "sg0")))
+    (tmp_path / "class/scsi_generic/sg0").unlink()
+    assert registry.lookup("000000000042") == (None, None)
+
+    device.install_sysfs(tmp_path, "sg1")
+    registry.handle(parse_uevent(uevent("add", "scsi_generic", 1, "sg1")))
+    mux, generation = registry.lookup("000000000042")
+    assert (mux.sg, generation) == ("/dev/sg1", 1)
+    assert [mux.sg for mux in registry.devices] == ["/dev/sg1"]
+
+    assert events == [
+        ("add", "sda", "/dev/sg0"),
+        ("remove", "sda", "/dev/sg0"),
+        ("remove", "sg0", None),
+        ("add", "sg1", "/dev/sg1"),
+    ]
+
+
+def test_reattach(tmp_path):
+    "test that a lost device is only reopened once it has been attached again"
+    device = SimulatedUsbSdMux(UsbSdMuxFast, serial="000000000042")
+    device.install_sysfs(tmp_path, "sg0")
+    registry = MuxRegistry(tmp_path)
+    transport = ReattachingTransport("000000000042", registry, timeout=5)
+
+    mux, generation = registry.wait_for_serial("000000000042", timeout=0)
+    assert mux.sg == "/dev/sg0"
+    assert registry.wait_for_serial("000000000042", timeout=0, newer_than=generation) == (None, None)
+
+    # Simulate the device getting lost: It is reattached as the same sg0
+    transport._lost = generation
+    result = []
+    waiter = threading.Thread(
+        target=lambda: result.append(registry.wait_for_serial("000000000042", 5, newer_than=transport._lost))
+    )
+    waiter.start()
+    registry.handle(parse_uevent(uevent("remove", "scsi_generic", 0, "sg0")))
+    registry.handle(parse_uevent(uevent("add", "scsi_generic", 0, "sg0")))
+    waiter.join()
+
+    mux, generation = result[0]
+    assert (mux.sg, generation) == ("/dev/sg0", 1)
+
+
+class QueueMonitor:
+    "stands in for a UeventMonitor, returning the uevents put into it"
+
+    def __init__(self):
+        self.queue = queue.Queue()
+
+    def receive(self, timeout=None):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+def test_wait_for_block(tmp_path):
+    "test that the block device is looked at again once a uevent announces a change"
+    SimulatedUsbSdMux(UsbSdMuxFast).install_sysfs(tmp_path, "sg0", block="sda")
+    monitor = QueueMonitor()
+
+    def insert_card():
+        time.sleep(0.1)
+        monitor.queue.put(parse_uevent(uevent("change", "block", 1, "sdb", DEVTYPE="disk")))
+        (tmp_path / "class/block/sda/size").write_text("31116288\n")
+        monitor.queue.put(parse_uevent(uevent("change", "block", 0, "sda", DEVTYPE="disk", DISK_MEDIA_CHANGE=1)))
+
+    thread = threading.Thread(target=insert_card)
+    thread.start()
+    start = time.monotonic()
+    assert wait_for_block("/dev/sg0", timeout=5, sysfs=tmp_path, monitor=monitor, recheck_interval=3) == "/dev/sda"
+    assert time.monotonic() - start < 1
+    thread.join()
+
+    with pytest.raises(BlockDeviceTimeout):
+        wait_for_block("/dev/sg1", timeout=0.1, sysfs=tmp_path, monitor=monitor)
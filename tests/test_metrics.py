@@ -0,0 +1,80 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+import threading
+import urllib.request
+
+from usbsdmux.metrics import OPENMETRICS_CONTENT_TYPE, make_server, render, scan_devices, write_textfile
+from usbsdmux.simulation import SimulatedTransport, SimulatedUsbSdMux, default_card
+from usbsdmux.usbsdmux import UsbSdMuxClassic, UsbSdMuxFast
+
+
+def _devices(tmp_path):
+    fast = SimulatedUsbSdMux(UsbSdMuxFast, card=default_card(), serial="000000000001")
+    fast.install_sysfs(tmp_path, "sg0", block="sda")
+    classic = SimulatedUsbSdMux(UsbSdMuxClassic, serial="000000000002")
+    classic.install_sysfs(tmp_path, "sg1")
+
+    ctl = UsbSdMuxFast("/dev/sg0", discharge_time=0, transport=SimulatedTransport(fast))
+    ctl.mode_host()
+    ctl.mode_DUT()
+
+    stats = {"000000000001": ctl.stats}
+    return scan_devices(tmp_path, stats.get)
+
+
+def test_scan(tmp_path):
+    "test that all USB-SD-Muxes and their counters are found in sysfs"
+    fast, classic = _devices(tmp_path)
+
+    assert (fast.sg_name, fast.serial, fast.model, fast.block) == ("sg0", "000000000001", "UsbSdMuxFast", "sda")
+    assert fast.ioerr_cnt == 0
+    assert fast.block_stat["sectors_read"] == 0
+    assert fast.stats.switches["host"].count == 1
+    assert (classic.model, classic.block, classic.stats) == ("UsbSdMuxClassic", None, None)
+
+
+def test_render(tmp_path):
+    "test the exposition format of the metrics"
+    text = render(_devices(tmp_path))
+    lines = text.splitlines()
+
+    assert 'usbsdmux_info{serial="000000000002",sg="sg1",model="UsbSdMuxClassic",block=""} 1' in lines
+    assert 'usbsdmux_switches_total{serial="000000000001",sg="sg0",mode="dut"} 1' in lines
+    assert 'usbsdmux_switch_duration_seconds_bucket{serial="000000000001",sg="sg0",mode="host",le="+Inf"} 1' in lines
+    assert 'usbsdmux_commands_total{serial="000000000001",sg="sg0",operation="write-config"} 0' in lines
+    assert 'usbsdmux_scsi_io_errors_total{serial="000000000001",sg="sg0"} 0' in lines
+    assert "# TYPE usbsdmux info" in lines
+    assert "# TYPE usbsdmux_switches counter" in lines
+    assert lines[-1] == "# EOF"
+
+    # Every family must only be declared once
+    types = [line for line in lines if line.startswith("# TYPE")]
+    assert len(types) == len(set(types))
+
+
+def test_textfile(tmp_path):
+    "test that the textfile uses the Prometheus text format"
+    filename = tmp_path / "usbsdmux.prom"
+    write_textfile(filename, render(_devices(tmp_path), openmetrics=False))
+
+    lines = filename.read_text().splitlines()
+    assert "# TYPE usbsdmux_info gauge" in lines
+    assert "# TYPE usbsdmux_switches_total counter" in lines
+    assert "# EOF" not in lines
+
+
+def test_http(tmp_path):
+    "test scraping the metrics via HTTP on the loopback interface"
+    devices = _devices(tmp_path)
+    server = make_server(lambda: devices, port=0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{server.server_port}/metrics") as response:
+            assert response.headers["Content-Type"] == OPENMETRICS_CONTENT_TYPE
+            assert response.read().decode() == render(devices)
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
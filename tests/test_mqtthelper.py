@@ -0,0 +1,61 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+from usbsdmux import mqtthelper
+from usbsdmux.simulation import SimulatedTransport, SimulatedUsbSdMux, default_card
+from usbsdmux.usb2642 import Usb2642
+from usbsdmux.usbsdmux import UsbSdMuxFast
+
+
+def test_gather_data_caches_card_info(tmp_path, monkeypatch):
+    "test that the card registers are only read again if the CID changes"
+    device = SimulatedUsbSdMux(UsbSdMuxFast, card=default_card(), serial="000000000042")
+    device.install_sysfs(tmp_path, "sg0", block="sda")
+    (tmp_path / "class/block/sda/diskseq").write_text("7\n")
+
+    reads = []
+    read_card_register = device.read_card_register
+
+    def count_reads(register, size):
+        reads.append(register)
+        return read_card_register(register, size)
+
+    monkeypatch.setattr(device, "read_card_register", count_reads)
+    monkeypatch.setattr(mqtthelper, "_card_cache", {})
+
+    ctl = UsbSdMuxFast("/dev/sg0", discharge_time=0, transport=SimulatedTransport(device))
+    ctl.mode_host()
+
+    data = mqtthelper._gather_data(ctl, "/dev/sg0", "host", sysfs=str(tmp_path))
+    assert data["serial"] == "000000000042"
+    assert data["diskseq"] == 7
+    assert data["card_info"]["cid"]["raw"] == "02544d53413034471027b7748500bc00"
+    assert len(reads) == 3
+
+    # Only the CID is read to identify the card
+    again = mqtthelper._gather_data(ctl, "/dev/sg0", "host", sysfs=str(tmp_path))
+    assert again["card_info"] == data["card_info"]
+    assert len(reads) == 4
+
+    # Another card
+    device.card.registers[Usb2642.REGISTER_CID[0]] = bytes.fromhex("03534453443136478030a14c6b0116d9")
+    other = mqtthelper._gather_data(ctl, "/dev/sg0", "host", sysfs=str(tmp_path))
+    assert other["card_info"]["cid"] != data["card_info"]["cid"]
+    assert len(reads) == 7
+
+
+def test_gather_data_client(tmp_path, monkeypatch):
+    "test that the card info is published before switching to the DUT without reading the mode"
+    device = SimulatedUsbSdMux(UsbSdMuxFast, card=default_card())
+    device.install_sysfs(tmp_path, "sg0", block="sda")
+    monkeypatch.setattr(mqtthelper, "_card_cache", {})
+
+    ctl = UsbSdMuxFast("/dev/sg0", discharge_time=0, transport=SimulatedTransport(device))
+    ctl.mode_host()
+    monkeypatch.setattr(ctl, "get_mode", None)
+
+    data = mqtthelper._gather_data(ctl, "/dev/sg0", "client", sysfs=str(tmp_path))
+    assert data["card_info"]["cid"]["raw"] == "02544d53413034471027b7748500bc00"
+
+    ctl.mode_DUT()
+    assert mqtthelper._gather_data(ctl, "/dev/sg0", "client", sysfs=str(tmp_path))["card_info"] is None
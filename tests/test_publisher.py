@@ -0,0 +1,185 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+import socket
+import struct
+import threading
+
+import pytest
+
+from usbsdmux.publisher import Forwarder, MqttPublisher, forward
+from usbsdmux.spool import Spool
+
+pytest.importorskip("paho.mqtt.client")
+
+
+class StandInBroker:
+    """
+    Just enough of an MQTT 3.1.1 broker on loopback to accept publishers.
+    """
+
+    def __init__(self):
+        self.messages = []
+        # (packet id, DUP flag) of every QoS 1 PUBLISH
+        self.packets = []
+        # Number of QoS 1 messages for which the connection is closed instead
+        # of acknowledging them
+        self.lose_acks = 0
+        self._condition = threading.Condition()
+        self._listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self._listener.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    @staticmethod
+    def _recv_exactly(conn, length):
+        data = b""
+        while len(data) < length:
+            chunk = conn.recv(length - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    def _serve(self, conn):
+        with conn:
+            try:
+                while True:
+                    header = self._recv_exactly(conn, 1)[0]
+                    length, shift = 0, 0
+                    while True:
+                        byte = self._recv_exactly(conn, 1)[0]
+                        length |= (byte & 0x7F) << shift
+                        shift += 7
+                        if not byte & 0x80:
+                            break
+                    body = self._recv_exactly(conn, length)
+                    packet_type = header >> 4
+
+                    if packet_type == 1:  # CONNECT
+                        conn.sendall(b"\x20\x02\x00\x00")
+                    elif packet_type == 3:  # PUBLISH
+                        (topic_length,) = struct.unpack(">H", body[:2])
+                        topic = body[2 : 2 + topic_length].decode()
+                        payload = body[2 + topic_length :]
+                        packet_id = None
+                        if (header >> 1) & 0x3:
+                            packet_id, payload = payload[:2], payload[2:]
+                        with self._condition:
+                            self.messages.append((topic, payload))
+                            if packet_id is not None:
+                                self.packets.append((packet_id, bool(header & 0x8)))
+                            self._condition.notify_all()
+                            if packet_id is not None and self.lose_acks:
+                                self.lose_acks -= 1
+                                return
+                        if packet_id is not None:
+                            conn.sendall(b"\x40\x02" + packet_id)
+                    elif packet_type == 12:  # PINGREQ
+                        conn.sendall(b"\xd0\x00")
+                    elif packet_type == 14:  # DISCONNECT
+                        return
+            except (EOFError, OSError):
+                return
+
+    def wait_for(self, count, timeout=10):
+        with self._condition:
+            assert self._condition.wait_for(lambda: len(self.messages) >= count, timeout)
+            return list(self.messages)
+
+    def close(self):
+        self._listener.close()
+
+
+@pytest.fixture
+def broker():
+    broker = StandInBroker()
+    yield broker
+    broker.close()
+
+
+def test_publish_in_background(broker):
+    publisher = MqttPublisher("127.0.0.1", broker.port, "usbsdmux")
+    for i in range(3):
+        assert publisher.publish(f"message {i}")
+
+    messages = broker.wait_for(3)
+    assert messages == [("usbsdmux", f"message {i}".encode()) for i in range(3)]
+    assert publisher.close() == []
+    assert publisher.published == 3
+
+
+def test_no_duplicates_after_reconnect(broker):
+    "test that a message is not published again while paho retransmits it"
+    broker.lose_acks = 1
+    publisher = MqttPublisher("127.0.0.1", broker.port, "usbsdmux")
+    publisher.publish("message")
+
+    # paho reconnects after a second and sends the message again
+    assert broker.wait_for(2) == [("usbsdmux", b"message")] * 2
+    assert publisher.close() == []
+    assert publisher.published == 1
+    assert len(broker.messages) == 2
+    (first_id, first_dup), (second_id, second_dup) = broker.packets
+    assert first_id == second_id
+    assert (first_dup, second_dup) == (False, True)
+
+
+def test_bounded_queue():
+    # Nothing listens on this port, so no message can be published
+    with socket.create_server(("127.0.0.1", 0)) as unused:
+        port = unused.getsockname()[1]
+
+    dropped = []
+    publisher = MqttPublisher("127.0.0.1", port, "usbsdmux", queue_size=2, on_drop=dropped.append)
+    results = [publisher.publish(f"message {i}") for i in range(4)]
+
+    assert results == [True, True, False, False]
+    assert dropped == ["message 0", "message 1"]
+    assert publisher.dropped == 2
+    assert publisher.close(timeout=0) == ["message 2", "message 3"]
+
+
+def test_forwarder(broker, tmp_path):
+    path = str(tmp_path / "mqtt.sock")
+    publisher = MqttPublisher("127.0.0.1", broker.port, "usbsdmux")
+    forwarder = Forwarder(path, publisher)
+    thread = threading.Thread(target=forwarder.serve_forever)
+    thread.start()
+
+    forward(path, '{"mode": "host"}')
+    assert broker.wait_for(1) == [("usbsdmux", b'{"mode": "host"}')]
+
+    forwarder.close()
+    thread.join()
+    publisher.close()
+
+    with pytest.raises(OSError):
+        forward(path, "lost")
+
+
+def test_spool_while_unreachable(broker, tmp_path):
+    with socket.create_server(("127.0.0.1", 0)) as unused:
+        port = unused.getsockname()[1]
+
+    spool = Spool(str(tmp_path / "spool"))
+    publisher = MqttPublisher("127.0.0.1", port, "usbsdmux", queue_size=1, spool=spool)
+    for i in range(3):
+        publisher.publish(f"message {i}")
+    assert publisher.close(timeout=0) == []
+    assert len(spool) == 3
+
+    # The spool is sent after the next successful publish
+    publisher = MqttPublisher("127.0.0.1", broker.port, "usbsdmux", spool=spool)
+    publisher.publish("message 3")
+    messages = broker.wait_for(4)
+    assert [payload for _, payload in messages] == [f"message {i}".encode() for i in (3, 0, 1, 2)]
+    publisher.close()
+    assert len(spool) == 0
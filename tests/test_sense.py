@@ -0,0 +1,58 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+import pytest
+
+from usbsdmux.sense import SenseData
+from usbsdmux.usb2642 import I2cTransactionFailed, SDTransactionFailed
+
+
+def fixed_sense(key, asc, ascq):
+    buffer = bytearray(18)
+    buffer[0] = 0x70
+    buffer[2] = key
+    buffer[7] = 10
+    buffer[12] = asc
+    buffer[13] = ascq
+    return bytes(buffer)
+
+
+@pytest.mark.parametrize(
+    "buffer",
+    [fixed_sense(0x2, 0x3A, 0x00), bytes([0x72, 0x2, 0x3A, 0x00, 0, 0, 0, 0])],
+    ids=["fixed", "descriptor"],
+)
+def test_parse_medium_not_present(buffer):
+    "test that both sense data formats are decoded"
+    sense = SenseData.parse(buffer)
+    assert (sense.key, sense.asc, sense.ascq) == (0x2, 0x3A, 0x00)
+    assert sense.medium_not_present
+    assert not sense.transient
+    assert str(sense) == "NOT READY: Medium not present (ASC 0x3A, ASCQ 0x00)"
+
+
+def test_parse_invalid():
+    "test that missing or unknown sense data is not decoded"
+    assert SenseData.parse(b"") is None
+    assert SenseData.parse(bytes(18)) is None
+
+
+@pytest.mark.parametrize(
+    "key, asc, ascq, transient",
+    [
+        (0x2, 0x04, 0x01, True),  # becoming ready
+        (0x6, 0x28, 0x00, True),  # medium may have changed
+        (0x2, 0x04, 0x03, False),  # manual intervention required
+        (0x5, 0x24, 0x00, False),  # invalid field in CDB
+    ],
+)
+def test_transient(key, asc, ascq, transient):
+    "test the classification of conditions that go away by themselves"
+    assert SenseData.parse(fixed_sense(key, asc, ascq)).transient == transient
+
+
+def test_transient_without_sense():
+    "test that only SD transactions are retried without sense data"
+    assert SDTransactionFailed("", 2, None).transient
+    assert not I2cTransactionFailed("", 2, None).transient
+    assert I2cTransactionFailed("", 8, None).transient
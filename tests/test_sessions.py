@@ -0,0 +1,105 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+from usbsdmux import blockdev, group, sessions, usbsdmux
+from usbsdmux.commands import run_command, switch_group
+from usbsdmux.mqtthelper import BLOCK_STAT_NAMES, Config
+from usbsdmux.sessions import SessionLog, delta, record_session
+from usbsdmux.simulation import SimulatedTransport, SimulatedUsbSdMux, default_card
+from usbsdmux.usbsdmux import UsbSdMuxFast
+
+
+def stat(**values):
+    return {name: values.get(name, 0) for name in BLOCK_STAT_NAMES}
+
+
+def test_delta():
+    "test that counters restarted by a new block device are handled"
+    assert delta(stat(sectors_written=10), stat(sectors_written=30))["sectors_written"] == 20
+    assert delta(stat(sectors_written=30, sectors_read=5), stat(sectors_written=8, sectors_read=9)) == delta(
+        stat(), stat(sectors_written=8, sectors_read=9)
+    )
+
+    # Kernels before 5.8 do not report flushes
+    old = {name: 0 for name in BLOCK_STAT_NAMES[:15]}
+    assert delta(old, old)["flush_requests_completed"] is None
+
+
+def test_session_log(tmp_path):
+    log = SessionLog(str(tmp_path / "sessions.db"))
+
+    log.begin("000000000042", stat(sectors_written=100), place="my-place", now=10)
+    # Switching to the host again does not start another session
+    log.begin("000000000042", stat(sectors_written=150), now=11)
+    assert log.is_open("000000000042")
+    assert log.sessions() == []
+
+    io = log.end("000000000042", stat(sectors_written=400, discards_completed=2), cid="0254", diskseq=3, now=20)
+    assert io["sectors_written"] == 300
+    assert io["discards_completed"] == 2
+    assert not log.is_open("000000000042")
+    assert log.end("000000000042", stat()) is None
+
+    log.begin("000000000007", stat(), now=30)
+    log.end("000000000007", stat(sectors_read=8), now=31)
+
+    (session,) = log.sessions(serial="000000000042")
+    assert session["place"] == "my-place"
+    assert (session["started"], session["ended"]) == (10, 20)
+    assert (session["cid"], session["diskseq"]) == ("0254", 3)
+    assert session["sectors_written"] == 300
+    assert [session["serial"] for session in log.sessions(since=25)] == ["000000000007"]
+    assert log.sessions(cid="0254") == [session]
+
+
+def test_record_session(tmp_path):
+    "test that a session is recorded from switching to the host until switching away"
+    configfile = tmp_path / "usbsdmux.config"
+    configfile.write_text(f"[sessions]\ndatabase = {tmp_path / 'sessions.db'}\n")
+    config = Config(str(configfile))
+
+    sysfs = tmp_path / "sys"
+    device = SimulatedUsbSdMux(UsbSdMuxFast, card=default_card(), serial="000000000042")
+    device.install_sysfs(sysfs, "sg0", block="sda")
+    stat_file = sysfs / "class/block/sda/stat"
+
+    ctl = UsbSdMuxFast("/dev/sg0", discharge_time=0, transport=SimulatedTransport(device))
+    ctl.mode_host()
+    record_session(ctl, config, "/dev/sg0", "host", sysfs=str(sysfs))
+
+    stat_file.write_text(" ".join(["0"] * 6 + ["2048"] + ["0"] * 10) + "\n")
+    record_session(ctl, config, "/dev/sg0", "dut", sysfs=str(sysfs))
+    ctl.mode_DUT()
+
+    (session,) = SessionLog(config.sessions_db).sessions()
+    assert session["serial"] == "000000000042"
+    assert session["sectors_written"] == 2048
+    assert session["cid"] == "02544d53413034471027b7748500bc00"
+
+
+def test_session_includes_flushed_writes(tmp_path, mocker):
+    "test that the card is flushed before the session is ended and the mux is switched"
+    configfile = tmp_path / "usbsdmux.config"
+    configfile.write_text(f"[switch]\nflush = true\n[sessions]\ndatabase = {tmp_path / 'sessions.db'}\n")
+    config = Config(str(configfile))
+
+    calls = []
+    mocker.patch.object(blockdev, "flush_card", lambda sg, check_mounted: calls.append(("flush", check_mounted)))
+    mocker.patch.object(sessions, "record_session", lambda ctl, config, sg, mode: calls.append(("session", mode)))
+    ctl = UsbSdMuxFast("/dev/sg0", discharge_time=0, transport=SimulatedTransport(SimulatedUsbSdMux(UsbSdMuxFast)))
+    mocker.patch.object(ctl, "_switch", lambda target, wait: calls.append(("switch", target)))
+
+    run_command(ctl, "/dev/sg0", config, "dut")
+    assert calls == [("flush", True), ("session", "dut"), ("switch", "dut")]
+
+    calls.clear()
+    mocker.patch.object(usbsdmux, "autoselect_driver", return_value=ctl)
+    mocker.patch.object(
+        group, "switch_all", lambda muxes, target, max_workers: [calls.append(("switch", target)) for _ in muxes]
+    )
+    assert switch_group(["/dev/sg0"], config, "dut") == {"/dev/sg0": None}
+    assert calls == [("flush", True), ("session", "dut"), ("switch", "dut")]
+
+    calls.clear()
+    assert switch_group(["/dev/sg0"], config, "host") == {"/dev/sg0": None}
+    assert calls == [("switch", "host"), ("flush", False), ("session", "host")]
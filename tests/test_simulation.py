@@ -0,0 +1,239 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+import asyncio
+import time
+
+import pytest
+
+from usbsdmux import aio
+from usbsdmux.calibration import calibrate_discharge_time
+from usbsdmux.group import switch_all
+from usbsdmux.i2c_gpio import I2cGpio, Tca6408
+from usbsdmux.simulation import SimulatedTransport, SimulatedUsbSdMux, default_card
+from usbsdmux.usb2642 import MediumNotPresent, TransactionFailed, Usb2642
+from usbsdmux.usb2642eeprom import USB2642Eeprom
+from usbsdmux.usbsdmux import (
+    NotInHostModeException,
+    UsbSdMuxClassic,
+    UsbSdMuxFast,
+    autoselect_driver,
+    get_modes,
+    usb_serial,
+)
+
+DRIVERS = [UsbSdMuxClassic, UsbSdMuxFast]
+
+
+@pytest.mark.parametrize("driver", DRIVERS)
+def test_autoselect(tmp_path, driver):
+    "test that the driver is selected by the model found in sysfs"
+    device = SimulatedUsbSdMux(driver, serial="000000000042")
+    device.install_sysfs(tmp_path, "sg3", block="sdb")
+
+    with autoselect_driver("/dev/sg3", transport=SimulatedTransport(device), sysfs=tmp_path) as ctl:
+        assert type(ctl) is driver
+    assert usb_serial("/dev/sg3", sysfs=tmp_path) == "000000000042"
+
+
+@pytest.mark.parametrize("driver", DRIVERS)
+def test_switch_modes(driver):
+    "test that the simulated card follows the mode set by the driver"
+    device = SimulatedUsbSdMux(driver, card=default_card())
+    ctl = driver("/dev/sg0", discharge_time=0, transport=SimulatedTransport(device))
+
+    ctl.mode_host()
+    assert ctl.get_mode() == device.mode == "host"
+    assert ctl.get_card_info()["cid"]["raw"] == "02544d53413034471027b7748500bc00"
+
+    ctl.mode_DUT()
+    assert ctl.get_mode() == device.mode == "dut"
+    with pytest.raises(NotInHostModeException):
+        ctl.get_card_info()
+    with pytest.raises(MediumNotPresent):
+        ctl._usb.read_cid()
+
+    ctl.mode_disconnect()
+    assert ctl.get_mode() == device.mode == "off"
+
+
+def test_switch_after_reset():
+    "test that the GPIO-expander is set up again if it has been reset while the device was reopened"
+    device = SimulatedUsbSdMux(UsbSdMuxFast, card=default_card())
+    transport = SimulatedTransport(device)
+    ctl = UsbSdMuxFast("/dev/sg0", discharge_time=0, transport=transport)
+    ctl.mode_host()
+
+    device.expander.reset()
+    transport.close()
+    ctl.mode_host()
+    assert device.mode == "host"
+
+    async def run():
+        ctl = aio.AsyncUsbSdMuxFast("/dev/sg0", discharge_time=0, transport=transport)
+        await ctl.mode_DUT()
+        device.expander.reset()
+        transport.close()
+        await ctl.mode_host()
+
+    asyncio.run(run())
+    assert device.mode == "host"
+
+
+@pytest.mark.parametrize("driver", DRIVERS)
+def test_discharge_after_other_instance(driver):
+    "test that the discharge time is waited for if the card may have been disconnected by another instance"
+    device = SimulatedUsbSdMux(driver, card=default_card())
+    driver("/dev/sg0", discharge_time=0, transport=SimulatedTransport(device)).mode_disconnect(wait=False)
+
+    ctl = driver("/dev/sg0", discharge_time=0.1, transport=SimulatedTransport(device))
+    start = time.monotonic()
+    ctl.mode_host()
+    assert time.monotonic() - start >= 0.1
+
+    ctl = driver("/dev/sg0", discharge_time=0.1, transport=SimulatedTransport(device))
+    start = time.monotonic()
+    ctl.mode_host()
+    assert time.monotonic() - start < 0.1
+
+
+def test_shadow_cache_transactions():
+    "test that the shadow cache saves the reads of read-modify-write operations"
+    device = SimulatedUsbSdMux(UsbSdMuxFast)
+    transport = SimulatedTransport(device)
+    ctl = UsbSdMuxFast("/dev/sg0", cache_registers=True, discharge_time=0, transport=transport)
+    ctl.mode_host()
+
+    transport.transactions.clear()
+    ctl.mode_DUT()
+    assert transport.transactions == {"i2c-write-read": 1, "i2c-write": 3}
+
+
+def test_write_read_to_copies_data():
+    "test that read data is not changed by the following transaction"
+    usb = Usb2642("/dev/sg0", transport=SimulatedTransport(SimulatedUsbSdMux(UsbSdMuxFast)))
+    inputs = usb.write_read_to(Tca6408._I2cAddr, [I2cGpio._register_inputPort], 1)
+    usb.write_read_to(Tca6408._I2cAddr, [I2cGpio._register_polarity], 1)
+    assert inputs == bytes([0x09])
+
+
+def test_card_becoming_ready():
+    "test that register reads are retried while the card initializes"
+    device = SimulatedUsbSdMux(UsbSdMuxFast, card=default_card(init_time=0.05))
+    transport = SimulatedTransport(device)
+    ctl = UsbSdMuxFast("/dev/sg0", discharge_time=0, transport=transport)
+
+    ctl.mode_host()
+    assert ctl.get_card_info()["scr"]["raw"] == "0235800001000000"
+    assert transport.transactions["read-register"] > 3
+
+
+def test_calibration():
+    "test that calibration finds the time the card needs to reset"
+    device = SimulatedUsbSdMux(UsbSdMuxFast, card=default_card(min_off_time=0.04))
+    ctl = UsbSdMuxFast("/dev/sg0", discharge_time=0.05, transport=SimulatedTransport(device))
+
+    assert calibrate_discharge_time(ctl, candidates=(0.1, 0.05, 0.02)) == pytest.approx(0.1)
+    assert device.mode == "host"
+
+
+def test_get_modes_concurrently():
+    "test that commands on several devices are in flight at the same time"
+    devices = [SimulatedUsbSdMux(UsbSdMuxFast) for _ in range(4)]
+    muxes = [UsbSdMuxFast("/dev/sg0", transport=SimulatedTransport(device, latency=0.1)) for device in devices]
+
+    start = time.monotonic()
+    assert get_modes(muxes) == ["dut"] * 4
+    assert time.monotonic() - start < 0.3
+
+
+def test_get_modes_timeout():
+    "test that devices are usable again after their commands timed out"
+    devices = [SimulatedUsbSdMux(UsbSdMuxFast) for _ in range(2)]
+    transports = [SimulatedTransport(device, latency=0.2) for device in devices]
+    muxes = [UsbSdMuxFast("/dev/sg0", transport=transport) for transport in transports]
+
+    with pytest.raises(TimeoutError):
+        get_modes(muxes, timeout=0.05)
+
+    for transport in transports:
+        transport.latency = 0
+    assert get_modes(muxes, timeout=1) == ["dut"] * 2
+    assert [mux.get_mode() for mux in muxes] == ["dut"] * 2
+
+
+def test_switch_all(mocker):
+    "test that several devices are switched waiting for the discharge only once"
+    devices = [SimulatedUsbSdMux(UsbSdMuxFast, card=default_card()) for _ in range(4)]
+    muxes = [UsbSdMuxFast("/dev/sg0", discharge_time=0.2, transport=SimulatedTransport(device)) for device in devices]
+    muxes[1].mode_host()
+    mocker.patch.object(muxes[3], "get_mode", side_effect=TransactionFailed("gone"))
+
+    start = time.monotonic()
+    results = switch_all(muxes, "host")
+    assert 0.2 <= time.monotonic() - start < 0.35
+
+    assert results[:3] == [None, None, None]
+    assert isinstance(results[3], TransactionFailed)
+    assert [device.mode for device in devices] == ["host", "host", "host", "dut"]
+
+
+def test_asyncio(tmp_path):
+    "test the asyncio interface on the simulated hardware"
+    device = SimulatedUsbSdMux(UsbSdMuxClassic, card=default_card())
+    device.install_sysfs(tmp_path, "sg0")
+
+    async def run():
+        transport = SimulatedTransport(device, latency=0.01)
+        async with await aio.autoselect_driver("/dev/sg0", transport=transport, sysfs=tmp_path) as ctl:
+            await ctl.mode_host(wait=False)
+            return await ctl.get_mode(), await ctl.get_card_info()
+
+    mode, info = asyncio.run(run())
+    assert mode == "host"
+    assert info["csd"]["raw"] == "400e00325b5900001d177f800a400000"
+
+
+def test_asyncio_discharge_time(tmp_path):
+    "test that the asyncio interface waits for the discharge time of the instance"
+    device = SimulatedUsbSdMux(UsbSdMuxFast, card=default_card())
+    device.install_sysfs(tmp_path, "sg0")
+    transport = SimulatedTransport(device)
+
+    async def run():
+        ctl = await aio.autoselect_driver("/dev/sg0", discharge_time=0.1, transport=transport, sysfs=tmp_path)
+        async with ctl:
+            await ctl.mode_host()
+            start = time.monotonic()
+            await ctl.mode_DUT()
+            return time.monotonic() - start
+
+    assert 0.1 <= asyncio.run(run()) < 0.5
+
+
+def test_asyncio_cancel():
+    "test that a device is usable again after waiting for a command was cancelled"
+    transport = SimulatedTransport(SimulatedUsbSdMux(UsbSdMuxClassic), latency=0.2)
+
+    async def run():
+        async with aio.AsyncUsbSdMuxClassic("/dev/sg0", transport=transport) as ctl:
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(ctl.get_mode(), 0.05)
+            transport.latency = 0
+            return await ctl.get_mode()
+
+    assert asyncio.run(run()) == "dut"
+
+
+def test_write_config():
+    "test that the config EEPROM blob reaches the USB2642"
+    device = SimulatedUsbSdMux()
+    transport = SimulatedTransport(device)
+    with USB2642Eeprom("/dev/sg0", transport=transport) as eeprom:
+        eeprom.write(0x0424, 0x4041, "usb-sd-mux_rev4", "Pengutronix", "000000000042", "PTX", "sdmux")
+        assert transport._pipe is not None
+    # Leaving the context closes the sg-device
+    assert transport._pipe is None
+
+    assert len(device.config) == Usb2642._DATA_LEN
+    assert device.config[0x1A:0x1E] == bytes([0x24, 0x04, 0x41, 0x40])
@@ -0,0 +1,37 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+from usbsdmux.spool import Spool
+
+
+def test_take_and_restore(tmp_path):
+    spool = Spool(str(tmp_path / "spool"))
+    spool.extend(["a", "b", b"c"])
+    spool.append("d")
+
+    assert spool.take(limit=2) == [b"a", b"b"]
+    spool.restore([b"a"])
+    assert spool.take() == [b"a", b"c", b"d"]
+    assert spool.take() == []
+
+
+def test_evict_oldest(tmp_path):
+    # Room for three records of "x0\n"
+    spool = Spool(str(tmp_path / "spool"), max_bytes=9)
+    for i in range(5):
+        spool.append(f"x{i}")
+
+    assert spool.evicted == 2
+    assert spool.take() == [b"x2", b"x3", b"x4"]
+
+
+def test_backing_off(tmp_path):
+    spool = Spool(str(tmp_path / "spool"))
+    assert not spool.backing_off(60)
+
+    spool.mark_failed()
+    assert spool.backing_off(60)
+    assert not spool.backing_off(0)
+
+    spool.mark_succeeded()
+    assert not spool.backing_off(60)
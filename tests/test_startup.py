@@ -0,0 +1,250 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+"""
+The usbsdmux tool is started for every single command, so its startup time
+matters more than the time the commands take. These tests ensure that every
+command only imports the modules it needs.
+
+Run this file directly to benchmark the startup of every command:
+
+    python3 tests/test_startup.py [--update] [--runs N] [--tolerance FRACTION]
+
+It measures the total import time (python -X importtime) and the wall-clock
+time of every command relative to those of the bare interpreter, measured in
+the same run, so the results of different machines can be compared. It fails
+if one of them got slower than recorded in tests/startup-baseline.json. Use
+--update to record a new baseline.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import pytest
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "startup-baseline.json")
+
+# Import usbsdmux from this source tree, even if it is not installed
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs the usbsdmux tool with a simulated USB-SD-Mux as /dev/sg0 and prints
+# the imported modules to stderr. The simulation itself imports the driver
+# modules, which every command talking to a USB-SD-Mux needs anyway.
+DRIVER = """
+import sys
+
+if sys.argv[1] == "simulate":
+    from usbsdmux import simulation, usbsdmux
+
+    device = simulation.SimulatedUsbSdMux(usbsdmux.UsbSdMuxFast, card=simulation.default_card())
+
+    def autoselect_driver(sg, discharge_time=None, transport=None, **kwargs):
+        return usbsdmux.UsbSdMuxFast(sg, discharge_time=0, transport=simulation.SimulatedTransport(device))
+
+    usbsdmux.autoselect_driver = autoselect_driver
+    # Allow reading the card information
+    autoselect_driver("/dev/sg0").mode_host()
+
+sys.argv = ["usbsdmux"] + sys.argv[2:]
+try:
+    from usbsdmux.__main__ import main
+
+    main()
+finally:
+    print("MODULES", " ".join(sorted(sys.modules)), file=sys.stderr)
+"""
+
+# Modules that are only needed by some commands or configurations
+OPTIONAL_MODULES = {
+    "concurrent.futures",
+    "sqlite3",
+    "socketserver",
+    "usbsdmux.batch",
+    "usbsdmux.blockdev",
+    "usbsdmux.calibration",
+    "usbsdmux.daemon",
+    "usbsdmux.hotplug",
+    "usbsdmux.mqtthelper",
+    "usbsdmux.group",
+    "usbsdmux.publisher",
+    "usbsdmux.sessions",
+    "usbsdmux.spool",
+    "usbsdmux.trace",
+}
+
+# Name of the run of the bare interpreter the commands are compared to
+REFERENCE = "python"
+
+# name -> (simulate a USB-SD-Mux, arguments, optional modules it may import)
+COMMANDS = {
+    "help": (False, ["-h"], set()),
+    "list": (False, ["list"], set()),
+    "get": (True, ["/dev/sg0", "get"], set()),
+    "host": (True, ["/dev/sg0", "host"], set()),
+    "dut": (True, ["/dev/sg0", "dut"], set()),
+    "off": (True, ["/dev/sg0", "off"], set()),
+    "gpio": (True, ["/dev/sg0", "gpio", "0", "get"], set()),
+    "info": (True, ["/dev/sg0", "info"], set()),
+}
+
+
+def run(name, configfile, importtime=False):
+    """
+    Runs a command of COMMANDS, or only the interpreter for REFERENCE, and
+    returns the completed process.
+    """
+    cmd = [sys.executable]
+    if importtime:
+        cmd += ["-X", "importtime"]
+    if name == REFERENCE:
+        cmd += ["-c", "pass"]
+    else:
+        simulate, args, _ = COMMANDS[name]
+        cmd += ["-c", DRIVER, "simulate" if simulate else "direct", "--config", configfile] + args
+        if args[0] in ("-h", "list"):
+            cmd.remove("--config")
+            cmd.remove(configfile)
+    return subprocess.run(cmd, capture_output=True, text=True, check=True, env=_env())
+
+
+def _env():
+    return dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")])))
+
+
+def imported_modules(stderr):
+    for line in stderr.splitlines():
+        if line.startswith("MODULES "):
+            return set(line.split()[1:])
+    raise ValueError("No module list found")
+
+
+def import_time(stderr):
+    """
+    Returns the total time in microseconds spent importing modules.
+    """
+    # "import time: self [us] | cumulative | imported package"
+    return sum(
+        int(line.split(":", 1)[1].split("|")[0])
+        for line in stderr.splitlines()
+        if line.startswith("import time:") and "self [us]" not in line
+    )
+
+
+@pytest.fixture
+def configfile(tmp_path):
+    configfile = tmp_path / "usbsdmux.config"
+    configfile.write_text("")
+    return str(configfile)
+
+
+@pytest.mark.parametrize("name", COMMANDS)
+def test_imports(name, configfile):
+    "test that commands only import the optional modules they need"
+    modules = imported_modules(run(name, configfile).stderr)
+    assert modules & OPTIONAL_MODULES == COMMANDS[name][2]
+
+
+def test_help_imports_no_driver(configfile):
+    "test that showing the help does not load the driver"
+    modules = imported_modules(run("help", configfile).stderr)
+    assert not {"ctypes", "usbsdmux.usb2642", "usbsdmux.usbsdmux"} & modules
+
+
+def test_eeprom_tool_imports():
+    "test that the EEPROM tool only loads the trace support when recording"
+    code = "import sys, usbsdmux.usb2642eeprom; print(' '.join(sys.modules))"
+    process = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True, env=_env())
+    modules = set(process.stdout.split())
+    assert "usbsdmux.usb2642eeprom" in modules
+    assert not {"usbsdmux.simulation", "usbsdmux.trace"} & modules
+
+
+def benchmark(configfile, runs):
+    """
+    Returns the median import time in milliseconds and the median wall-clock
+    time in milliseconds of the bare interpreter and of every command.
+    """
+    results = {}
+    for name in [REFERENCE, *COMMANDS]:
+        imports = [import_time(run(name, configfile, importtime=True).stderr) / 1000 for _ in range(runs)]
+        walls = []
+        for _ in range(runs):
+            start = time.monotonic()
+            run(name, configfile)
+            walls.append((time.monotonic() - start) * 1000)
+        results[name] = {"import": statistics.median(imports), "wall": statistics.median(walls)}
+    return results
+
+
+def relative(results):
+    """
+    Returns the import and wall-clock times of every command as multiple of
+    those of the bare interpreter.
+    """
+    reference = results[REFERENCE]
+    return {
+        name: {key: round(result[key] / reference[key], 2) for key in result}
+        for name, result in results.items()
+        if name != REFERENCE
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the startup of the usbsdmux commands.")
+    parser.add_argument("--runs", type=int, default=10, help="Runs per command (default: %(default)s)")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.3,
+        help="Allowed slowdown against the baseline as fraction (default: %(default)s)",
+    )
+    parser.add_argument("--baseline", default=BASELINE, help="Baseline file (default: %(default)s)")
+    parser.add_argument("--update", action="store_true", help="Store the results as new baseline")
+    args = parser.parse_args()
+
+    configfile = os.path.join(os.path.dirname(args.baseline), "startup-empty.config")
+    with open(configfile, "w"):
+        pass
+    try:
+        results = benchmark(configfile, args.runs)
+    finally:
+        os.unlink(configfile)
+    ratios = relative(results)
+
+    if args.update:
+        with open(args.baseline, "w") as fh:
+            json.dump(ratios, fh, indent=2)
+            fh.write("\n")
+
+    with open(args.baseline) as fh:
+        baseline = json.load(fh)
+
+    reference = results[REFERENCE]
+    print(f"Bare interpreter: imports {reference['import']:.1f} ms, startup {reference['wall']:.1f} ms")
+    columns = " ".join(f"{title:>14} {'x python':>9} {'baseline':>9}" for title in ("imports [ms]", "startup [ms]"))
+    print(f"{'command':<8} {columns}")
+    regressions = 0
+    for name, ratio in ratios.items():
+        base = baseline.get(name, {})
+        slower = [key for key in ratio if key in base and ratio[key] > base[key] * (1 + args.tolerance)]
+        regressions += bool(slower)
+        print(
+            f"{name:<8} "
+            + " ".join(
+                f"{results[name][key]:>14.1f} {ratio[key]:>9.2f} {base.get(key, float('nan')):>9.2f}"
+                for key in ("import", "wall")
+            )
+            + (f"  REGRESSION: {', '.join(slower)}" if slower else "")
+        )
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
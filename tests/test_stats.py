@@ -0,0 +1,59 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+import pytest
+
+from usbsdmux.simulation import SimulatedTransport, SimulatedUsbSdMux, default_card
+from usbsdmux.stats import Histogram, StatsFile, TransactionStats
+from usbsdmux.usb2642 import MediumNotPresent
+from usbsdmux.usbsdmux import UsbSdMuxFast
+
+
+def test_histogram():
+    "test that values are counted in the bucket of the next larger bound"
+    histogram = Histogram((0.001, 0.01, 0.1))
+    for value in (0.0005, 0.001, 0.002, 0.05, 0.05, 3):
+        histogram.observe(value)
+
+    assert histogram.buckets == [2, 1, 2, 1]
+    assert histogram.quantile(0.5) == 0.01
+    assert histogram.quantile(0.8) == 0.1
+    assert histogram.quantile(1) == float("inf")
+    assert histogram.mean == pytest.approx(3.1035 / 6)
+
+
+def test_transaction_stats():
+    "test that commands, failures, retries and sleeps are accounted"
+    device = SimulatedUsbSdMux(UsbSdMuxFast, card=default_card(init_time=0.03))
+    ctl = UsbSdMuxFast("/dev/sg0", discharge_time=0.01, transport=SimulatedTransport(device, latency=0.002))
+
+    with pytest.raises(MediumNotPresent):
+        ctl._usb.read_cid()
+    ctl.mode_host()
+    ctl._usb.read_cid()
+
+    reads = ctl.stats.operations["read-register"]
+    assert reads.retries > 0
+    assert reads.failures == reads.retries + 1
+    assert reads.count == reads.failures + 1
+    assert reads.duration.mean == pytest.approx(0.002)
+    assert reads.latency.quantile(0.5) == 0.005
+    assert ctl.stats.operations["i2c-write"].count > 0
+    assert ctl.stats.sleeps["discharge"].count == 1
+    assert ctl.stats.sleeps["retry"].count == reads.retries
+
+
+def test_stats_file(tmp_path):
+    "test that the statistics of several processes are accumulated"
+    stats = TransactionStats()
+    stats.record("i2c-write", 0.003, 0.002, False)
+    stats.record_sleep("discharge", 1)
+
+    stats_file = StatsFile(str(tmp_path / "stats.json"))
+    stats_file.add("000000000042", stats)
+    stats_file.add("000000000042", stats)
+
+    total = stats_file.get("000000000042")
+    assert total.operations["i2c-write"].count == 2
+    assert total.sleeps["discharge"].sum == 2
+    assert stats_file.get("000000000043").operations["i2c-write"].count == 0
@@ -0,0 +1,67 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+import time
+
+import pytest
+
+from usbsdmux.simulation import SimulatedTransport, SimulatedUsbSdMux, default_card
+from usbsdmux.trace import RecordingTransport, ReplayTransport, TraceMismatch, read_trace
+from usbsdmux.usb2642eeprom import USB2642Eeprom
+from usbsdmux.usbsdmux import UsbSdMuxFast, get_modes
+
+
+def _session(transport):
+    ctl = UsbSdMuxFast("/dev/sg0", discharge_time=0, transport=transport)
+    ctl.mode_host()
+    info = ctl.get_card_info()
+    ctl.mode_DUT()
+    modes = get_modes([ctl])
+    ctl.close()
+    return info, modes
+
+
+def test_record_replay(tmp_path):
+    "test that a replayed session behaves like the recorded one"
+    trace = tmp_path / "trace.bin"
+    device = SimulatedUsbSdMux(UsbSdMuxFast, card=default_card())
+    recorded = _session(RecordingTransport(SimulatedTransport(device, latency=0.001), trace))
+
+    records = list(read_trace(trace))
+    assert records[-1].asynchronous
+    assert all(record.duration == 1 for record in records)
+    assert all(record.elapsed >= 0.001 for record in records)
+
+    replay = ReplayTransport(trace)
+    assert _session(replay) == recorded
+    assert replay.replayed == len(records)
+
+
+def test_replay_mismatch(tmp_path):
+    "test that diverging from the trace is detected"
+    trace = tmp_path / "trace.bin"
+    device = SimulatedUsbSdMux(UsbSdMuxFast, card=default_card())
+    ctl = UsbSdMuxFast("/dev/sg0", transport=RecordingTransport(SimulatedTransport(device), trace))
+    ctl.close()
+
+    ctl = UsbSdMuxFast("/dev/sg0", transport=ReplayTransport(trace))
+    with pytest.raises(TraceMismatch):
+        ctl.mode_host()
+
+
+def test_replay_realtime(tmp_path):
+    "test that realtime replay reproduces the recorded latencies"
+    trace = tmp_path / "trace.bin"
+    transport = RecordingTransport(SimulatedTransport(SimulatedUsbSdMux(), latency=0.02), trace)
+    eeprom = USB2642Eeprom("/dev/sg0", transport=transport)
+    eeprom.write(0x0424, 0x4041, "usb-sd-mux_rev4", "Pengutronix", "000000000042", "PTX", "sdmux")
+    eeprom.close()
+
+    eeprom = USB2642Eeprom("/dev/sg0", transport=ReplayTransport(trace, realtime=True))
+    start = time.monotonic()
+    eeprom.write(0x0424, 0x4041, "usb-sd-mux_rev4", "Pengutronix", "000000000042", "PTX", "sdmux")
+    assert time.monotonic() - start >= 0.02
+
+    eeprom = USB2642Eeprom("/dev/sg0", transport=ReplayTransport(trace))
+    with pytest.raises(TraceMismatch):
+        eeprom.write(0x0424, 0x4041, "usb-sd-mux_rev4", "Pengutronix", "000000000043", "PTX", "sdmux")
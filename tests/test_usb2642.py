@@ -0,0 +1,61 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+import errno
+import itertools
+
+import pytest
+
+from usbsdmux.simulation import SimulatedUsbSdMux
+from usbsdmux.usb2642 import IoctlFailed, RetryPolicy, SgTransport
+
+
+def test_retry_policy_backoff():
+    "test that retry delays grow exponentially up to max_delay"
+    policy = RetryPolicy(initial_delay=0.005, multiplier=2, max_delay=0.03, deadline=60)
+    delays = list(itertools.islice(policy.delays(), 6))
+    assert delays == [0.005, 0.01, 0.02, 0.03, 0.03, 0.03]
+
+
+def test_retry_policy_deadline():
+    "test that no retries are started after the deadline"
+    assert list(RetryPolicy(deadline=0).delays()) == []
+
+
+@pytest.fixture
+def stale_sg(tmp_path, mocker):
+    "an SgTransport whose first SG_IO fails as if the USB-SD-Mux was re-enumerated"
+    sysfs = tmp_path / "sys"
+    SimulatedUsbSdMux(serial="000000000042").install_sysfs(sysfs, "sg0")
+    sg = tmp_path / "sg0"
+    sg.write_bytes(b"")
+    calls = []
+
+    def ioctl(fd, request, arg=None):
+        if request == SgTransport._SG_IO:
+            calls.append(fd)
+            if len(calls) == 1:
+                raise OSError(errno.ENODEV, "No such device")
+        return 0
+
+    mocker.patch("fcntl.ioctl", ioctl)
+    return SgTransport(str(sg), sysfs=str(sysfs)), sysfs, calls
+
+
+def test_stale_fd_reopened(stale_sg):
+    "test that the command is sent again if the sg-device belongs to the same USB device"
+    transport, _, calls = stale_sg
+    transport.execute(None)
+    assert len(calls) == 2
+    assert transport.generation == 2
+
+
+def test_stale_fd_other_device(stale_sg):
+    "test that the command is not sent to another USB-SD-Mux that got the same sg-device"
+    transport, sysfs, calls = stale_sg
+    transport.open()
+    (sysfs / "devices/pci0000:00/0000:00:14.0/usb1/1-1/serial").write_text("000000000007\n")
+
+    with pytest.raises(IoctlFailed, match="has gone away"):
+        transport.execute(None)
+    assert len(calls) == 1
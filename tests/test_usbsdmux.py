@@ -0,0 +1,53 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+import pytest
+
+from usbsdmux.usbsdmux import UsbSdMuxClassic, UsbSdMuxFast
+
+DRIVERS = [UsbSdMuxClassic, UsbSdMuxFast]
+
+
+@pytest.mark.parametrize("driver", DRIVERS)
+@pytest.mark.parametrize("mode", ["off", "dut", "host"])
+def test_plan_noop(driver, mode):
+    "test that nothing is written if the mux is already in the target mode"
+    assert driver._plan_transition(driver._pin_values(mode), True, mode) == []
+
+
+@pytest.mark.parametrize("driver", DRIVERS)
+def test_plan_host_to_dut(driver):
+    "test that switching sides disconnects, waits and selects before connecting"
+    steps = driver._plan_transition(driver._pin_values("host"), True, "dut")
+    assert steps == [
+        ("output", driver._pin_values("off")),
+        ("wait", None),
+        ("output", driver._pin_values("dut-select")),
+        ("output", driver._pin_values("dut")),
+    ]
+
+
+@pytest.mark.parametrize("driver", DRIVERS)
+def test_plan_off_to_host(driver):
+    "test that connecting a disconnected card only needs a single write"
+    steps = driver._plan_transition(driver._pin_values("off"), True, "host")
+    assert steps == [("wait", None), ("output", driver._pin_values("host"))]
+
+
+@pytest.mark.parametrize("driver", DRIVERS)
+def test_plan_unconfigured(driver):
+    "test that outputs are set before they are enabled after power on reset"
+    steps = driver._plan_transition(0xFF, False, "host")
+    assert steps == [
+        ("output", driver._pin_values("off")),
+        ("direction", None),
+        ("wait", None),
+        ("output", driver._pin_values("host")),
+    ]
+
+
+@pytest.mark.parametrize("driver", DRIVERS)
+@pytest.mark.parametrize("mode", ["off", "dut", "host"])
+def test_decode_mode(driver, mode):
+    "test that the pin values of every mode are decoded to that mode"
+    assert driver._decode_mode(driver._pin_values(mode)) == mode
@@ -4,22 +4,201 @@
 # SPDX-FileCopyrightText: 2017 The USB-SD-Mux Authors
 
 import argparse
-import errno
 import json
 import sys
 
-from .mqtthelper import Config, publish_info
-from .sd_regs import decoded_to_text
-from .usbsdmux import NotInHostModeException, UnknownUsbSdMuxRevisionException, autoselect_driver
+from .commands import (
+    COMMANDS,
+    SWITCH_COMMANDS,
+    discharge_time,
+    error_message,
+    result_to_text,
+    run_command,
+    stats_key,
+    store_stats,
+    switch_group,
+)
+
+# The tool is started for every single command. Only import what the command
+# at hand needs, see tests/test_startup.py.
+
+SG_HELP = "/dev/sg* to use or a serial:, usb: or place: selector"
+
+
+def _print_result(args, result):
+    if args.json:
+        print(json.dumps(result, indent=2 if args.mode == "info" else None))
+    else:
+        for line in result_to_text(args.mode, result, getattr(args, "action", None)):
+            print(line)
+
+
+def _fail(args, error_msg):
+    if args.json:
+        print(json.dumps({"error-message": error_msg}))
+    else:
+        print(error_msg, file=sys.stderr)
+    sys.exit(1)
+
+
+def _command_params(args):
+    """
+    Returns the arguments of the command for commands.run_command().
+    """
+    params = {}
+    if args.mode == "gpio":
+        params.update(gpio=args.gpio, action=args.action)
+    if args.mode == "host" and args.wait_for_block:
+        params.update(wait_for_block=True, timeout=args.timeout)
+    if getattr(args, "flush", None):
+        params.update(flush=True)
+    return params
+
+
+def _run_via_daemon(args, path):
+    """
+    Runs the command using usbsdmuxd. Returns its result or None if the
+    daemon is not reachable.
+    """
+    from .daemon import Client, DaemonError
+
+    params = _command_params(args)
+    try:
+        client = Client(path)
+    except OSError:
+        return None
+    with client:
+        try:
+            return client.request(args.sg, args.mode, **params)
+        except DaemonError as e:
+            _fail(args, str(e))
+
+
+def list_main(argv):
+    """
+    Lists the USB-SD-Muxes attached to this host: usbsdmux list
+    """
+    parser = argparse.ArgumentParser(prog="usbsdmux list", description="List the USB-SD-Muxes attached to this host.")
+    parser.add_argument("--json", help="Format output as json. Useful for scripting.", action="store_true")
+    args = parser.parse_args(argv)
+
+    from .discovery import scan
+
+    devices = [mux.to_dict() for mux in scan()]
+    if args.json:
+        print(json.dumps(devices, indent=2))
+        return
+
+    columns = ("sg", "block", "model", "serial", "usb", "speed")
+    rows = [columns] + [
+        tuple("-" if device[column] is None else str(device[column]) for column in columns) for device in devices
+    ]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    for row in rows:
+        print("  ".join(value.ljust(width) for value, width in zip(row, widths, strict=True)).rstrip())
+
+
+def group_main(mode, argv):
+    """
+    Switches several USB-SD-Muxes at once: usbsdmux MODE [--all] [SG ...]
+    """
+    parser = argparse.ArgumentParser(
+        prog=f"usbsdmux {mode}", description="Switch several USB-SD-Muxes at once, waiting for them in parallel."
+    )
+    parser.add_argument("sg", metavar="SG", nargs="*", help=SG_HELP)
+    parser.add_argument("--all", help="Switch all USB-SD-Muxes attached to this host", action="store_true")
+    parser.add_argument("--config", help="Set config file location", default=None)
+    parser.add_argument(
+        "--discharge-time",
+        metavar="SECONDS",
+        help="Time to wait for the SD card supply to discharge when switching",
+        type=float,
+        default=None,
+    )
+    parser.add_argument("--json", help="Format output as json. Useful for scripting.", action="store_true")
+
+    args = parser.parse_args(argv)
+    if not args.sg and not args.all:
+        parser.error("No USB-SD-Mux given. Pass at least one SG or --all.")
+
+    from .config import Config
+    from .discovery import DeviceNotFound, resolve, scan
+
+    config = Config(args.config)
+    try:
+        sgs = [resolve(sg, config.places) for sg in args.sg]
+    except DeviceNotFound as e:
+        parser.error(str(e))
+    if args.all:
+        sgs += [mux.sg for mux in scan()]
+
+    errors = switch_group(sgs, config, mode, args.discharge_time)
+
+    if args.json:
+        results = [{"sg": sg} if error is None else {"sg": sg, "error-message": error} for sg, error in errors.items()]
+        print(json.dumps(results))
+    else:
+        for sg, error in errors.items():
+            if error is None:
+                print(f"{sg}: {mode}")
+            else:
+                print(f"{sg}: {error}", file=sys.stderr)
+
+    if any(error is not None for error in errors.values()):
+        sys.exit(1)
 
 
 def main():
-    parser = argparse.ArgumentParser(prog=sys.argv[0], formatter_class=argparse.RawTextHelpFormatter)
+    # "batch" does not operate on a single SG and has its own arguments.
+    if sys.argv[1:2] == ["batch"]:
+        from .batch import main as batch_main
+
+        batch_main(sys.argv[2:])
+        return
+
+    if sys.argv[1:2] == ["list"]:
+        list_main(sys.argv[2:])
+        return
+
+    # Switching several devices at once names the mode first.
+    if sys.argv[1:2] and sys.argv[1] in SWITCH_COMMANDS:
+        group_main(sys.argv[1], sys.argv[2:])
+        return
+
+    parser = argparse.ArgumentParser(
+        prog=sys.argv[0],
+        formatter_class=argparse.RawTextHelpFormatter,
+        epilog="Use 'usbsdmux list' to list the USB-SD-Muxes attached to this host.\n"
+        "Use 'usbsdmux batch -h' to run many commands in a single process.\n"
+        "Use 'usbsdmux {dut,client,host,off} -h' to switch several devices at once.",
+    )
 
-    parser.add_argument("sg", metavar="SG", help="/dev/sg* to use")
+    parser.add_argument("sg", metavar="SG", help=SG_HELP)
 
     parser.add_argument("--config", help="Set config file location", default=None)
 
+    parser.add_argument(
+        "--discharge-time",
+        metavar="SECONDS",
+        help="Time to wait for the SD card supply to discharge when switching",
+        type=float,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--socket",
+        metavar="PATH",
+        help="Run the command using the usbsdmuxd listening on PATH,\nif reachable",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--record-trace",
+        metavar="FILE",
+        help="Record all commands sent to the USB-SD-Mux to a trace file",
+        default=None,
+    )
+
     format_parser = parser.add_mutually_exclusive_group()
     format_parser.add_argument("--json", help="Format output as json. Useful for scripting.", action="store_true")
 
@@ -28,9 +207,29 @@ def main():
     subparsers.dest = "mode"
 
     subparsers.add_parser("get", help="Read the current state of the USB-SD-Mux")
-    subparsers.add_parser("dut", help="Switch to the DUT")
-    subparsers.add_parser("client", help="Switch to the DUT")
-    subparsers.add_parser("host", help="Switch to the host")
+    parser_dut = subparsers.add_parser("dut", help="Switch to the DUT")
+    parser_client = subparsers.add_parser("client", help="Switch to the DUT")
+    parser_host = subparsers.add_parser("host", help="Switch to the host")
+    for subparser in (parser_dut, parser_client, parser_host):
+        subparser.add_argument(
+            "--flush",
+            help="Flush the block device of the SD card before switching to the DUT "
+            "or drop its cached data after switching to the host",
+            action="store_true",
+            default=None,
+        )
+    parser_host.add_argument(
+        "--wait-for-block",
+        help="Wait until the block device of the SD card is usable and print its path",
+        action="store_true",
+    )
+    parser_host.add_argument(
+        "--timeout",
+        metavar="SECONDS",
+        help="Maximum time to wait for the block device (default: %(default)s)",
+        type=float,
+        default=10,
+    )
     subparsers.add_parser("off", help="Disconnect from host and DUT")
 
     parser_gpio = subparsers.add_parser("gpio", help="Manipulate a GPIO (open drain output only)")
@@ -38,94 +237,97 @@ def main():
     parser_gpio.add_argument("action", help="What to do with the GPIO", choices=["low", "0", "high", "1", "get"])
 
     subparsers.add_parser("info", help="Show information about the SD card")
+    subparsers.add_parser("calibrate", help="Determine the shortest safe discharge time for the inserted SD card")
+    subparsers.add_parser("stats", help="Show latency statistics of the commands sent to the USB-SD-Mux")
 
     args = parser.parse_args()
 
+    from .config import Config
+    from .usbsdmux import UnknownUsbSdMuxRevisionException, autoselect_driver
+
     config = Config(args.config)
 
+    if ":" in args.sg:
+        from .discovery import DeviceNotFound, resolve
+
+        try:
+            args.sg = resolve(args.sg, config.places)
+        except DeviceNotFound as e:
+            _fail(args, str(e))
+
+    # The daemon uses its own discharge time and can not record traces.
+    socket_path = args.socket or config.daemon_socket
+    if socket_path and args.mode in COMMANDS and args.discharge_time is None and not args.record_trace:
+        result = _run_via_daemon(args, socket_path)
+        if result is not None:
+            _print_result(args, result)
+            return
+
+    transport = None
+    if args.record_trace:
+        from .trace import RecordingTransport
+        from .usb2642 import SgTransport
+
+        transport = RecordingTransport(SgTransport(args.sg), args.record_trace)
+
+    discharge = args.discharge_time
+    if args.mode in SWITCH_COMMANDS:
+        discharge = discharge_time(args.sg, config, discharge)
+    elif discharge is None:
+        discharge = config.discharge_time
+
     try:
-        ctl = autoselect_driver(args.sg)
+        ctl = autoselect_driver(args.sg, discharge_time=discharge, transport=transport)
     except UnknownUsbSdMuxRevisionException as e:
-        error_msg = str(e) + "\n" + f"Does {args.sg} really point to a USB-SD-Mux?"
-        if args.json:
-            print(json.dumps({"error-message": error_msg}))
-        else:
-            print(error_msg, file=sys.stderr)
-        sys.exit(1)
+        _fail(args, str(e) + "\n" + f"Does {args.sg} really point to a USB-SD-Mux?")
     mode = args.mode
 
     error_msg = None
     try:
-        if mode == "off":
-            ctl.mode_disconnect()
-            if args.json:
-                print(json.dumps({}))
+        if mode in COMMANDS:
+            _print_result(args, run_command(ctl, args.sg, config, mode, **_command_params(args)))
 
-        elif mode in ("dut", "client"):
-            publish_info(ctl, config, args.sg, "client")
+        elif mode == "calibrate":
+            from .calibration import CalibrationFailed, DischargeCalibration, calibrate_discharge_time
+            from .usbsdmux import usb_serial
 
-            ctl.mode_DUT()
+            serial = usb_serial(args.sg)
+            if serial is None:
+                raise CalibrationFailed(f"Could not determine the serial number of {args.sg}.")
+            calibrated = calibrate_discharge_time(ctl)
+            DischargeCalibration(config.calibration_file).set(serial, calibrated)
             if args.json:
-                print(json.dumps({}))
+                print(json.dumps({"discharge-time": calibrated}))
+            else:
+                print(f"Calibrated discharge time: {calibrated:.3f} s")
 
-        elif mode == "host":
-            ctl.mode_host()
-            if args.json:
-                print(json.dumps({}))
+        elif mode == "stats":
+            from .stats import StatsFile
 
-            publish_info(ctl, config, args.sg, "host")
+            stats = ctl.stats
+            if config.stats_file is not None:
+                stats = StatsFile(config.stats_file).get(stats_key(args.sg))
+                stats.merge(ctl.stats)
+            elif not args.json:
+                print("No [stats] file configured, showing this invocation only.", file=sys.stderr)
 
-        elif mode == "get":
-            if args.json:
-                print(json.dumps({"switch-state": ctl.get_mode()}))
-            else:
-                print(ctl.get_mode())
-
-        elif mode == "gpio":
-            if args.action == "get":
-                if args.json:
-                    print(json.dumps({"gpio-state": {"gpio": args.gpio, "state:": ctl.gpio_get(args.gpio)}}))
-                else:
-                    print(ctl.gpio_get(args.gpio))
-            elif args.action in ["0", "low"]:
-                ctl.gpio_set_low(args.gpio)
-                if args.json:
-                    print(json.dumps({}))
-            elif args.action in ["1", "high"]:
-                ctl.gpio_set_high(args.gpio)
-                if args.json:
-                    print(json.dumps({}))
-
-        elif mode == "info":
-            info = ctl.get_card_info()
             if args.json:
-                print(json.dumps(info, indent=2))
+                print(json.dumps(stats.to_dict(), indent=2))
             else:
-                print("\n".join(decoded_to_text(info["scr"])))
-                print("\n".join(decoded_to_text(info["cid"])))
-                print("\n".join(decoded_to_text(info["csd"])))
-
-    except FileNotFoundError as fnfe:
-        error_msg = str(fnfe)
-    except PermissionError as perr:
-        error_msg = str(perr)
-    except OSError as ose:
-        if ose.errno == errno.ENOTTY:
-            # ENOTTY is raised when an error occurred when calling an ioctl
-            error_msg = ose + "\n" + f"Does '{args.sg}' really point to a USB-SD-Mux?"
-        else:
-            raise ose
-    except NotInHostModeException:
-        error_msg = "Card information is only available in host mode."
-    except NotImplementedError:
-        error_msg = "This USB-SD-Mux does not support GPIOs."
+                print("\n".join(stats.to_text()))
+
+    except Exception as e:
+        error_msg = error_message(e, args.sg)
+        if error_msg is None:
+            raise
+
+    if mode != "stats":
+        stats_error = store_stats(ctl, args.sg, config)
+        if stats_error is not None:
+            print(stats_error, file=sys.stderr)
 
     if error_msg:
-        if args.json:
-            print(json.dumps({"error-message": error_msg}))
-        else:
-            print(error_msg, file=sys.stderr)
-        sys.exit(1)
+        _fail(args, error_msg)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,379 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+import asyncio
+import time
+
+from .i2c_gpio import I2cGpio, Pca9536, Tca6408
+from .usb2642 import DEFAULT_RETRY_POLICY, IoctlFailed, TransactionFailed, Usb2642
+from .usbsdmux import (
+    SYSFS,
+    NotInHostModeException,
+    UsbSdMux,
+    UsbSdMuxClassic,
+    UsbSdMuxFast,
+    _driver_class,
+    decode_card_info,
+)
+
+"""
+This module provides an asyncio interface to the USB-SD-Mux.
+
+Instead of blocking in the SG_IO ioctl() the commands are submitted to the
+sg-device and the event loop is notified via loop.add_reader() once they have
+completed. This way a single event loop can drive many USB-SD-Muxes without
+needing a thread per device.
+"""
+
+
+class AsyncUsb2642:
+    """
+    asyncio variant of Usb2642.
+
+    Transactions on the same device are serialized, as they share the buffers
+    of the underlying Usb2642. Transactions on different devices run
+    concurrently.
+    """
+
+    def __init__(self, sg, retry_policy=DEFAULT_RETRY_POLICY, transport=None):
+        """
+        Create a new asyncio USB2642-Interface wrapper.
+
+        Arguments:
+        sg -- The sg-device to use. E.g. "/dev/sg1"
+        retry_policy -- See Usb2642.__init__()
+        transport -- See Usb2642.__init__()
+        """
+        self._usb = Usb2642(sg, retry_policy, transport)
+        self._lock = asyncio.Lock()
+
+    @property
+    def stats(self):
+        """
+        See Usb2642.stats
+        """
+        return self._usb.stats
+
+    @property
+    def generation(self):
+        """
+        See Usb2642.generation
+        """
+        return self._usb.generation
+
+    def close(self):
+        self._usb.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    async def _wait(self, request):
+        """
+        Waits until the sg-device signals the completion of request and
+        returns its result.
+        """
+        loop = asyncio.get_running_loop()
+        completed = loop.create_future()
+        fd = request.fileno()
+
+        def readable():
+            if not completed.done():
+                completed.set_result(None)
+
+        loop.add_reader(fd, readable)
+        try:
+            await completed
+        except asyncio.CancelledError:
+            loop.remove_reader(fd)
+            # The command may still be in flight. Drop it, so that the device
+            # can be used by the following commands.
+            self._usb._abandon(IoctlFailed("Waiting for the command was cancelled"))
+            raise
+        loop.remove_reader(fd)
+
+        self._usb._receive()
+        return request.result()
+
+    async def _retry(self, submit):
+        """
+        Submits commands using submit() until one succeeds, fails with a
+        permanent error or the retry policy gives up.
+        """
+        delays = self._usb.retry_policy.delays()
+        while True:
+            try:
+                return await self._wait(submit())
+            except TransactionFailed as e:
+                if not e.transient:
+                    raise
+                delay = next(delays, None)
+                if delay is None:
+                    raise
+                self.stats.record_retry(self._usb._operation())
+                self.stats.record_sleep("retry", delay)
+                await asyncio.sleep(delay)
+
+    async def write_to(self, i2cAddr, data):
+        """
+        See Usb2642.write_to().
+        """
+        async with self._lock:
+            await self._retry(lambda: self._usb.submit_write_to(i2cAddr, data))
+
+    async def write_read_to(self, i2cAddr, writeData, readLength):
+        """
+        See Usb2642.write_read_to().
+        """
+        async with self._lock:
+            return await self._retry(lambda: self._usb.submit_write_read_to(i2cAddr, writeData, readLength))
+
+    async def _read_register(self, reg, size):
+        async with self._lock:
+            return await self._retry(lambda: self._usb.submit_read_register(reg, size))
+
+    async def read_cid(self):
+        return await self._read_register(*Usb2642.REGISTER_CID)
+
+    async def read_csd(self):
+        return await self._read_register(*Usb2642.REGISTER_CSD)
+
+    async def read_scr(self):
+        return await self._read_register(*Usb2642.REGISTER_SCR)
+
+
+class AsyncI2cGpio:
+    """
+    asyncio variant of I2cGpio for the GPIO expander type given by gpio_class.
+    """
+
+    def __init__(self, sg, gpio_class, transport=None):
+        """
+        Arguments:
+        sg -- /dev/sg* to use.
+        gpio_class -- Pca9536 or Tca6408
+        transport -- See Usb2642.__init__()
+        """
+        self._usb = AsyncUsb2642(sg, transport=transport)
+        self._I2cAddr = gpio_class._I2cAddr
+
+    def get_usb(self):
+        return self._usb
+
+    async def _write_register(self, register, value):
+        await self._usb.write_to(self._I2cAddr, [register, value])
+
+    async def _read_register(self, addr):
+        return (await self._usb.write_read_to(self._I2cAddr, [addr], 1))[0]
+
+    async def set_pin_to_output(self, pins):
+        direction = await self._read_register(I2cGpio._register_configuration)
+        direction = (direction & ~pins) & 0xFF
+        await self._write_register(I2cGpio._register_configuration, direction)
+
+    async def get_gpio_config(self):
+        return await self._read_register(I2cGpio._register_configuration)
+
+    async def get_input_values(self):
+        return await self._read_register(I2cGpio._register_inputPort)
+
+    async def output_values(self, values: int, bitmask: int = 0xFF):
+        if bitmask == 0xFF:
+            await self._write_register(I2cGpio._register_outputPort, values)
+        else:
+            val = await self._read_register(I2cGpio._register_outputPort)
+            val = (val & ~bitmask) & 0xFF
+            val = val | (values & bitmask)
+            await self._write_register(I2cGpio._register_outputPort, val)
+
+
+class AsyncUsbSdMux:
+    """
+    asyncio variant of UsbSdMux.
+
+    Use autoselect_driver() from this module to create an instance.
+    The pin assignment is taken from the corresponding blocking class in _pins.
+    """
+
+    _pins = None
+    _gpio_class = None
+    _powered_off_at = None
+
+    def __init__(self, sg, discharge_time=None, transport=None):
+        """
+        Arguments:
+        sg -- /dev/sg* to use
+        discharge_time -- See UsbSdMux.__init__()
+        transport -- See Usb2642.__init__()
+        """
+        self._gpio = AsyncI2cGpio(sg, self._gpio_class, transport)
+        self._usb = self._gpio.get_usb()
+        self._discharge_time = self._pins._discharge_time if discharge_time is None else discharge_time
+
+    async def _setup(self):
+        """
+        Bring the device into a defined state after it has been opened.
+        """
+        pass
+
+    def close(self):
+        self._usb.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def stats(self):
+        return self._usb.stats
+
+    async def get_mode(self):
+        """
+        Returns currently selected mode as string
+        """
+        return self._pins._decode_mode(await self._gpio.get_input_values())
+
+    async def _outputs_configured(self):
+        return await self._gpio.get_gpio_config() & self._pins._mux_pins == 0
+
+    _discharge_remaining = UsbSdMux._discharge_remaining
+
+    async def _wait_discharged(self):
+        remaining = self._discharge_remaining()
+        if remaining > 0:
+            self._usb.stats.record_sleep("discharge", remaining)
+            await asyncio.sleep(remaining)
+
+    async def _switch(self, target, wait=True):
+        """
+        See UsbSdMux._switch(). Waiting does not block the event loop.
+        """
+        p = self._pins
+        start = time.monotonic()
+        current = await self._gpio.get_input_values()
+
+        for step, value in p._transition(self, current, await self._outputs_configured(), target):
+            if step == "output":
+                await self._gpio.output_values(value, p._output_mask)
+            elif step == "direction":
+                await self._gpio.set_pin_to_output(p._mux_pins)
+            elif step == "wait" and wait:
+                await self._wait_discharged()
+
+        self._usb.stats.record_switch(target, time.monotonic() - start)
+
+    async def mode_disconnect(self, wait=True):
+        """
+        See UsbSdMux.mode_disconnect().
+        """
+        await self._switch("off", wait)
+
+    async def mode_DUT(self, wait=True):
+        """
+        See UsbSdMux.mode_DUT().
+        """
+        await self._switch("dut", wait)
+
+    async def mode_host(self, wait=True):
+        """
+        See UsbSdMux.mode_host().
+        """
+        await self._switch("host", wait)
+
+    async def gpio_get(self, gpio):
+        raise NotImplementedError()
+
+    async def gpio_set_high(self, gpio):
+        raise NotImplementedError()
+
+    async def gpio_set_low(self, gpio):
+        raise NotImplementedError()
+
+    async def get_card_info(self):
+        if await self.get_mode() != "host":
+            raise NotInHostModeException()
+
+        scr = await self._usb.read_scr()
+        cid = await self._usb.read_cid()
+        csd = await self._usb.read_csd()
+
+        return decode_card_info(scr, cid, csd)
+
+
+class AsyncUsbSdMuxClassic(AsyncUsbSdMux):
+    _pins = UsbSdMuxClassic
+    _gpio_class = Pca9536
+
+
+class AsyncUsbSdMuxFast(AsyncUsbSdMux):
+    _pins = UsbSdMuxFast
+    _gpio_class = Tca6408
+
+    # Generation of the device _setup() has last run for
+    _setup_generation = None
+
+    async def _setup(self):
+        # See UsbSdMuxFast._assure_default_state()
+        p = self._pins
+        if await self._gpio.get_gpio_config() == 0xFF:
+            await self._gpio.output_values(p._DAT_enable | p._PWR_enable | p._select_DUT | p._card_removed)
+            await self._gpio.set_pin_to_output(
+                Tca6408.gpio_0 | Tca6408.gpio_1 | Tca6408.gpio_2 | Tca6408.gpio_3 | Tca6408.gpio_4 | Tca6408.gpio_5
+            )
+        self._setup_generation = self._usb.generation
+
+    async def _setup_after_reopen(self):
+        # See UsbSdMuxFast._assure_default_state_after_reopen()
+        if self._usb.generation != self._setup_generation:
+            await self._setup()
+
+    async def _outputs_configured(self):
+        # _setup() has configured the pins when the device was opened.
+        await self._setup_after_reopen()
+        return True
+
+    async def gpio_get(self, gpio):
+        gpio = UsbSdMuxFast._map_gpio(gpio)
+        val = await self._gpio.get_input_values()
+        if val & gpio:
+            return "low"
+        return "high"
+
+    async def gpio_set_high(self, gpio):
+        gpio = UsbSdMuxFast._map_gpio(gpio)
+        await self._setup_after_reopen()
+        await self._gpio.output_values(0x0, gpio)
+
+    async def gpio_set_low(self, gpio):
+        gpio = UsbSdMuxFast._map_gpio(gpio)
+        await self._setup_after_reopen()
+        await self._gpio.output_values(gpio, gpio)
+
+
+_ASYNC_DRIVERS = {
+    UsbSdMuxClassic: AsyncUsbSdMuxClassic,
+    UsbSdMuxFast: AsyncUsbSdMuxFast,
+}
+
+
+async def autoselect_driver(sg, discharge_time=None, transport=None, sysfs=SYSFS):
+    """
+    Create a new AsyncUsbSdMux with the correct driver for the device at /dev/<sg>
+
+    Arguments:
+    sg -- /dev/sg* to use
+    discharge_time -- See UsbSdMux.__init__()
+    transport -- See Usb2642.__init__()
+    sysfs -- Mount point of sysfs to look up the model in
+    """
+    mux = _ASYNC_DRIVERS[_driver_class(sg, sysfs)](sg, discharge_time, transport)
+    try:
+        await mux._setup()
+    except Exception:
+        mux.close()
+        raise
+    return mux
@@ -0,0 +1,165 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+import argparse
+import json
+import sys
+import time
+
+from .commands import COMMANDS, discharge_time
+from .config import Config
+from .daemon import Client, DaemonError, DeviceManager, handle_request
+from .usbsdmux import autoselect_driver
+
+"""
+This module implements "usbsdmux batch", which runs many commands from a
+file or stdin in a single process.
+
+Every line of the input is a JSON object describing one command:
+
+    {"sg": "/dev/sg0", "op": "host"}
+    {"sg": "/dev/sg0", "op": "gpio", "gpio": 0, "action": "high"}
+    {"op": "sleep", "seconds": 0.5}
+
+"op" is either one of commands.COMMANDS or "sleep". An optional "id" is
+copied to the result. For every command one line with its result or error
+is written as soon as it has completed:
+
+    {"id": 1, "result": {"switch-state": "host"}}
+    {"error": "Card information is only available in host mode."}
+
+The USB-SD-Muxes are opened once and reused by all following commands, or,
+if usbsdmuxd is reachable, the commands are sent to the daemon.
+"""
+
+
+def _local_executor(config, discharge_override=None):
+    def open_device(sg):
+        return autoselect_driver(sg, discharge_time=discharge_time(sg, config, discharge_override))
+
+    manager = DeviceManager(open_device)
+
+    def execute(request):
+        return handle_request(manager, config, request)
+
+    return execute, manager.close
+
+
+def _daemon_executor(client):
+    def execute(request):
+        response = {"id": request["id"]} if "id" in request else {}
+        params = {
+            key: request[key] for key in ("gpio", "action", "wait_for_block", "timeout", "flush") if key in request
+        }
+        try:
+            response["result"] = client.request(request.get("sg"), request.get("command"), **params)
+        except DaemonError as e:
+            response["error"] = str(e)
+        return response
+
+    return execute, client.close
+
+
+def _run_line(execute, line):
+    try:
+        command = json.loads(line)
+    except ValueError as e:
+        return {"error": f"Invalid JSON: {e}"}
+    if not isinstance(command, dict):
+        return {"error": "Invalid command. Expected a JSON object."}
+
+    response = {"id": command["id"]} if "id" in command else {}
+    op = command.get("op")
+
+    if op == "sleep":
+        try:
+            time.sleep(float(command["seconds"]))
+        except (KeyError, TypeError, ValueError):
+            response["error"] = "Invalid sleep. Expected 'seconds'."
+        else:
+            response["result"] = {}
+        return response
+
+    if op not in COMMANDS:
+        response["error"] = f"Invalid command. Expected an 'op' out of {', '.join(COMMANDS + ('sleep',))}."
+        return response
+
+    request = {key: value for key, value in command.items() if key != "op"}
+    request["command"] = op
+    try:
+        return execute(request)
+    except Exception as e:
+        # Report the failure like usbsdmuxd does and continue with the next command
+        response["error"] = f"Internal error: {e!r}"
+        return response
+
+
+def run_batch(infile, outfile, execute):
+    """
+    Runs the commands read from infile and writes their results to outfile.
+    Returns the number of commands that failed.
+
+    Arguments:
+    infile -- Iterable of lines, each containing a command
+    outfile -- Text file to write the results to
+    execute -- Callable running a request as understood by
+               daemon.handle_request() and returning the response
+    """
+    failed = 0
+    for line in infile:
+        if not line.strip():
+            continue
+        response = _run_line(execute, line)
+        if "error" in response:
+            failed += 1
+        outfile.write(json.dumps(response) + "\n")
+        outfile.flush()
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="usbsdmux batch", description="Run newline-delimited JSON commands on USB-SD-Muxes."
+    )
+    parser.add_argument(
+        "file", metavar="FILE", nargs="?", default="-", help="File to read the commands from (default: stdin)"
+    )
+    parser.add_argument("--config", help="Set config file location", default=None)
+    parser.add_argument(
+        "--discharge-time",
+        metavar="SECONDS",
+        help="Time to wait for the SD card supply to discharge when switching",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--socket", metavar="PATH", help="Run the commands using the usbsdmuxd listening on PATH, if reachable"
+    )
+
+    args = parser.parse_args(argv)
+
+    config = Config(args.config)
+
+    executor = None
+    socket_path = args.socket or config.daemon_socket
+    # The daemon uses its own discharge time.
+    if socket_path and args.discharge_time is None:
+        try:
+            executor = _daemon_executor(Client(socket_path))
+        except OSError:
+            executor = None
+    if executor is None:
+        executor = _local_executor(config, args.discharge_time)
+
+    execute, close = executor
+    try:
+        if args.file == "-":
+            failed = run_batch(sys.stdin, sys.stdout, execute)
+        else:
+            with open(args.file) as infile:
+                failed = run_batch(infile, sys.stdout, execute)
+    finally:
+        close()
+
+    if failed:
+        sys.exit(1)
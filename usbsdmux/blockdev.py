@@ -0,0 +1,131 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+import errno
+import fcntl
+import os
+
+from .discovery import _block_name
+from .fileutil import read_int
+from .usbsdmux import SYSFS
+
+"""
+This module flushes and invalidates the cached data of the block device of
+the SD-Card of a single USB-SD-Mux.
+
+Before the card is handed to the DUT, all data written by the host has to
+reach the card. After the DUT has modified the card, the host must not serve
+reads from its page cache. A global sync would flush every disk of the host,
+so only the block devices of the card (the disk and its partitions) are
+flushed and invalidated.
+"""
+
+# Flush and invalidate the buffer cache of a block device. <linux/fs.h>
+BLKFLSBUF = 0x1261
+
+MOUNTS = "/proc/self/mounts"
+
+
+class BlockDeviceBusy(Exception):
+    pass
+
+
+def medium_block(sg, sysfs=SYSFS):
+    """
+    Returns the name of the block device of the USB-SD-Mux at sg if a medium
+    is present, i.e. it has a non-zero size, None otherwise.
+    """
+    block = _block_name(os.path.basename(os.path.realpath(sg)), sysfs)
+    if block is None or not read_int(os.path.join(sysfs, "class/block", block, "size")):
+        return None
+    return block
+
+
+def block_devices(sg, sysfs=SYSFS):
+    """
+    Returns the names of the block device of the SD-Card of the USB-SD-Mux at
+    sg and of its partitions, or an empty list if there is no card.
+    """
+    block = medium_block(sg, sysfs)
+    if block is None:
+        return []
+
+    disk = os.path.join(sysfs, "class/block", block)
+    partitions = sorted(name for name in os.listdir(disk) if os.path.isfile(os.path.join(disk, name, "partition")))
+    return [block] + partitions
+
+
+def _unescape(field):
+    # Spaces, tabs, newlines and backslashes are escaped as octal numbers
+    for escaped, character in (("\\040", " "), ("\\011", "\t"), ("\\012", "\n"), ("\\134", "\\")):
+        field = field.replace(escaped, character)
+    return field
+
+
+def mountpoints(devices, mounts=MOUNTS):
+    """
+    Returns the mount points of the given block devices.
+
+    Arguments:
+    devices -- Names of block devices, e.g. ["sda", "sda1"]
+    mounts -- File listing the mounted filesystems
+    """
+    devices = set(devices)
+    result = []
+    with open(mounts) as fh:
+        for line in fh:
+            fields = line.split()
+            if len(fields) < 2 or not fields[0].startswith("/"):
+                continue
+            if os.path.basename(os.path.realpath(_unescape(fields[0]))) in devices:
+                result.append(_unescape(fields[1]))
+    return result
+
+
+def flush(path):
+    """
+    Writes all dirty data of the block device at path to the device and
+    drops its cached data.
+
+    BLKFLSBUF needs CAP_SYS_ADMIN. Without it the clean pages are dropped
+    using posix_fadvise() instead, which only needs access to the device.
+    """
+    fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        os.fsync(fd)
+        try:
+            fcntl.ioctl(fd, BLKFLSBUF)
+        except OSError as e:
+            if e.errno not in (errno.EPERM, errno.EACCES, errno.ENOTTY):
+                raise
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def flush_card(sg, check_mounted=True, sysfs=SYSFS, mounts=MOUNTS, dev="/dev"):
+    """
+    Flushes and invalidates the disk and partitions of the SD-Card of the
+    USB-SD-Mux at sg. Nothing is done if there is no card.
+
+    Arguments:
+    sg -- /dev/sg* of the USB-SD-Mux
+    check_mounted -- Raise BlockDeviceBusy if one of them is mounted, as its
+                     filesystem may still be modified by the host
+    sysfs -- Mount point of sysfs
+    mounts -- File listing the mounted filesystems
+    dev -- Directory containing the device nodes
+    """
+    devices = block_devices(sg, sysfs)
+    if check_mounted and devices:
+        busy = mountpoints(devices, mounts)
+        if busy:
+            raise BlockDeviceBusy(f"The SD card of {sg} is mounted at {', '.join(busy)}. Unmount it first.")
+
+    for name in devices:
+        try:
+            flush(os.path.join(dev, name))
+        except OSError as e:
+            # The card may just have been removed
+            if e.errno not in (errno.ENOMEDIUM, errno.ENOENT, errno.ENXIO):
+                raise
@@ -0,0 +1,122 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+import json
+import os
+import time
+
+from .config import DEFAULT_CALIBRATION_FILE
+from .fileutil import write_atomic
+from .usb2642 import SDTransactionFailed
+from .usbsdmux import NotInHostModeException
+
+"""
+This module determines and stores the time the supply of an SD-Card needs to
+discharge after it has been disconnected by a USB-SD-Mux.
+
+The model defaults are chosen to be safe for every card. Depending on the card
+and the USB-SD-Mux much shorter times may be sufficient, which speeds up every
+switch between host and DUT.
+"""
+
+# Discharge times in seconds that are tried during calibration
+DEFAULT_CANDIDATES = (1.0, 0.7, 0.5, 0.35, 0.25, 0.15, 0.1, 0.05)
+
+
+class CalibrationFailed(Exception):
+    pass
+
+
+class DischargeCalibration:
+    """
+    Stores calibrated discharge times of USB-SD-Muxes in a JSON file, using
+    their USB serial number as key.
+    """
+
+    def __init__(self, filename=DEFAULT_CALIBRATION_FILE):
+        self.filename = filename
+
+    def _load(self):
+        try:
+            with open(self.filename) as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return {}
+
+    def get(self, serial):
+        """
+        Returns the calibrated discharge time in seconds for the USB-SD-Mux
+        with the given serial or None if it has not been calibrated.
+        """
+        entry = self._load().get(serial)
+        if entry is None:
+            return None
+        return entry["discharge_time"]
+
+    def set(self, serial, discharge_time):
+        """
+        Stores the discharge time for the USB-SD-Mux with the given serial.
+        """
+        data = self._load()
+        data[serial] = {
+            "discharge_time": discharge_time,
+            "calibrated": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        }
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+        write_atomic(self.filename, json.dumps(data, indent=2))
+
+
+def _power_cycle_succeeds(ctl, discharge_time, reference):
+    ctl.mode_disconnect(wait=False)
+    time.sleep(discharge_time)
+    ctl.mode_host(wait=False)
+
+    try:
+        info = ctl.get_card_info()
+    except (SDTransactionFailed, NotInHostModeException):
+        return False
+
+    return info["cid"]["raw"] == reference
+
+
+def calibrate_discharge_time(ctl, candidates=DEFAULT_CANDIDATES, cycles=3, margin=2.0):
+    """
+    Determines the shortest discharge time for which the SD-Card reliably
+    re-initializes after it has been disconnected, multiplied by a safety
+    margin. The result is never larger than the model default.
+
+    The card is power cycled cycles times for every candidate, starting with
+    the longest one. After each cycle the card registers are read back and
+    compared to those read before the calibration.
+    The card is connected to the host afterward.
+
+    Arguments:
+    ctl -- UsbSdMux with an SD-Card inserted
+    candidates -- Discharge times in seconds to try
+    cycles -- Number of power cycles per candidate
+    margin -- Factor applied to the shortest successful discharge time
+    """
+    model_default = type(ctl)._discharge_time
+
+    ctl.mode_host()
+    try:
+        reference = ctl.get_card_info()["cid"]["raw"]
+    except SDTransactionFailed as e:
+        raise CalibrationFailed("Could not read the SD-Card. Is a card inserted?") from e
+
+    shortest = None
+    for discharge_time in sorted(candidates, reverse=True):
+        if not all(_power_cycle_succeeds(ctl, discharge_time, reference) for _ in range(cycles)):
+            break
+        shortest = discharge_time
+
+    # Leave the card in a defined state, with a full discharge.
+    ctl.mode_disconnect(wait=False)
+    time.sleep(model_default)
+    ctl.mode_host(wait=False)
+
+    if shortest is None:
+        raise CalibrationFailed("The SD-Card did not re-initialize reliably for any discharge time.")
+
+    return min(shortest * margin, model_default)
@@ -0,0 +1,283 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+import errno
+import os
+
+"""
+This module implements the commands of the usbsdmux tool on an open UsbSdMux,
+so that they behave the same no matter if they are run by the tool itself or
+on its behalf by usbsdmuxd.
+
+Every command returns the dictionary printed by the tool in --json mode.
+
+The tool is started for every single command, so modules only needed by some
+commands or configurations are imported where they are used.
+"""
+
+# Commands that change the mode of the USB-SD-Mux
+SWITCH_COMMANDS = ("dut", "client", "host", "off")
+
+# Commands that can be run by run_command()
+COMMANDS = ("get", "gpio", "info") + SWITCH_COMMANDS
+
+
+def discharge_time(sg, config, override=None):
+    """
+    Returns the discharge time to use: override if set, set in the config
+    file, calibrated for this device or None for the model default.
+    """
+    if override is not None:
+        return override
+    if config.discharge_time is not None:
+        return config.discharge_time
+
+    from .usbsdmux import usb_serial
+
+    # The calibration is only an optimization. Fall back to the default if it
+    # can not be used for whatever reason.
+    try:
+        serial = usb_serial(sg)
+        if serial is None:
+            return None
+        from .calibration import DischargeCalibration
+
+        return DischargeCalibration(config.calibration_file).get(serial)
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def stats_key(sg):
+    """
+    Returns the key the statistics of the device at sg are stored with.
+    """
+    from .usbsdmux import usb_serial
+
+    try:
+        serial = usb_serial(sg)
+    except OSError:
+        serial = None
+    return serial if serial is not None else os.path.realpath(sg)
+
+
+def store_stats(ctl, sg, config):
+    """
+    Adds the statistics collected by ctl to the [stats] file, if configured,
+    and resets them, so they are not stored twice.
+
+    Returns an error message if they could not be stored, None otherwise.
+    """
+    if config.stats_file is None:
+        return None
+
+    from .stats import StatsFile
+
+    # The statistics are only a diagnostic aid. Do not fail the command if
+    # they can not be stored.
+    try:
+        StatsFile(config.stats_file).add(stats_key(sg), ctl.stats)
+    except OSError as e:
+        return f"Could not store statistics: {e}"
+    ctl.stats.reset()
+    return None
+
+
+def _publish_info(ctl, config, sg, mode):
+    if config.mqtt_enabled:
+        from .mqtthelper import publish_info
+
+        publish_info(ctl, config, sg, mode)
+
+
+def _record_session(ctl, config, sg, mode):
+    if config.sessions_db is not None:
+        from .sessions import record_session
+
+        record_session(ctl, config, sg, mode)
+
+
+def _flush_card(sg, check_mounted=True):
+    from .blockdev import flush_card
+
+    flush_card(sg, check_mounted=check_mounted)
+
+
+def run_command(ctl, sg, config, command, gpio=None, action=None, wait_for_block=False, timeout=10, flush=None):
+    """
+    Runs a command on the USB-SD-Mux and returns its result.
+
+    Arguments:
+    ctl -- UsbSdMux to use
+    sg -- /dev/sg* of ctl, used for the MQTT statistics
+    config -- mqtthelper.Config
+    command -- One of COMMANDS
+    gpio -- Number of the GPIO for the "gpio" command
+    action -- "low", "0", "high", "1" or "get" for the "gpio" command
+    wait_for_block -- Wait for the block device after the "host" command
+                      and return its path
+    timeout -- Maximum time in seconds to wait for the block device
+    flush -- Flush the block device of the card before "dut" and invalidate
+             it after "host". Defaults to [switch] flush of the config.
+    """
+    if flush is None:
+        flush = config.flush
+
+    if command == "off":
+        _record_session(ctl, config, sg, "off")
+        ctl.mode_disconnect()
+        return {}
+
+    if command in ("dut", "client"):
+        _publish_info(ctl, config, sg, "client")
+        # Flush before ending the session, so it includes the flushed writes
+        if flush:
+            _flush_card(sg)
+        _record_session(ctl, config, sg, "dut")
+        ctl.mode_DUT()
+        return {}
+
+    if command == "host":
+        block = ctl.mode_host(wait_for_block=wait_for_block, timeout=timeout, invalidate=flush)
+        _publish_info(ctl, config, sg, "host")
+        _record_session(ctl, config, sg, "host")
+        return {"block": block} if wait_for_block else {}
+
+    if command == "get":
+        return {"switch-state": ctl.get_mode()}
+
+    if command == "gpio":
+        if action == "get":
+            return {"gpio-state": {"gpio": gpio, "state:": ctl.gpio_get(gpio)}}
+        if action in ("0", "low"):
+            ctl.gpio_set_low(gpio)
+            return {}
+        if action in ("1", "high"):
+            ctl.gpio_set_high(gpio)
+            return {}
+        raise ValueError(f"Unknown GPIO action '{action}'")
+
+    if command == "info":
+        return ctl.get_card_info()
+
+    raise ValueError(f"Unknown command '{command}'")
+
+
+def switch_group(sgs, config, command, discharge_override=None, max_workers=8):
+    """
+    Switches several USB-SD-Muxes at once, see group.switch_all().
+
+    Returns a dictionary with the error message for every sg, None if it has
+    been switched.
+    If [switch] flush is set in the config, the cards are flushed before
+    switching to the DUT and invalidated after switching to the host, like
+    run_command() does.
+
+    Arguments:
+    sgs -- /dev/sg* of the USB-SD-Muxes to switch
+    config -- mqtthelper.Config
+    command -- One of SWITCH_COMMANDS
+    discharge_override -- Discharge time to use instead of the configured one
+    max_workers -- Maximum number of USB-SD-Muxes to talk to concurrently
+    """
+    from .group import switch_all
+    from .usbsdmux import UnknownUsbSdMuxRevisionException, autoselect_driver
+
+    sgs = list(dict.fromkeys(sgs))
+    target = {"client": "dut"}.get(command, command)
+    errors = {}
+    ctls = {}
+
+    for sg in sgs:
+        try:
+            ctls[sg] = autoselect_driver(sg, discharge_time=discharge_time(sg, config, discharge_override))
+        except UnknownUsbSdMuxRevisionException as e:
+            errors[sg] = str(e) + "\n" + f"Does {sg} really point to a USB-SD-Mux?"
+        except OSError as e:
+            errors[sg] = error_message(e, sg) or str(e)
+
+    def failed(sg, exception):
+        message = error_message(exception, sg)
+        if message is None:
+            raise exception
+        errors[sg] = message
+
+    switching = dict(ctls)
+    try:
+        if target == "dut":
+            for sg, ctl in ctls.items():
+                _publish_info(ctl, config, sg, "client")
+            if config.flush:
+                # A card that can not be flushed is not switched
+                for sg in ctls:
+                    try:
+                        _flush_card(sg)
+                    except Exception as e:
+                        failed(sg, e)
+                        del switching[sg]
+        if target != "host":
+            for sg, ctl in switching.items():
+                _record_session(ctl, config, sg, target)
+
+        results = switch_all(switching.values(), target, max_workers)
+        for (sg, ctl), exception in zip(switching.items(), results, strict=True):
+            if exception is not None:
+                failed(sg, exception)
+                continue
+            errors[sg] = None
+            if target == "host":
+                if config.flush:
+                    try:
+                        _flush_card(sg, check_mounted=False)
+                    except Exception as e:
+                        failed(sg, e)
+                _publish_info(ctl, config, sg, "host")
+                _record_session(ctl, config, sg, "host")
+    finally:
+        for sg, ctl in ctls.items():
+            store_stats(ctl, sg, config)
+            ctl.close()
+
+    return {sg: errors[sg] for sg in sgs}
+
+
+def result_to_text(command, result, action=None):
+    """
+    Returns the lines printed by the tool for the result of a command if
+    --json is not given.
+    """
+    if command == "get":
+        return [result["switch-state"]]
+    if command == "gpio" and action == "get":
+        return [result["gpio-state"]["state:"]]
+    if command == "info":
+        from .sd_regs import decoded_to_text
+
+        return decoded_to_text(result["scr"]) + decoded_to_text(result["cid"]) + decoded_to_text(result["csd"])
+    if command == "host" and "block" in result:
+        return [result["block"]]
+    return []
+
+
+def error_message(exception, sg):
+    """
+    Returns the message to show to the user for an exception raised by a
+    command or None if the exception is unexpected.
+    """
+    from .blockdev import BlockDeviceBusy
+    from .calibration import CalibrationFailed
+    from .hotplug import BlockDeviceTimeout
+    from .usb2642 import TransactionFailed
+    from .usbsdmux import NotInHostModeException
+
+    if isinstance(exception, (FileNotFoundError, PermissionError)):
+        return str(exception)
+    if isinstance(exception, OSError) and exception.errno == errno.ENOTTY:
+        # ENOTTY is raised when an error occurred when calling an ioctl
+        return str(exception) + "\n" + f"Does '{sg}' really point to a USB-SD-Mux?"
+    if isinstance(exception, NotInHostModeException):
+        return "Card information is only available in host mode."
+    if isinstance(exception, NotImplementedError):
+        return "This USB-SD-Mux does not support GPIOs."
+    if isinstance(exception, (BlockDeviceBusy, BlockDeviceTimeout, CalibrationFailed, TransactionFailed)):
+        return str(exception)
+    return None
@@ -0,0 +1,78 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2024 The USB-SD-Mux Authors
+
+import configparser
+import os
+
+"""
+This module reads the configuration file shared by all usbsdmux tools.
+
+It is kept free of heavy imports, as every invocation of the usbsdmux tool
+reads the configuration. mqtthelper.Config refers to the same class.
+"""
+
+DEFAULT_CALIBRATION_FILE = "/var/lib/usbsdmux/calibration.json"
+
+
+class Config:
+    """
+    Reads the configuration file by default at /etc/usbsdmux.config
+    """
+
+    def __init__(self, configfile: str | None = None):
+        if configfile is not None:
+            if not os.path.isfile(configfile):
+                raise FileNotFoundError("Config file {configfile} not found")
+        else:
+            configfile = "/etc/usbsdmux.config"
+
+        config = configparser.ConfigParser()
+        config.read(configfile)
+
+        self.discharge_time = config.getfloat("switch", "discharge_time", fallback=None)
+        self.calibration_file = config.get("switch", "calibration_file", fallback=DEFAULT_CALIBRATION_FILE)
+        self.flush = config.getboolean("switch", "flush", fallback=False)
+        self.stats_file = config.get("stats", "file", fallback=None)
+        self.sessions_db = config.get("sessions", "database", fallback=None)
+        self.daemon_socket = config.get("daemon", "socket", fallback=None)
+        # labgrid place -> discovery selector, e.g. "serial:000000000042"
+        self.places = dict(config["places"]) if "places" in config else {}
+
+        if "mqtt" not in config or "send" not in config:
+            self.mqtt_enabled = False
+            return
+        else:
+            self.mqtt_enabled = True
+
+        # publisher.py imports this module, and neither it nor the spool is
+        # needed unless MQTT is enabled.
+        from .publisher import DEFAULT_QUEUE_SIZE
+        from .spool import DEFAULT_MAX_BYTES
+
+        mqtt_section = config["mqtt"]
+
+        for argument in ("server", "port", "topic"):
+            if argument not in mqtt_section:
+                raise ValueError(f"Config value mqtt/{argument} not found. Please check {configfile}")
+
+        self.mqtt_server = mqtt_section["server"]
+        self.mqtt_port = int(mqtt_section["port"])
+        self.mqtt_topic = mqtt_section["topic"]
+
+        if "username" in mqtt_section and "password" in mqtt_section:
+            self.mqtt_auth = {"username": mqtt_section["username"], "password": mqtt_section["password"]}
+        else:
+            self.mqtt_auth = None
+
+        # Maximum number of messages waiting for the broker in a MqttPublisher
+        self.mqtt_queue_size = mqtt_section.getint("queue_size", DEFAULT_QUEUE_SIZE)
+        # Unix socket of the usbsdmux-mqtt-forwarder to hand messages to
+        self.mqtt_forwarder = mqtt_section.get("forwarder")
+        # File to keep the messages in that could not be sent
+        self.mqtt_spool = mqtt_section.get("spool")
+        self.mqtt_spool_size = mqtt_section.getint("spool_size", DEFAULT_MAX_BYTES)
+
+        send_section = config["send"]
+
+        self.send_on_host = send_section.get("host", False)
+        self.send_on_dut = send_section.get("dut", False)
@@ -0,0 +1,310 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+import argparse
+import contextlib
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+
+from .commands import COMMANDS, discharge_time, error_message, run_command, store_stats
+from .config import Config
+from .discovery import DeviceNotFound, resolve
+from .mqtthelper import start_publisher, stop_publisher
+from .usb2642 import TransactionFailed
+from .usbsdmux import UnknownUsbSdMuxRevisionException, autoselect_driver
+
+"""
+This module implements usbsdmuxd, a daemon that keeps the USB-SD-Muxes of a
+host open and runs commands on them on behalf of clients.
+
+Starting the usbsdmux tool, parsing its configuration, selecting the driver
+and bringing the USB-SD-Mux into a defined state takes far longer than the
+actual switch. The daemon only pays this once per device and serves every
+following command with a few USB transactions.
+
+Clients connect to a Unix socket and send one JSON object per line:
+
+    {"id": 1, "sg": "/dev/sg0", "command": "gpio", "gpio": 0, "action": "get"}
+
+"id" is optional and copied to the response. The command and its arguments
+are the same as those of the usbsdmux tool, see commands.run_command().
+"host" also accepts "wait_for_block" and "timeout", "dut", "client" and
+"host" accept "flush".
+Every request is answered by one line with either the result or an error:
+
+    {"id": 1, "result": {"gpio-state": {"gpio": 0, "state:": "high"}}}
+    {"id": 1, "error": "This USB-SD-Mux does not support GPIOs."}
+
+Commands on the same USB-SD-Mux are serialized, commands on different
+USB-SD-Muxes run concurrently.
+"""
+
+DEFAULT_SOCKET = "/run/usbsdmux/usbsdmuxd.sock"
+
+
+class DaemonError(Exception):
+    pass
+
+
+class Device:
+    """
+    A USB-SD-Mux held open by the daemon.
+    """
+
+    def __init__(self, sg, open_device):
+        self.sg = sg
+        self.lock = threading.Lock()
+        self._open_device = open_device
+        self._ctl = None
+
+    def call(self, function):
+        """
+        Calls function(ctl) with exclusive access to the USB-SD-Mux and
+        returns its result. The USB-SD-Mux is opened on first use.
+
+        If the USB-SD-Mux fails, it is closed and reopened on the next call,
+        as it may have been re-enumerated in the meantime.
+        """
+        with self.lock:
+            if self._ctl is None:
+                self._ctl = self._open_device(self.sg)
+            try:
+                return function(self._ctl)
+            except (OSError, TransactionFailed):
+                self.close()
+                raise
+
+    def close(self):
+        if self._ctl is not None:
+            self._ctl.close()
+            self._ctl = None
+
+
+class DeviceManager:
+    """
+    Keeps one Device per USB-SD-Mux.
+    """
+
+    def __init__(self, open_device):
+        """
+        Arguments:
+        open_device -- Callable returning a UsbSdMux for a /dev/sg* path
+        """
+        self._open_device = open_device
+        self._devices = {}
+        self._lock = threading.Lock()
+
+    def get(self, sg):
+        # Different names for the same device (e.g. udev symlinks) share
+        # the handle and the lock.
+        sg = os.path.realpath(sg)
+        with self._lock:
+            if sg not in self._devices:
+                self._devices[sg] = Device(sg, self._open_device)
+            return self._devices[sg]
+
+    def close(self):
+        with self._lock:
+            for device in self._devices.values():
+                with device.lock:
+                    device.close()
+            self._devices = {}
+
+
+def handle_request(manager, config, request):
+    """
+    Runs a single request and returns the response as dictionary.
+    """
+    response = {}
+    if isinstance(request, dict) and "id" in request:
+        response["id"] = request["id"]
+
+    try:
+        if not isinstance(request, dict) or "sg" not in request or request.get("command") not in COMMANDS:
+            raise DaemonError(f"Invalid request. Expected 'sg' and a 'command' out of {', '.join(COMMANDS)}.")
+
+        sg = resolve(request["sg"], config.places)
+        device = manager.get(sg)
+
+        def run(ctl):
+            try:
+                return run_command(
+                    ctl,
+                    sg,
+                    config,
+                    request["command"],
+                    gpio=request.get("gpio"),
+                    action=request.get("action"),
+                    wait_for_block=request.get("wait_for_block", False),
+                    timeout=request.get("timeout", 10),
+                    flush=request.get("flush"),
+                )
+            finally:
+                stats_error = store_stats(ctl, sg, config)
+                if stats_error is not None:
+                    print(stats_error, file=sys.stderr)
+
+        response["result"] = device.call(run)
+    except (DaemonError, DeviceNotFound, UnknownUsbSdMuxRevisionException, ValueError) as e:
+        response["error"] = str(e)
+    except Exception as e:
+        message = error_message(e, request["sg"])
+        if message is None:
+            raise
+        response["error"] = message
+
+    return response
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                response = {"error": f"Invalid JSON: {e}"}
+            else:
+                try:
+                    response = handle_request(self.server.manager, self.server.config, request)
+                except Exception as e:
+                    # Keep serving other clients, even if a command failed
+                    # unexpectedly.
+                    response = {"error": f"Internal error: {e!r}"}
+                    if isinstance(request, dict) and "id" in request:
+                        response["id"] = request["id"]
+
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+
+
+class Server(socketserver.ThreadingUnixStreamServer):
+    """
+    The usbsdmuxd Unix socket server. Every client connection is handled in
+    its own thread.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, config, cache_registers=False, open_device=None):
+        """
+        Arguments:
+        path -- Path of the Unix socket to create
+        config -- mqtthelper.Config
+        cache_registers -- See UsbSdMux.__init__(). Only enable this if the
+                           USB-SD-Muxes are not used without the daemon.
+        open_device -- Callable returning a UsbSdMux for a /dev/sg* path,
+                       autoselect_driver() by default
+        """
+        self.config = config
+
+        if open_device is None:
+
+            def open_device(sg):
+                return autoselect_driver(
+                    sg, cache_registers=cache_registers, discharge_time=discharge_time(sg, config)
+                )
+
+        self.manager = DeviceManager(open_device)
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+        super().__init__(path, _RequestHandler)
+        # Allow access for the group, e.g. the group owning /dev/sg*
+        os.chmod(path, 0o660)
+
+    def server_close(self):
+        super().server_close()
+        self.manager.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.server_address)
+
+
+class Client:
+    """
+    Sends commands to usbsdmuxd. The connection is kept open until close()
+    is called, so many commands can be sent with little overhead.
+    """
+
+    def __init__(self, path=DEFAULT_SOCKET, timeout=None):
+        """
+        Raises OSError if the daemon is not reachable.
+
+        Arguments:
+        path -- Path of the Unix socket of the daemon
+        timeout -- Maximum time in seconds to wait for a response or None
+        """
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._socket.settimeout(timeout)
+            self._socket.connect(path)
+        except OSError:
+            self._socket.close()
+            raise
+        self._file = self._socket.makefile("rwb")
+        self._next_id = 0
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def request(self, sg, command, **params):
+        """
+        Runs a command on the USB-SD-Mux at sg and returns its result.
+        Raises DaemonError with the message of the daemon if it failed.
+        """
+        self._next_id += 1
+        request = {"id": self._next_id, "sg": sg, "command": command, **params}
+        self._file.write(json.dumps(request).encode() + b"\n")
+        self._file.flush()
+
+        line = self._file.readline()
+        if not line:
+            raise DaemonError("usbsdmuxd closed the connection")
+        response = json.loads(line)
+        if "error" in response:
+            raise DaemonError(response["error"])
+        return response["result"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Daemon that keeps USB-SD-Muxes open and runs commands on them.")
+    parser.add_argument("--config", help="Set config file location", default=None)
+    parser.add_argument("--socket", help="Path of the Unix socket to create", default=None)
+    parser.add_argument(
+        "--cache-registers",
+        help="Cache the GPIO-expander registers. Only use this if all accesses go through the daemon.",
+        action="store_true",
+    )
+
+    args = parser.parse_args()
+
+    config = Config(args.config)
+    path = args.socket or config.daemon_socket or DEFAULT_SOCKET
+
+    server = Server(path, config, cache_registers=args.cache_registers)
+    # Keep a connection to the MQTT broker instead of connecting per switch
+    start_publisher(config)
+    print(f"Listening on {path}", file=sys.stderr)
+    try:
+        with contextlib.suppress(KeyboardInterrupt):
+            server.serve_forever()
+    finally:
+        server.server_close()
+        stop_publisher()
+
+
+if __name__ == "__main__":
+    main()
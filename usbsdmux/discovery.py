@@ -0,0 +1,191 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+import os
+
+from .fileutil import read_text
+from .usbsdmux import SYSFS, UnknownUsbSdMuxRevisionException, _driver_class, usb_device_path
+
+"""
+This module finds the USB-SD-Muxes attached to this host by scanning sysfs
+once and allows to refer to them by their USB serial number, their USB path
+or a labgrid place instead of their /dev/sg* path, which changes whenever
+they are re-enumerated.
+
+This works without the udev rules shipped in contrib/udev, e.g. in minimal
+containers.
+
+Devices are selected using one of:
+
+* /dev/sg0 -- The sg-device itself (or any path pointing to it)
+* serial:000000000042 -- The USB serial number
+* usb:1-1.2 -- The USB path, i.e. the name of the USB device in sysfs
+* place:my-place -- A labgrid place, mapped to one of the above in the
+  [places] section of the config file
+"""
+
+
+class DeviceNotFound(Exception):
+    pass
+
+
+class MuxInfo:
+    """
+    A USB-SD-Mux found in sysfs.
+    """
+
+    def __init__(self, sg_name, driver, block=None, serial=None, usb_path=None, speed=None):
+        """
+        Arguments:
+        sg_name -- Name of the sg-device, e.g. "sg0"
+        driver -- The matching UsbSdMux subclass
+        block -- Name of the block device of the SD-Card, e.g. "sda", or None
+        serial -- USB serial number or None
+        usb_path -- sysfs path of the USB device or None
+        speed -- USB speed in Mbit/s or None
+        """
+        self.sg_name = sg_name
+        self.driver = driver
+        self.block = block
+        self.serial = serial
+        self.usb_path = usb_path
+        self.speed = speed
+
+    @property
+    def sg(self):
+        return os.path.join("/dev", self.sg_name)
+
+    @property
+    def usb_name(self):
+        """
+        Name of the USB device, e.g. "1-1.2", describing the port it is
+        attached to.
+        """
+        return os.path.basename(self.usb_path) if self.usb_path is not None else None
+
+    def to_dict(self):
+        return {
+            "sg": self.sg,
+            "block": self.block,
+            "model": self.driver.__name__,
+            "serial": self.serial,
+            "usb": self.usb_name,
+            "speed": self.speed,
+        }
+
+
+def _block_name(sg_name, sysfs=SYSFS):
+    try:
+        return os.listdir(os.path.join(sysfs, "class/scsi_generic", sg_name, "device/block"))[0]
+    except (FileNotFoundError, IndexError):
+        return None
+
+
+def probe(sg_name, sysfs=SYSFS):
+    """
+    Returns the MuxInfo of /dev/<sg_name> or None if it is no USB-SD-Mux.
+    """
+    sg = os.path.join("/dev", sg_name)
+    try:
+        driver = _driver_class(sg, sysfs)
+    except UnknownUsbSdMuxRevisionException:
+        return None
+
+    usb_path = usb_device_path(sg, sysfs)
+    serial = speed = None
+    if usb_path is not None:
+        serial = read_text(os.path.join(usb_path, "serial"))
+        speed = read_text(os.path.join(usb_path, "speed"))
+
+    return MuxInfo(
+        sg_name,
+        driver,
+        block=_block_name(sg_name, sysfs),
+        serial=serial,
+        usb_path=usb_path,
+        speed=int(speed) if speed else None,
+    )
+
+
+def scan(sysfs=SYSFS):
+    """
+    Returns a MuxInfo for every USB-SD-Mux found in sysfs, sorted by the
+    name of their sg-device.
+    """
+    try:
+        sg_names = sorted(os.listdir(os.path.join(sysfs, "class/scsi_generic")))
+    except FileNotFoundError:
+        return []
+
+    devices = (probe(sg_name, sysfs) for sg_name in sg_names)
+    return [device for device in devices if device is not None]
+
+
+class DeviceIndex:
+    """
+    Looks up USB-SD-Muxes by their serial number or USB path.
+    """
+
+    def __init__(self, devices, places=None):
+        """
+        Arguments:
+        devices -- iterable of MuxInfo, e.g. as returned by scan()
+        places -- dict mapping labgrid places to selectors
+        """
+        self.devices = list(devices)
+        self.places = places or {}
+        self._by_serial = {device.serial: device for device in self.devices if device.serial is not None}
+        self._by_usb = {device.usb_name: device for device in self.devices if device.usb_path is not None}
+
+    @classmethod
+    def scan(cls, sysfs=SYSFS, places=None):
+        return cls(scan(sysfs), places)
+
+    def by_serial(self, serial):
+        return self._by_serial.get(serial)
+
+    def by_usb_path(self, usb_name):
+        return self._by_usb.get(usb_name)
+
+    def find(self, selector):
+        """
+        Returns the MuxInfo of the device selected by a "serial:", "usb:" or
+        "place:" selector. Raises DeviceNotFound if there is none.
+        """
+        kind, _, value = selector.partition(":")
+        if kind == "place":
+            if value not in self.places:
+                raise DeviceNotFound(f"Place '{value}' is not configured in the [places] section.")
+            return self.find(self.places[value])
+        if kind == "serial":
+            device = self.by_serial(value)
+        elif kind == "usb":
+            device = self.by_usb_path(value)
+        else:
+            raise DeviceNotFound(f"Unknown selector '{selector}'. Expected a path, serial:, usb: or place:.")
+
+        if device is None:
+            raise DeviceNotFound(f"No USB-SD-Mux with {kind} '{value}' found.")
+        return device
+
+
+def is_selector(sg):
+    """
+    Returns True if sg is a selector instead of a path.
+    """
+    return sg.partition(":")[0] in ("serial", "usb", "place")
+
+
+def resolve(sg, places=None, sysfs=SYSFS):
+    """
+    Returns the /dev/sg* path of the device selected by sg. Paths are
+    returned unchanged, so only selectors cause a scan of sysfs.
+
+    Arguments:
+    sg -- A path or a selector, see the module documentation
+    places -- dict mapping labgrid places to selectors
+    sysfs -- Mount point of sysfs
+    """
+    if not is_selector(sg):
+        return sg
+    return DeviceIndex.scan(sysfs, places).find(sg).sg
@@ -0,0 +1,66 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+import contextlib
+import os
+import tempfile
+
+"""
+This module contains helpers to read single values, e.g. from sysfs, and to
+replace files atomically.
+"""
+
+
+def read_text(filename):
+    """
+    Returns the content of filename without surrounding whitespace or None if
+    it cannot be read.
+    """
+    try:
+        with open(filename) as fh:
+            return fh.read().strip()
+    except OSError:
+        return None
+
+
+def read_int(filename, base=10):
+    """
+    Returns the integer stored in filename or None if it cannot be read or does
+    not contain an integer.
+
+    Arguments:
+    filename -- File to read
+    base -- Base the integer is written in
+    """
+    try:
+        return int(read_text(filename), base)
+    except (TypeError, ValueError):
+        return None
+
+
+def write_atomic(filename, data, mode=0o644):
+    """
+    Replaces filename with data atomically, so concurrent readers see either
+    the old or the new content but never a partially written file.
+
+    Arguments:
+    filename -- File to replace
+    data -- str or bytes to write
+    mode -- Permissions of the new file
+    """
+    with tempfile.NamedTemporaryFile(
+        "wb" if isinstance(data, bytes) else "w",
+        dir=os.path.dirname(os.path.abspath(filename)),
+        prefix=os.path.basename(filename) + ".",
+        suffix=".tmp",
+        delete=False,
+    ) as fh:
+        try:
+            fh.write(data)
+            fh.close()
+            os.chmod(fh.name, mode)
+            os.replace(fh.name, filename)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(fh.name)
+            raise
@@ -0,0 +1,72 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+import concurrent.futures
+import time
+
+"""
+This module switches several USB-SD-Muxes at once.
+
+It is kept apart from usbsdmux.py, as the thread pool (concurrent.futures
+imports logging) is only needed when switching groups, while usbsdmux.py is
+loaded by every command of the usbsdmux tool.
+"""
+
+
+def switch_all(muxes, target, max_workers=8):
+    """
+    Switches several USB-SD-Muxes to the target mode at once.
+
+    All muxes that have to be switched are disconnected first, then the
+    discharge time is waited for only once for all of them, before they are
+    connected to the target.
+    The commands are issued by a pool of at most max_workers threads.
+
+    Returns a list with one entry per mux: None if it has been switched or
+    the exception raised while switching it.
+
+    Arguments:
+    muxes -- iterable of UsbSdMux
+    target -- One of "off", "dut" or "host"
+    max_workers -- Maximum number of muxes to talk to concurrently
+    """
+    muxes = list(muxes)
+    results = [None] * len(muxes)
+
+    def run(function, indices):
+        def call(i):
+            try:
+                function(muxes[i])
+            except Exception as e:
+                results[i] = e
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+            list(pool.map(call, indices))
+
+    def disconnect(mux):
+        if mux.get_mode() != target:
+            mux.mode_disconnect(wait=False)
+            if mux._powered_off_at is None:
+                # The card has been disconnected by someone else, possibly
+                # only just now.
+                mux._powered_off_at = time.monotonic()
+
+    run(disconnect, range(len(muxes)))
+
+    # Muxes that are already connected to the target are left alone and need
+    # no wait.
+    remaining = {
+        i: muxes[i]._discharge_remaining()
+        for i in range(len(muxes))
+        if results[i] is None and muxes[i]._powered_off_at is not None
+    }
+    longest = max(remaining.values(), default=0)
+    if longest > 0:
+        for i, seconds in remaining.items():
+            if seconds > 0:
+                muxes[i]._usb.stats.record_sleep("discharge", seconds)
+        time.sleep(longest)
+
+    run(lambda mux: mux._switch(target), [i for i in range(len(muxes)) if results[i] is None])
+
+    return results
@@ -0,0 +1,417 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+import os
+import select
+import socket
+import threading
+import time
+
+from .blockdev import medium_block
+from .discovery import DeviceNotFound, probe, scan
+from .usb2642 import SgTransport
+from .usbsdmux import SYSFS, autoselect_driver
+
+"""
+This module keeps track of the USB-SD-Muxes attached to this host while they
+come and go, without polling sysfs.
+
+The kernel announces every device that is added or removed via a uevent on
+a NETLINK_KOBJECT_UEVENT socket. MuxRegistry is filled by a single scan of
+sysfs and afterwards only updates the devices named in the scsi_generic and
+block uevents it is fed, e.g. by a UeventMonitor.
+
+When a USB-SD-Mux is re-enumerated (e.g. after a hub reset) it usually gets
+a new /dev/sg* device. ReattachingTransport looks the device up by its
+serial number in the registry whenever it has to be (re-)opened, so
+UsbSdMux objects using it keep working.
+
+    monitor = UeventMonitor()  # Before the scan, so no event is missed
+    registry = MuxRegistry()
+    registry.listen(monitor)
+    ctl = open_by_serial("000000000042", registry)
+"""
+
+NETLINK_KOBJECT_UEVENT = 15
+
+# Multicast group of the uevents sent by the kernel itself (as opposed to
+# the ones re-broadcast by udev)
+_KERNEL_GROUP = 1
+
+# Bursts of uevents, e.g. when a hub with many USB-SD-Muxes is reset, must
+# not overflow the socket buffer.
+_RECEIVE_BUFFER = 1024 * 1024
+
+
+class BlockDeviceTimeout(Exception):
+    pass
+
+
+class Uevent:
+    """
+    A uevent as sent by the kernel.
+    """
+
+    def __init__(self, action, devpath, subsystem, properties):
+        """
+        Arguments:
+        action -- e.g. "add", "remove" or "change"
+        devpath -- Path of the device in sysfs, without the mount point
+        subsystem -- e.g. "scsi_generic" or "block"
+        properties -- dict of all KEY=value pairs of the event
+        """
+        self.action = action
+        self.devpath = devpath
+        self.subsystem = subsystem
+        self.properties = properties
+
+    @property
+    def name(self):
+        return os.path.basename(self.devpath)
+
+    @property
+    def scsi_devpath(self):
+        """
+        devpath of the SCSI device a scsi_generic or block device belongs to,
+        e.g. /devices/.../0:0:0:0 for /devices/.../0:0:0:0/block/sda
+        """
+        return os.path.dirname(os.path.dirname(self.devpath))
+
+
+def parse_uevent(data):
+    """
+    Returns the Uevent contained in a netlink message or None if it is not a
+    kernel uevent.
+    """
+    fields = data.split(b"\0")
+    # Kernel uevents start with "ACTION@DEVPATH", messages sent by udev with
+    # "libudev".
+    if b"@" not in fields[0]:
+        return None
+
+    properties = {}
+    for field in fields[1:]:
+        key, separator, value = field.decode("utf-8", "replace").partition("=")
+        if separator:
+            properties[key] = value
+
+    if "ACTION" not in properties or "DEVPATH" not in properties:
+        return None
+    return Uevent(properties["ACTION"], properties["DEVPATH"], properties.get("SUBSYSTEM"), properties)
+
+
+class UeventMonitor:
+    """
+    Receives the uevents sent by the kernel.
+    """
+
+    def __init__(self):
+        self._socket = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        try:
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, _RECEIVE_BUFFER)
+            self._socket.bind((0, _KERNEL_GROUP))
+        except OSError:
+            self._socket.close()
+            raise
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def close(self):
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def receive(self, timeout=None):
+        """
+        Returns the next uevent or None if there was none within timeout
+        seconds. Messages that are no kernel uevents are skipped.
+        """
+        while True:
+            readable, _, _ = select.select([self._socket], [], [], timeout)
+            if not readable:
+                return None
+            uevent = parse_uevent(self._socket.recv(65536))
+            if uevent is not None:
+                return uevent
+
+
+class MuxRegistry:
+    """
+    The USB-SD-Muxes currently attached to this host, indexed by their sg
+    device and serial number. All methods are thread-safe.
+    """
+
+    def __init__(self, sysfs=SYSFS, devices=None):
+        """
+        Arguments:
+        sysfs -- Mount point of sysfs
+        devices -- iterable of discovery.MuxInfo to start with instead of
+                   scanning sysfs
+        """
+        self.sysfs = sysfs
+        self._condition = threading.Condition()
+        self._devices = {}
+        self._scsi_devpaths = {}
+        # Incremented every time a device with the serial is added
+        self._generations = {}
+        self._callbacks = []
+
+        for mux in scan(sysfs) if devices is None else devices:
+            self._add(mux, self._scsi_devpath(mux.sg_name))
+
+    def _scsi_devpath(self, sg_name):
+        device = os.path.realpath(os.path.join(self.sysfs, "class/scsi_generic", sg_name, "device"))
+        return "/" + os.path.relpath(device, os.path.realpath(self.sysfs))
+
+    def _add(self, mux, scsi_devpath):
+        self._remove(mux.sg_name)
+        self._devices[mux.sg_name] = mux
+        self._scsi_devpaths[scsi_devpath] = mux.sg_name
+        if mux.serial is not None:
+            self._generations[mux.serial] = self._generations.get(mux.serial, -1) + 1
+
+    def _remove(self, sg_name):
+        self._devices.pop(sg_name, None)
+        for scsi_devpath, name in list(self._scsi_devpaths.items()):
+            if name == sg_name:
+                del self._scsi_devpaths[scsi_devpath]
+
+    @property
+    def devices(self):
+        with self._condition:
+            return sorted(self._devices.values(), key=lambda mux: mux.sg_name)
+
+    def subscribe(self, callback):
+        """
+        Calls callback(uevent, mux) for every uevent that changed the
+        registry. mux is the affected discovery.MuxInfo, or None if it has
+        been removed.
+        """
+        with self._condition:
+            self._callbacks.append(callback)
+
+    def lookup(self, serial):
+        """
+        Returns the MuxInfo of the device with the serial number and the
+        number of times it has been (re-)attached, or (None, None).
+        """
+        with self._condition:
+            for mux in self._devices.values():
+                if mux.serial == serial:
+                    return mux, self._generations[serial]
+            return None, None
+
+    def by_serial(self, serial):
+        return self.lookup(serial)[0]
+
+    def wait_for(self, predicate, timeout=None):
+        """
+        Waits until predicate() returns a true value and returns it, or None
+        after timeout seconds. predicate() is called with the registry locked
+        every time it changes.
+        """
+        with self._condition:
+            return self._condition.wait_for(predicate, timeout) or None
+
+    def wait_for_serial(self, serial, timeout=None, newer_than=None):
+        """
+        Waits until the device with the serial number is attached and returns
+        its MuxInfo and generation, or (None, None) after timeout seconds.
+
+        Arguments:
+        newer_than -- Only return once the device has been attached again
+                      after this generation, e.g. because it is known to be
+                      gone.
+        """
+
+        def attached():
+            mux, generation = self.lookup(serial)
+            if mux is None or (newer_than is not None and generation <= newer_than):
+                return None
+            return mux, generation
+
+        return self.wait_for(attached, timeout) or (None, None)
+
+    def handle(self, uevent):
+        """
+        Updates the registry for a uevent.
+        """
+        mux = None
+        with self._condition:
+            if uevent.subsystem == "scsi_generic":
+                if uevent.action == "add":
+                    mux = probe(uevent.name, self.sysfs)
+                    if mux is None:
+                        return
+                    self._add(mux, uevent.scsi_devpath)
+                elif uevent.action == "remove":
+                    if uevent.name not in self._devices:
+                        return
+                    self._remove(uevent.name)
+                else:
+                    return
+
+            elif uevent.subsystem == "block" and uevent.properties.get("DEVTYPE", "disk") == "disk":
+                sg_name = self._scsi_devpaths.get(uevent.scsi_devpath)
+                if sg_name is None:
+                    return
+                mux = self._devices[sg_name]
+                if uevent.action == "add":
+                    mux.block = uevent.name
+                elif uevent.action == "remove" and mux.block == uevent.name:
+                    mux.block = None
+                else:
+                    return
+
+            else:
+                return
+
+            callbacks = list(self._callbacks)
+            self._condition.notify_all()
+
+        for callback in callbacks:
+            callback(uevent, mux)
+
+    def listen(self, monitor):
+        """
+        Starts a background thread feeding the uevents received by monitor
+        into the registry. Returns the thread.
+        """
+
+        def run():
+            while True:
+                try:
+                    uevent = monitor.receive()
+                except (OSError, ValueError):
+                    # The monitor has been closed
+                    return
+                if uevent is not None:
+                    self.handle(uevent)
+
+        thread = threading.Thread(target=run, name="usbsdmux-uevents", daemon=True)
+        thread.start()
+        return thread
+
+
+class ReattachingTransport(SgTransport):
+    """
+    An SgTransport for the USB-SD-Mux with a given serial number. The
+    sg-device is looked up in a MuxRegistry every time it is opened, so the
+    transport follows the USB-SD-Mux if it is re-enumerated.
+    """
+
+    def __init__(self, serial, registry, timeout=10):
+        """
+        Arguments:
+        serial -- USB serial number of the USB-SD-Mux
+        registry -- MuxRegistry kept up to date by a UeventMonitor
+        timeout -- Time in seconds to wait for a detached device to return
+        """
+        super().__init__(None, registry.sysfs)
+        self.serial = serial
+        self.registry = registry
+        self.timeout = timeout
+        # Generation in the registry of the device that has been lost, if any
+        self._lost = None
+        self._attached = None
+
+    def open(self):
+        if self._fh is None:
+            mux, generation = self.registry.wait_for_serial(self.serial, self.timeout, newer_than=self._lost)
+            if mux is None:
+                raise DeviceNotFound(f"USB-SD-Mux with serial '{self.serial}' did not show up")
+            self.sg = mux.sg
+            self._attached = generation
+            self._lost = None
+        return super().open()
+
+    def _on_fd(self, operation, *args):
+        try:
+            return operation(self.fileno(), *args)
+        except OSError as e:
+            if e.errno not in self._STALE_ERRNOS:
+                raise
+            # Wait for the device to be attached again, instead of reopening
+            # the sg-device, which may be gone or belong to another device.
+            self._lost = self._attached
+            self.close()
+            return operation(self.fileno(), *args)
+
+
+def open_by_serial(serial, registry, timeout=10, **kwargs):
+    """
+    Returns a UsbSdMux for the device with the serial number, that reattaches
+    to it when it is re-enumerated.
+
+    Arguments:
+    serial -- USB serial number of the USB-SD-Mux
+    registry -- MuxRegistry kept up to date by a UeventMonitor
+    timeout -- See ReattachingTransport
+    kwargs -- Passed to usbsdmux.autoselect_driver()
+    """
+    transport = ReattachingTransport(serial, registry, timeout)
+    transport.open()
+    return autoselect_driver(transport.sg, transport=transport, sysfs=registry.sysfs, **kwargs)
+
+
+def wait_for_block(sg, timeout=10, sysfs=SYSFS, monitor=None, recheck_interval=1.0):
+    """
+    Waits until the block device of the USB-SD-Mux at sg exists and has a
+    non-zero size, e.g. after switching to the host, and returns its path.
+    Raises BlockDeviceTimeout if this takes longer than timeout seconds.
+
+    Instead of polling, sysfs is only checked again when a uevent for the
+    block device arrives. As the kernel only announces media changes if it
+    polls the device for them, sysfs is also checked every recheck_interval
+    seconds without an event.
+
+    Arguments:
+    sg -- /dev/sg* of the USB-SD-Mux
+    timeout -- Maximum time to wait in seconds
+    sysfs -- Mount point of sysfs
+    monitor -- UeventMonitor to use. By default one is created and closed
+               again, or sysfs is checked every recheck_interval seconds if
+               netlink sockets are not available (e.g. in a container).
+    """
+    sg_name = os.path.basename(os.path.realpath(sg))
+    deadline = time.monotonic() + timeout
+
+    own_monitor = None
+    if monitor is None:
+        try:
+            own_monitor = monitor = UeventMonitor()
+        except OSError:
+            monitor = None
+
+    try:
+        # Subscribe to the uevents before looking at sysfs, so the change can
+        # not happen unnoticed in between.
+        scsi_device = os.path.realpath(os.path.join(sysfs, "class/scsi_generic", sg_name, "device"))
+        scsi_devpath = "/" + os.path.relpath(scsi_device, os.path.realpath(sysfs))
+
+        while True:
+            block = medium_block(sg_name, sysfs)
+            if block is not None:
+                return os.path.join("/dev", block)
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise BlockDeviceTimeout(f"The block device of {sg} did not show up within {timeout} s.")
+
+            if monitor is None:
+                time.sleep(min(remaining, recheck_interval))
+                continue
+
+            wait_until = time.monotonic() + min(remaining, recheck_interval)
+            while (left := wait_until - time.monotonic()) > 0:
+                uevent = monitor.receive(left)
+                if uevent is not None and uevent.subsystem == "block" and uevent.scsi_devpath == scsi_devpath:
+                    break
+    finally:
+        if own_monitor is not None:
+            own_monitor.close()
@@ -17,27 +17,93 @@ class I2cGpio:
     _direction_output = 0
     _direction_input = 1
 
-    def __init__(self, sg):
+    # Registers that are only changed by writing them and can thus be mirrored
+    # in the shadow cache
+    _shadowed_registers = (_register_outputPort, _register_configuration)
+
+    def __init__(self, sg, cache_registers=False, transport=None):
         """
         Arguments:
         sg -- /dev/sg* to use.
-        """
-        self._usb = Usb2642(sg)
+        cache_registers -- Keep a write-through shadow copy of the output and
+                           configuration registers. This saves the read of
+                           read-modify-write operations, but is only correct
+                           as long as nobody else (e.g. another process)
+                           writes to the GPIO-expander.
+        transport -- See Usb2642.__init__()
+        """
+        self._usb = Usb2642(sg, transport=transport)
+        self._cache_registers = cache_registers
+        self._shadow = {}
+        self._shadow_generation = None
 
     def get_usb(self):
         return self._usb
 
+    def close(self):
+        """
+        Closes the underlying sg-device.
+        """
+        self._usb.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def invalidate_cache(self):
+        """
+        Drops the shadow copies of the registers. They will be read from the
+        device again on next use.
+        """
+        self._shadow.clear()
+
+    def _validate_shadow(self):
+        # The shadow copies are only valid for the device they were read from.
+        # If the sg-device has been reopened it may have been re-enumerated.
+        if self._shadow_generation != self._usb.generation:
+            self._shadow.clear()
+            self._shadow_generation = self._usb.generation
+
     def _write_register(self, register, value):
         """
         Writes a register on the GPIO-expander with a given value.
         """
-        self._usb.write_to(self._I2cAddr, [register, value])
+        try:
+            self._usb.write_to(self._I2cAddr, [register, value])
+        except Exception:
+            self.invalidate_cache()
+            raise
+
+        if self._cache_registers and register in self._shadowed_registers:
+            self._validate_shadow()
+            self._shadow[register] = value
 
     def _read_register(self, addr):
         """
         Returns a register of the GPIO-expander.
         """
-        return self._usb.write_read_to(self._I2cAddr, [addr], 1)[0]
+        try:
+            return self._usb.write_read_to(self._I2cAddr, [addr], 1)[0]
+        except Exception:
+            self.invalidate_cache()
+            raise
+
+    def _read_shadowed_register(self, register):
+        """
+        Returns a register of the GPIO-expander. If the shadow cache is enabled
+        the register is only read from the device if there is no valid copy.
+        """
+        if not self._cache_registers:
+            return self._read_register(register)
+
+        self._validate_shadow()
+        if register not in self._shadow:
+            value = self._read_register(register)
+            self._validate_shadow()
+            self._shadow[register] = value
+        return self._shadow[register]
 
     def set_pin_to_output(self, pins):
         """
@@ -46,7 +112,7 @@ class I2cGpio:
         Arguments:
         pins -- Combination of I2cGpio.gpio_*
         """
-        direction = self._read_register(self._register_configuration)
+        direction = self._read_shadowed_register(self._register_configuration)
         direction = (direction & ~pins) & 0xFF
         self._write_register(self._register_configuration, direction)
 
@@ -57,7 +123,7 @@ class I2cGpio:
         Arguments:
         pins -- Combination of I2cGpio.gpio_*
         """
-        direction = self._read_register(self._register_configuration)
+        direction = self._read_shadowed_register(self._register_configuration)
         direction = direction | pins
         self._write_register(self._register_configuration, direction)
 
@@ -65,7 +131,7 @@ class I2cGpio:
         """
         Returns the state of the configuration register.
         """
-        return self._read_register(self._register_configuration)
+        return self._read_shadowed_register(self._register_configuration)
 
     def get_input_values(self):
         """
@@ -73,6 +139,14 @@ class I2cGpio:
         """
         return self._read_register(self._register_inputPort)
 
+    def submit_get_input_values(self):
+        """
+        Like get_input_values(), but only submits the read and returns an
+        SgRequest (see Usb2642.submit_write_read_to()). The first byte of its
+        result is the value of the input register.
+        """
+        return self._usb.submit_write_read_to(self._I2cAddr, [self._register_inputPort], 1)
+
     def output_values(self, values: int, bitmask: int = 0xFF):
         """
         Writes the given values to the GPIO-expander.
@@ -88,7 +162,7 @@ class I2cGpio:
             self._write_register(self._register_outputPort, values)
         else:
             # complex case: Let's do a read-modify-write
-            val = self._read_register(self._register_outputPort)
+            val = self._read_shadowed_register(self._register_outputPort)
             val = (val & ~bitmask) & 0xFF  # reset masked bits
             val = val | (values & bitmask)  # set bits set in values and bitmask
             self._write_register(self._register_outputPort, val)
@@ -0,0 +1,276 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+import argparse
+import contextlib
+import http.server
+import os
+import sys
+
+from .config import Config
+from .discovery import scan
+from .fileutil import read_text, write_atomic
+from .mqtthelper import BLOCK_STAT_NAMES
+from .stats import StatsFile
+from .usbsdmux import SYSFS
+
+"""
+This module exports metrics of the USB-SD-Muxes attached to this host in the
+OpenMetrics / Prometheus text format.
+
+The switch and command statistics are taken from the [stats] file (see
+stats.StatsFile), the I/O error counter of the SCSI device and the block
+device statistics from sysfs.
+
+The metrics can either be served via HTTP (by default on the loopback
+interface only) or written to a file for the textfile collector of the
+Prometheus node exporter.
+"""
+
+DEFAULT_PORT = 9489
+
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+
+class DeviceMetrics:
+    """
+    The values exported for a single USB-SD-Mux.
+    """
+
+    def __init__(self, sg_name, serial, model, stats=None, ioerr_cnt=None, block=None, block_stat=None):
+        """
+        Arguments:
+        sg_name -- Name of the sg-device, e.g. "sg0"
+        serial -- USB serial number or None
+        model -- Name of the driver class
+        stats -- stats.TransactionStats of the device or None
+        ioerr_cnt -- Number of failed SCSI commands as counted by the kernel
+        block -- Name of the block device or None
+        block_stat -- dict of the block device statistics, see BLOCK_STAT_NAMES
+        """
+        self.sg_name = sg_name
+        self.serial = serial
+        self.model = model
+        self.stats = stats
+        self.ioerr_cnt = ioerr_cnt
+        self.block = block
+        self.block_stat = block_stat
+
+    @property
+    def labels(self):
+        return {"serial": self.serial or "", "sg": self.sg_name}
+
+
+def scan_devices(sysfs=SYSFS, stats_for=None):
+    """
+    Returns a DeviceMetrics for every USB-SD-Mux found in sysfs.
+
+    Arguments:
+    sysfs -- Mount point of sysfs
+    stats_for -- Callable returning the stats.TransactionStats for a serial
+                 number or None
+    """
+    devices = []
+    for mux in scan(sysfs):
+        ioerr_cnt = read_text(os.path.join(sysfs, "class/scsi_generic", mux.sg_name, "device/ioerr_cnt"))
+
+        block_stat = None
+        if mux.block is not None:
+            stat = read_text(os.path.join(sysfs, "class/block", mux.block, "stat"))
+            if stat is not None:
+                block_stat = dict(zip(BLOCK_STAT_NAMES, (int(value) for value in stat.split()), strict=False))
+
+        devices.append(
+            DeviceMetrics(
+                mux.sg_name,
+                mux.serial,
+                mux.driver.__name__,
+                stats=stats_for(mux.serial) if stats_for is not None and mux.serial is not None else None,
+                ioerr_cnt=int(ioerr_cnt, 16) if ioerr_cnt is not None else None,
+                block=mux.block,
+                block_stat=block_stat,
+            )
+        )
+
+    return devices
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+class _Exposition:
+    """
+    Collects metric families and their samples in the text format.
+    """
+
+    def __init__(self, openmetrics):
+        self.openmetrics = openmetrics
+        self.lines = []
+
+    def family(self, name, metric_type, help_text):
+        # The Prometheus text format expects counters to be declared with
+        # their sample name, OpenMetrics without the _total suffix.
+        if metric_type == "counter" and not self.openmetrics:
+            name += "_total"
+        # Info metrics only exist in OpenMetrics, the Prometheus text format
+        # exports them as gauges named like their sample.
+        if metric_type == "info" and not self.openmetrics:
+            name, metric_type = name + "_info", "gauge"
+        self.lines.append(f"# HELP {name} {help_text}")
+        self.lines.append(f"# TYPE {name} {metric_type}")
+
+    def sample(self, name, labels, value):
+        self.lines.append(f"{name}{_format_labels(labels)} {value}")
+
+    def histogram(self, name, labels, histogram):
+        cumulative = 0
+        for bound, count in zip(histogram.bounds, histogram.buckets, strict=False):
+            cumulative += count
+            self.sample(f"{name}_bucket", {**labels, "le": repr(float(bound))}, cumulative)
+        self.sample(f"{name}_bucket", {**labels, "le": "+Inf"}, histogram.count)
+        self.sample(f"{name}_count", labels, histogram.count)
+        self.sample(f"{name}_sum", labels, histogram.sum)
+
+    def text(self):
+        lines = self.lines + ["# EOF"] if self.openmetrics else self.lines
+        return "\n".join(lines) + "\n"
+
+
+def render(devices, openmetrics=True):
+    """
+    Returns the metrics of the given devices in the OpenMetrics text format or,
+    if openmetrics is False, in the Prometheus text format.
+
+    Arguments:
+    devices -- iterable of DeviceMetrics
+    """
+    devices = list(devices)
+    with_stats = [device for device in devices if device.stats is not None]
+    out = _Exposition(openmetrics)
+
+    out.family("usbsdmux", "info", "USB-SD-Mux attached to this host")
+    for device in devices:
+        out.sample("usbsdmux_info", {**device.labels, "model": device.model, "block": device.block or ""}, 1)
+
+    out.family("usbsdmux_switches", "counter", "Number of mode switches")
+    for device in with_stats:
+        for mode, histogram in device.stats.switches.items():
+            out.sample("usbsdmux_switches_total", {**device.labels, "mode": mode}, histogram.count)
+
+    out.family("usbsdmux_switch_duration_seconds", "histogram", "Time a mode switch took, including all waits")
+    for device in with_stats:
+        for mode, histogram in device.stats.switches.items():
+            out.histogram("usbsdmux_switch_duration_seconds", {**device.labels, "mode": mode}, histogram)
+
+    for name, attribute, help_text in (
+        ("usbsdmux_commands", "count", "Number of SCSI commands sent to the USB2642"),
+        ("usbsdmux_command_failures", "failures", "Number of SCSI commands that did not complete successfully"),
+        ("usbsdmux_command_retries", "retries", "Number of SCSI commands retried after a transient error"),
+    ):
+        out.family(name, "counter", help_text)
+        for device in with_stats:
+            for operation, stats in device.stats.operations.items():
+                out.sample(f"{name}_total", {**device.labels, "operation": operation}, getattr(stats, attribute))
+
+    for name, attribute, help_text in (
+        ("usbsdmux_command_latency_seconds", "latency", "Time from issuing a SCSI command until its completion"),
+        ("usbsdmux_command_duration_seconds", "duration", "Duration of a SCSI command as reported by the kernel"),
+    ):
+        out.family(name, "histogram", help_text)
+        for device in with_stats:
+            for operation, stats in device.stats.operations.items():
+                out.histogram(name, {**device.labels, "operation": operation}, getattr(stats, attribute))
+
+    out.family("usbsdmux_sleep_seconds", "histogram", "Time spent waiting, e.g. for the SD card to discharge")
+    for device in with_stats:
+        for reason, histogram in device.stats.sleeps.items():
+            out.histogram("usbsdmux_sleep_seconds", {**device.labels, "reason": reason}, histogram)
+
+    out.family("usbsdmux_scsi_io_errors", "counter", "Failed SCSI commands as counted by the kernel (ioerr_cnt)")
+    for device in devices:
+        if device.ioerr_cnt is not None:
+            out.sample("usbsdmux_scsi_io_errors_total", device.labels, device.ioerr_cnt)
+
+    out.family("usbsdmux_block_stat", "gauge", "Statistics of the block device of the SD card, see sysfs-block")
+    for device in devices:
+        for field, value in (device.block_stat or {}).items():
+            out.sample("usbsdmux_block_stat", {**device.labels, "block": device.block, "field": field}, value)
+
+    return out.text()
+
+
+def write_textfile(filename, text):
+    """
+    Replaces filename atomically with text, so the node exporter never reads
+    a partially written file.
+    """
+    write_atomic(filename, text)
+
+
+def make_server(collect, address="127.0.0.1", port=DEFAULT_PORT):
+    """
+    Returns an HTTP server serving the metrics at /metrics.
+    Call serve_forever() on it to start serving.
+
+    Arguments:
+    collect -- Callable returning the DeviceMetrics to export
+    address -- Address to listen on
+    port -- TCP port to listen on, 0 for any free port
+    """
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+
+            body = render(collect()).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", OPENMETRICS_CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Scrapes are far too frequent to be logged.
+            pass
+
+    return http.server.ThreadingHTTPServer((address, port), Handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Exports metrics of the USB-SD-Muxes attached to this host for Prometheus."
+    )
+    parser.add_argument("--config", help="Set config file location", default=None)
+    parser.add_argument("--address", help="Address to listen on (default: %(default)s)", default="127.0.0.1")
+    parser.add_argument("--port", help="Port to listen on (default: %(default)s)", type=int, default=DEFAULT_PORT)
+    parser.add_argument(
+        "--textfile", metavar="FILE", help="Write the metrics to FILE once for the node exporter and exit"
+    )
+
+    args = parser.parse_args()
+
+    config = Config(args.config)
+    stats_file = StatsFile(config.stats_file) if config.stats_file is not None else None
+
+    def collect():
+        return scan_devices(stats_for=stats_file.get if stats_file is not None else None)
+
+    if args.textfile:
+        write_textfile(args.textfile, render(collect(), openmetrics=False))
+        return
+
+    server = make_server(collect, args.address, args.port)
+    print(f"Serving metrics on http://{args.address}:{server.server_port}/metrics", file=sys.stderr)
+    with contextlib.suppress(KeyboardInterrupt):
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
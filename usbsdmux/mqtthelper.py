@@ -1,151 +1,169 @@
 # SPDX-License-Identifier: LGPL-2.1-or-later
 # SPDX-FileCopyrightText: 2024 The USB-SD-Mux Authors
 
-import configparser
+import functools
+import getpass
 import json
 import os
 import sys
-
-from usbsdmux.usbsdmux import UsbSdMux
-
-
-class Config:
+import time
+
+from usbsdmux.config import Config
+from usbsdmux.fileutil import read_int, read_text
+from usbsdmux.spool import Spool
+from usbsdmux.usb2642 import SDTransactionFailed
+from usbsdmux.usbsdmux import SYSFS, UsbSdMux, usb_device_path
+
+# https://www.kernel.org/doc/Documentation/ABI/testing/sysfs-block
+BLOCK_STAT_NAMES = (
+    "reads_completed_successfully",
+    "reads_merged",
+    "sectors_read",
+    "time_spent_reading",
+    "writes_completed",
+    "writes_merged",
+    "sectors_written",
+    "time_spent_writing",
+    "IOs_currently_in_progress",
+    "time_spent_doing_IOs",
+    "weighted_time_spent_doing_IOs",
+    "discards_completed",
+    "discards_merged",
+    "sectors_discarded",
+    "time_spent_discarding",
+    "flush_requests_completed",
+    "time_spent_flushing",
+)
+
+
+@functools.cache
+def _host_info() -> dict:
     """
-    Reads the configuration file by default at /etc/usbsdmux.config
+    Returns the fields describing this host and tool, which do not change
+    while the process is running.
     """
+    import socket
+    from importlib import metadata
 
-    def __init__(self, configfile: str | None = None):
-        if configfile is not None:
-            if not os.path.isfile(configfile):
-                raise FileNotFoundError("Config file {configfile} not found")
-        else:
-            configfile = "/etc/usbsdmux.config"
+    try:
+        version = metadata.version("usbsdmux")
+    except metadata.PackageNotFoundError:
+        version = None
 
-        config = configparser.ConfigParser()
-        config.read(configfile)
+    try:
+        username = os.getlogin()
+    except OSError:
+        # No controlling terminal, e.g. in a service
+        username = getpass.getuser()
 
-        if "mqtt" not in config or "send" not in config:
-            self.mqtt_enabled = False
-            return
-        else:
-            self.mqtt_enabled = True
+    return {
+        "username": username,
+        "hostname": socket.gethostname(),
+        "version": version,
+    }
 
-        mqtt_section = config["mqtt"]
 
-        for argument in ("server", "port", "topic"):
-            if argument not in mqtt_section:
-                raise ValueError(f"Config value mqtt/{argument} not found. Please check {configfile}")
+# These caches only live as long as the process. They speed up usbsdmuxd,
+# which publishes the data of every command, but not the usbsdmux tool,
+# which gathers it once.
 
-        self.mqtt_server = mqtt_section["server"]
-        self.mqtt_port = int(mqtt_section["port"])
-        self.mqtt_topic = mqtt_section["topic"]
+# sysfs path of the SCSI device -> (block device name, USB path, serial).
+# A re-enumerated USB-SD-Mux gets a new SCSI device.
+_device_cache = {}
 
-        if "username" in mqtt_section and "password" in mqtt_section:
-            self.mqtt_auth = {"username": mqtt_section["username"], "password": mqtt_section["password"]}
-        else:
-            self.mqtt_auth = None
+# (USB path, diskseq) -> size of the medium. diskseq changes with the medium.
+_size_cache = {}
 
-        send_section = config["send"]
+# USB path -> (raw CID, decoded card info) of the last SD-Card seen
+_card_cache = {}
 
-        self.send_on_host = send_section.get("host", False)
-        self.send_on_dut = send_section.get("dut", False)
 
+def _device_info(sg: str, sysfs: str) -> tuple:
+    sg_name = os.path.basename(os.path.realpath(sg))
+    device = os.path.realpath(f"{sysfs}/class/scsi_generic/{sg_name}/device")
+    if device not in _device_cache:
+        # only file in this directory is a hard link pointing to the block device
+        sd_name = os.listdir(f"{device}/block/")[0]
+        usb_path = usb_device_path(sg, sysfs)
+        serial = read_text(os.path.join(usb_path, "serial")) if usb_path else None
+        _device_cache[device] = (sd_name, usb_path, serial)
+    return _device_cache[device]
 
-def _read_file(filename: str) -> str | None:
-    try:
-        with open(filename) as f:
-            return f.read()
-    except FileNotFoundError:
-        return None
 
+def _card_info(ctl: UsbSdMux, usb_path: str | None, mode: str) -> dict | None:
+    if mode == "host":
+        cid = ctl.get_card_cid(check_mode=False)
+    else:
+        # Before switching to the DUT the card may or may not be connected to
+        # the host. Instead of reading the mode first, read the CID right away,
+        # which fails without retries if the card is not connected.
+        try:
+            cid = ctl.get_card_cid(check_mode=False, retry=False)
+        except SDTransactionFailed:
+            return None
 
-def _read_int(filename: str, base: int = 10) -> int | None:
-    try:
-        return int(_read_file(filename).strip(), base)
-    except TypeError:
-        return None
+    # Reading the CID is cheaper than reading and decoding all registers
+    cached = _card_cache.get(usb_path)
+    if cached is not None and cached[0] == cid:
+        return cached[1]
 
+    card_info = ctl.get_card_info(check_mode=False, cid=cid)
+    _card_cache[usb_path] = (cid, card_info)
+    return card_info
 
-def _gather_data(ctl: UsbSdMux, sg: str, mode: str) -> dict:
-    import socket
 
-    import pkg_resources
+def _gather_data(ctl: UsbSdMux, sg: str, mode: str, sysfs: str = SYSFS) -> dict:
+    sg_name = os.path.basename(os.path.realpath(sg))
+    sd_name, usb_path, serial = _device_info(sg, sysfs)
 
-    base_sg = os.path.realpath(sg)
-    sg_name = os.path.basename(base_sg)
+    # using that name we can obtain further information
+    stat_data = [int(part) for part in read_text(f"{sysfs}/class/block/{sd_name}/stat").split()]
 
-    # only file in this directory is a hard link pointing to the block device
-    sd_name = os.listdir(f"/sys/class/scsi_generic/{sg_name}/device/block/")[0]
+    stat = dict(zip(BLOCK_STAT_NAMES, stat_data, strict=True))
 
-    # using that name we can obtain further information
-    stat_data = [int(part) for part in _read_file(f"/sys/class/block/{sd_name}/stat").split()]
-
-    # https://www.kernel.org/doc/Documentation/ABI/testing/sysfs-block
-    stat_names = (
-        "reads_completed_successfully",
-        "reads_merged",
-        "sectors_read",
-        "time_spent_reading",
-        "writes_completed",
-        "writes_merged",
-        "sectors_written",
-        "time_spent_writing",
-        "IOs_currently_in_progress",
-        "time_spent_doing_IOs",
-        "weighted_time_spent_doing_IOs",
-        "discards_completed",
-        "discards_merged",
-        "sectors_discarded",
-        "time_spent_discarding",
-        "flush_requests_completed",
-        "time_spent_flushing",
-    )
-
-    stat = dict(zip(stat_names, stat_data, strict=True))
-
-    usb_path = os.path.realpath(f"/sys/class/scsi_generic/{sg_name}")
-
-    max_depth = 10
-    while not os.path.isfile(os.path.join(usb_path, "serial")) and max_depth > 0:
-        usb_path = os.path.dirname(usb_path)
-        max_depth -= 1
-
-    card_info = ctl.get_card_info() if ctl.get_mode() == "host" or mode == "dut" else None
+    diskseq = read_int(f"{sysfs}/class/block/{sd_name}/diskseq")
+    if diskseq is None or (usb_path, diskseq) not in _size_cache:
+        size = read_int(f"{sysfs}/class/block/{sd_name}/size")
+        if diskseq is not None:
+            _size_cache[(usb_path, diskseq)] = size
+    else:
+        size = _size_cache[(usb_path, diskseq)]
+
+    host_info = _host_info()
 
     data = {
         "command": " ".join(sys.argv),
         "mode": mode,
+        # Messages may be spooled and sent much later
+        "time": time.time(),
         "sg": sg_name,
         "sd": sd_name,
         "usb": usb_path,
-        "username": os.getlogin(),
-        "hostname": socket.gethostname(),
+        "username": host_info["username"],
+        "hostname": host_info["hostname"],
         "labgrid-place": os.environ.get("LG_PLACE"),
         "model": type(ctl).__name__,
-        "serial": _read_file(os.path.join(usb_path, "serial")).strip(),
-        "version": pkg_resources.get_distribution("usbsdmux").version,
-        "diskseq": _read_int(f"/sys/class/block/{sd_name}/diskseq"),
-        "size": _read_int(f"/sys/class/block/{sd_name}/size"),
-        "ioerr_cnt": _read_int(f"/sys/class/scsi_generic/{sg_name}/device/ioerr_cnt", 16),
+        "serial": serial,
+        "version": host_info["version"],
+        "diskseq": diskseq,
+        "size": size,
+        "ioerr_cnt": read_int(f"{sysfs}/class/scsi_generic/{sg_name}/device/ioerr_cnt", 16),
         "stat": stat,
-        "card_info": card_info,
+        "card_info": _card_info(ctl, usb_path, mode),
     }
 
     return data
 
 
-def publish_info(ctl: UsbSdMux, config: Config, sg: str, mode: str) -> None:
-    """
-    Publish info to mqtt server, if mqtt is enabled.
-    This requires installing paho-mqtt.
-    """
+# The MqttPublisher of this process, see start_publisher()
+_publisher = None
 
-    if not config.mqtt_enabled:
-        return
+# Time in seconds to spool messages without connecting after the broker was
+# unreachable
+RETRY_INTERVAL = 60
 
-    if (mode == "client" and not config.send_on_dut) or (mode == "host" and not config.send_on_host):
-        return
 
+def _import_paho():
     try:
         import paho.mqtt.publish as mqtt
     except ImportError:
@@ -158,15 +176,112 @@ def publish_info(ctl: UsbSdMux, config: Config, sg: str, mode: str) -> None:
             file=sys.stderr,
         )
         exit(1)
+    return mqtt
+
+
+def start_publisher(config: Config) -> None:
+    """
+    Publish the info of all following publish_info() calls from a background
+    thread using a persistent connection, so they do not wait for the broker.
+    This is meant for long-running processes using the USB-SD-Muxes.
+    """
+    global _publisher
+
+    if not config.mqtt_enabled or _publisher is not None:
+        return
+
+    _import_paho()
+    from usbsdmux.publisher import MqttPublisher
+
+    _publisher = MqttPublisher.from_config(config)
+
+
+def stop_publisher(timeout: float = 5) -> None:
+    """
+    Publish the queued info for at most timeout seconds and stop the
+    publisher started by start_publisher().
+    """
+    global _publisher
+
+    if _publisher is None:
+        return
+
+    publisher, _publisher = _publisher, None
+    lost = publisher.close(timeout)
+    if lost:
+        print(f"Dropped {len(lost)} MQTT messages that could not be sent.", file=sys.stderr)
+
+
+def publish_info(ctl: UsbSdMux, config: Config, sg: str, mode: str) -> None:
+    """
+    Publish info to mqtt server, if mqtt is enabled.
+    This requires installing paho-mqtt.
+
+    The info is queued if start_publisher() was called or handed to the
+    usbsdmux-mqtt-forwarder if one is configured. Otherwise it is sent
+    synchronously. If a spool is configured, info that could not be sent is
+    kept and sent along with the next info.
+    """
+
+    if not config.mqtt_enabled:
+        return
+
+    if (mode == "client" and not config.send_on_dut) or (mode == "host" and not config.send_on_host):
+        return
+
+    payload = json.dumps(_gather_data(ctl, sg, mode))
+
+    if _publisher is not None:
+        _publisher.publish(payload)
+        return
+
+    spool = Spool(config.mqtt_spool, config.mqtt_spool_size) if config.mqtt_spool else None
+
+    if config.mqtt_forwarder is not None:
+        from usbsdmux.publisher import forward
+
+        try:
+            forward(config.mqtt_forwarder, payload)
+            return
+        except OSError as e:
+            if spool is not None:
+                spool.append(payload)
+                return
+            print(f"usbsdmux-mqtt-forwarder not reachable ({e}). Sending directly.", file=sys.stderr)
+
+    mqtt = _import_paho()
+
+    if spool is None:
+        try:
+            mqtt.single(
+                config.mqtt_topic,
+                payload=payload,
+                hostname=config.mqtt_server,
+                port=config.mqtt_port,
+                auth=config.mqtt_auth,
+            )
+        except Exception as e:
+            print("Sending statistics via MQTT failed: (", e, "). Continuing anyway.", sep="", file=sys.stderr)
+        return
+
+    # Do not wait for the connection to time out again during an outage
+    if spool.backing_off(RETRY_INTERVAL):
+        spool.append(payload)
+        return
 
-    data = _gather_data(ctl, sg, mode)
+    # Send a batch of the spooled messages along with this one
+    batch = spool.take()
     try:
-        mqtt.single(
-            config.mqtt_topic,
-            payload=json.dumps(data),
+        mqtt.multiple(
+            [{"topic": config.mqtt_topic, "payload": message, "qos": 1} for message in batch + [payload]],
             hostname=config.mqtt_server,
             port=config.mqtt_port,
             auth=config.mqtt_auth,
         )
     except Exception as e:
-        print("Sending statistics via MQTT failed: (", e, "). Continuing anyway.", sep="", file=sys.stderr)
+        spool.restore(batch)
+        spool.append(payload)
+        spool.mark_failed()
+        print("Sending statistics via MQTT failed: (", e, "). Spooled for later.", sep="", file=sys.stderr)
+    else:
+        spool.mark_succeeded()
@@ -0,0 +1,321 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+import argparse
+import collections
+import contextlib
+import os
+import socket
+import sys
+import threading
+import time
+
+from .config import Config
+from .spool import BATCH_SIZE, Spool
+
+"""
+This module sends the MQTT statistics without making the switch wait for
+the broker.
+
+MqttPublisher keeps a persistent connection to the broker and publishes the
+messages queued by publish() from a background thread. The queue is bounded:
+if the broker is unreachable for too long, the oldest (or, if configured, the
+newest) messages are dropped. Given a spool.Spool, dropped messages are
+spooled instead and sent once the broker is reachable again.
+
+A process like usbsdmuxd uses an MqttPublisher directly, see
+mqtthelper.start_publisher(). The short-lived usbsdmux tool instead hands its
+messages to usbsdmux-mqtt-forwarder via a Unix datagram socket (see
+forward()), which only takes a single syscall.
+
+This requires installing paho-mqtt.
+"""
+
+DEFAULT_QUEUE_SIZE = 1000
+
+# Largest message accepted by the forwarder
+_MAX_DATAGRAM = 256 * 1024
+
+
+class MqttPublisher:
+    """
+    Publishes messages to an MQTT broker from a background thread.
+    """
+
+    def __init__(
+        self, server, port, topic, auth=None, queue_size=DEFAULT_QUEUE_SIZE, drop_oldest=True, on_drop=None, spool=None
+    ):
+        """
+        Arguments:
+        server -- Hostname of the broker
+        port -- Port of the broker
+        topic -- Topic to publish the messages to
+        auth -- dict with "username" and "password" or None
+        queue_size -- Maximum number of messages waiting to be published
+        drop_oldest -- Drop the oldest message if the queue is full,
+                       otherwise the message to be queued is dropped
+        on_drop -- Callable called with every dropped message
+        spool -- spool.Spool to store dropped and unsent messages in. The
+                 spooled messages are sent whenever the queue runs empty.
+        """
+        import paho.mqtt.client as mqtt
+
+        self.topic = topic
+        self.queue_size = queue_size
+        self.drop_oldest = drop_oldest
+        self.on_drop = on_drop
+        self.spool = spool
+        self.dropped = 0
+        self.published = 0
+
+        self._queue = collections.deque()
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._deadline = None
+
+        # The message handed to paho, but not yet acknowledged by the broker.
+        # It is no longer in _queue, so it can not be dropped.
+        self._inflight = None
+        # mids of the messages acknowledged by the broker
+        self._acked = set()
+        # Results of publish() for which paho has queued the message. If not
+        # connected, it is sent once the connection is back.
+        self._queued_rcs = (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN)
+
+        if hasattr(mqtt, "CallbackAPIVersion"):
+            self._client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        else:
+            self._client = mqtt.Client()
+        if auth is not None:
+            self._client.username_pw_set(auth["username"], auth["password"])
+        self._client.on_connect = self._on_connect
+        self._client.on_publish = self._on_publish
+        self._client.reconnect_delay_set(min_delay=1, max_delay=30)
+        self._client.connect_async(server, port)
+        self._client.loop_start()
+
+        self._thread = threading.Thread(target=self._run, name="usbsdmux-mqtt", daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def from_config(cls, config, on_drop=None):
+        """
+        Creates an MqttPublisher for the [mqtt] section of a mqtthelper.Config.
+        """
+        spool = Spool(config.mqtt_spool, config.mqtt_spool_size) if config.mqtt_spool else None
+        return cls(
+            config.mqtt_server,
+            config.mqtt_port,
+            config.mqtt_topic,
+            auth=config.mqtt_auth,
+            queue_size=config.mqtt_queue_size,
+            on_drop=on_drop,
+            spool=spool,
+        )
+
+    def _on_connect(self, *args):
+        # Wake up the sender, messages may be waiting for the connection
+        with self._condition:
+            self._condition.notify_all()
+
+    def _on_publish(self, client, userdata, mid, *args):
+        with self._condition:
+            self._acked.add(mid)
+            self._condition.notify_all()
+
+    def publish(self, payload):
+        """
+        Queues payload (str or bytes) to be published and returns immediately.
+        Returns False if a message had to be dropped.
+        """
+        dropped = None
+        with self._condition:
+            if len(self._queue) >= self.queue_size:
+                dropped = self._queue.popleft() if self.drop_oldest else payload
+            if dropped is not payload:
+                self._queue.append(payload)
+            self._condition.notify_all()
+
+        if dropped is not None:
+            self.dropped += 1
+            if self.spool is not None:
+                self.spool.append(dropped)
+            if self.on_drop is not None:
+                self.on_drop(dropped)
+            return False
+        return True
+
+    @property
+    def pending(self):
+        with self._condition:
+            return len(self._queue) + (self._inflight is not None)
+
+    def _wait(self):
+        # Called with _condition held
+        timeout = 1 if not self._stopping else max(0, self._deadline - time.monotonic())
+        self._condition.wait(timeout)
+
+    def _next(self):
+        """
+        Takes the next message from the queue once it can be published and
+        returns it, or None if the publisher is stopping.
+        """
+        with self._condition:
+            while True:
+                if self._stopping and (not self._queue or time.monotonic() >= self._deadline):
+                    return None
+                if self._queue and self._client.is_connected():
+                    self._inflight = self._queue.popleft()
+                    return self._inflight
+                self._wait()
+
+    def _wait_acked(self, mid):
+        """
+        Waits until the broker has acknowledged the message mid. Returns
+        False if the publisher is stopping before.
+        """
+        with self._condition:
+            while mid not in self._acked:
+                if self._stopping and time.monotonic() >= self._deadline:
+                    return False
+                self._wait()
+            self._acked.discard(mid)
+            self._inflight = None
+            return True
+
+    def _run(self):
+        while (payload := self._next()) is not None:
+            info = self._client.publish(self.topic, payload, qos=1)
+            if info.rc not in self._queued_rcs:
+                # paho has not taken the message, try again later
+                with self._condition:
+                    self._queue.appendleft(payload)
+                    self._inflight = None
+                time.sleep(0.1)
+                continue
+
+            # paho sends the message again if the connection was lost, so
+            # publishing it again would create a duplicate.
+            if not self._wait_acked(info.mid):
+                return
+
+            with self._condition:
+                empty = not self._queue
+            self.published += 1
+
+            if empty and self.spool is not None:
+                self._refill()
+
+    def _refill(self):
+        # The broker is reachable: send a batch of the spooled messages
+        batch = self.spool.take(min(BATCH_SIZE, self.queue_size))
+        if batch:
+            with self._condition:
+                self._queue.extend(batch)
+                self._condition.notify_all()
+
+    def close(self, timeout=5):
+        """
+        Publishes the queued messages for at most timeout seconds and closes
+        the connection. Returns the messages that could neither be published
+        nor spooled.
+        """
+        with self._condition:
+            self._stopping = True
+            self._deadline = time.monotonic() + timeout
+            self._condition.notify_all()
+        self._thread.join()
+
+        self._client.disconnect()
+        self._client.loop_stop()
+
+        with self._condition:
+            remaining = list(self._queue)
+            if self._inflight is not None:
+                remaining.insert(0, self._inflight)
+                self._inflight = None
+            self._queue.clear()
+        if self.spool is not None:
+            self.spool.extend(remaining)
+            return []
+        return remaining
+
+
+def forward(path, payload):
+    """
+    Hands payload (str or bytes) to the usbsdmux-mqtt-forwarder listening on
+    path without waiting for it to be published. Raises OSError if the
+    forwarder is not running.
+    """
+    if isinstance(payload, str):
+        payload = payload.encode()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.setblocking(False)
+        sock.sendto(payload, path)
+
+
+class Forwarder:
+    """
+    Receives messages on a Unix datagram socket and publishes them using an
+    MqttPublisher.
+    """
+
+    def __init__(self, path, publisher):
+        self.path = path
+        self.publisher = publisher
+        self._closed = False
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.bind(path)
+        # Allow access for the group of the users of the USB-SD-Muxes
+        os.chmod(path, 0o660)
+
+    def serve_forever(self):
+        while True:
+            try:
+                payload = self._socket.recv(_MAX_DATAGRAM)
+            except OSError:
+                if self._closed:
+                    return
+                raise
+            if self._closed:
+                return
+            if payload:
+                self.publisher.publish(payload)
+
+    def close(self):
+        self._closed = True
+        # Wakes up serve_forever(), unlike close()
+        with contextlib.suppress(OSError):
+            self._socket.shutdown(socket.SHUT_RDWR)
+        self._socket.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Forward the MQTT statistics of usbsdmux to the broker.")
+    parser.add_argument("--config", help="Set config file location", default=None)
+    args = parser.parse_args()
+
+    config = Config(args.config)
+    if not config.mqtt_enabled or config.mqtt_forwarder is None:
+        print("No [mqtt] forwarder socket configured.", file=sys.stderr)
+        sys.exit(1)
+
+    publisher = MqttPublisher.from_config(config)
+    forwarder = Forwarder(config.mqtt_forwarder, publisher)
+    print(f"Forwarding {config.mqtt_forwarder} to {config.mqtt_server}:{config.mqtt_port}", file=sys.stderr)
+    try:
+        with contextlib.suppress(KeyboardInterrupt):
+            forwarder.serve_forever()
+    finally:
+        forwarder.close()
+        publisher.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+"""
+This module decodes the SCSI sense data returned by the USB2642 along with a
+CHECK CONDITION status.
+
+See the SCSI Primary Commands (SPC) specification, "Sense data" and the
+"ASC and ASCQ assignments" table for details.
+"""
+
+SENSE_KEY_NO_SENSE = 0x0
+SENSE_KEY_RECOVERED_ERROR = 0x1
+SENSE_KEY_NOT_READY = 0x2
+SENSE_KEY_MEDIUM_ERROR = 0x3
+SENSE_KEY_HARDWARE_ERROR = 0x4
+SENSE_KEY_ILLEGAL_REQUEST = 0x5
+SENSE_KEY_UNIT_ATTENTION = 0x6
+SENSE_KEY_DATA_PROTECT = 0x7
+SENSE_KEY_ABORTED_COMMAND = 0xB
+
+SENSE_KEYS = {
+    SENSE_KEY_NO_SENSE: "NO SENSE",
+    SENSE_KEY_RECOVERED_ERROR: "RECOVERED ERROR",
+    SENSE_KEY_NOT_READY: "NOT READY",
+    SENSE_KEY_MEDIUM_ERROR: "MEDIUM ERROR",
+    SENSE_KEY_HARDWARE_ERROR: "HARDWARE ERROR",
+    SENSE_KEY_ILLEGAL_REQUEST: "ILLEGAL REQUEST",
+    SENSE_KEY_UNIT_ATTENTION: "UNIT ATTENTION",
+    SENSE_KEY_DATA_PROTECT: "DATA PROTECT",
+    0x8: "BLANK CHECK",
+    0x9: "VENDOR SPECIFIC",
+    0xA: "COPY ABORTED",
+    SENSE_KEY_ABORTED_COMMAND: "ABORTED COMMAND",
+    0xD: "VOLUME OVERFLOW",
+    0xE: "MISCOMPARE",
+}
+
+ASC_LOGICAL_UNIT_NOT_READY = 0x04
+ASC_MEDIUM_MAY_HAVE_CHANGED = 0x28
+ASC_POWER_ON_RESET = 0x29
+ASC_MEDIUM_NOT_PRESENT = 0x3A
+
+# (ASC, ASCQ) -> description. An ASCQ of None matches every qualifier.
+ADDITIONAL_SENSE = {
+    (0x00, 0x00): "No additional sense information",
+    (ASC_LOGICAL_UNIT_NOT_READY, 0x00): "Logical unit not ready, cause not reportable",
+    (ASC_LOGICAL_UNIT_NOT_READY, 0x01): "Logical unit is in process of becoming ready",
+    (ASC_LOGICAL_UNIT_NOT_READY, 0x02): "Logical unit not ready, initializing command required",
+    (ASC_LOGICAL_UNIT_NOT_READY, 0x03): "Logical unit not ready, manual intervention required",
+    (0x08, None): "Logical unit communication failure",
+    (0x11, None): "Unrecovered read error",
+    (0x20, 0x00): "Invalid command operation code",
+    (0x24, 0x00): "Invalid field in CDB",
+    (0x25, 0x00): "Logical unit not supported",
+    (0x27, None): "Write protected",
+    (ASC_MEDIUM_MAY_HAVE_CHANGED, 0x00): "Not ready to ready change, medium may have changed",
+    (ASC_POWER_ON_RESET, None): "Power on, reset, or bus device reset occurred",
+    (ASC_MEDIUM_NOT_PRESENT, None): "Medium not present",
+    (0x44, 0x00): "Internal target failure",
+    (0x47, None): "SCSI parity error",
+}
+
+# Conditions that are expected to go away by themselves, so retrying the
+# command later makes sense.
+_TRANSIENT_NOT_READY = {(ASC_LOGICAL_UNIT_NOT_READY, 0x00), (ASC_LOGICAL_UNIT_NOT_READY, 0x01)}
+
+
+class SenseData:
+    """
+    Decoded sense key, additional sense code (ASC) and additional sense code
+    qualifier (ASCQ) of a failed SCSI command.
+    """
+
+    def __init__(self, key, asc, ascq):
+        self.key = key
+        self.asc = asc
+        self.ascq = ascq
+
+    @classmethod
+    def parse(cls, buffer):
+        """
+        Decodes sense data in fixed or descriptor format.
+        Returns None if buffer does not contain valid sense data.
+
+        Arguments:
+        buffer -- bytes as written by the device to the sense buffer
+        """
+        if len(buffer) < 1:
+            return None
+
+        response_code = buffer[0] & 0x7F
+        if response_code in (0x70, 0x71) and len(buffer) >= 14:
+            return cls(buffer[2] & 0x0F, buffer[12], buffer[13])
+        if response_code in (0x72, 0x73) and len(buffer) >= 4:
+            return cls(buffer[1] & 0x0F, buffer[2], buffer[3])
+        return None
+
+    @property
+    def key_name(self):
+        return SENSE_KEYS.get(self.key, f"Sense key 0x{self.key:X}")
+
+    @property
+    def description(self):
+        """
+        Human readable description of the ASC/ASCQ.
+        """
+        text = ADDITIONAL_SENSE.get((self.asc, self.ascq)) or ADDITIONAL_SENSE.get((self.asc, None))
+        return text or "Unknown additional sense"
+
+    @property
+    def medium_not_present(self):
+        return self.key == SENSE_KEY_NOT_READY and self.asc == ASC_MEDIUM_NOT_PRESENT
+
+    @property
+    def transient(self):
+        """
+        True if the condition is expected to go away by itself, e.g. because
+        the SD-Card is still initializing or the device has just been reset.
+        """
+        if self.key == SENSE_KEY_UNIT_ATTENTION:
+            return True
+        if self.key == SENSE_KEY_NOT_READY:
+            return (self.asc, self.ascq) in _TRANSIENT_NOT_READY
+        return False
+
+    def __str__(self):
+        return f"{self.key_name}: {self.description} (ASC 0x{self.asc:02X}, ASCQ 0x{self.ascq:02X})"
+
+    def __repr__(self):
+        return f"SenseData(key=0x{self.key:X}, asc=0x{self.asc:02X}, ascq=0x{self.ascq:02X})"
@@ -0,0 +1,232 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+import contextlib
+import os
+import sqlite3
+import sys
+import time
+
+from .discovery import _block_name
+from .fileutil import read_int
+from .mqtthelper import BLOCK_STAT_NAMES
+from .usb2642 import TransactionFailed
+from .usbsdmux import SYSFS, NotInHostModeException, usb_serial
+
+"""
+This module records how the SD-Card of a USB-SD-Mux was used while it was
+connected to the host.
+
+The block I/O counters in /sys/class/block/<sd>/stat accumulate over the
+lifetime of the block device. To tell how much a single test job wrote to
+the card, the counters are recorded when switching to the host and the
+difference is stored when switching away again. Every such host session is
+a row in an SQLite database, indexed by the serial number of the USB-SD-Mux,
+the CID of the SD-Card and time.
+"""
+
+# Counters of which the difference is stored per session
+DELTA_NAMES = (
+    "reads_completed_successfully",
+    "sectors_read",
+    "writes_completed",
+    "sectors_written",
+    "time_spent_doing_IOs",
+    "discards_completed",
+    "sectors_discarded",
+    "flush_requests_completed",
+)
+
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    serial TEXT NOT NULL,
+    place TEXT,
+    started REAL NOT NULL,
+    ended REAL,
+    start_stat TEXT NOT NULL,
+    cid TEXT,
+    diskseq INTEGER,
+    {", ".join(f"{name} INTEGER" for name in DELTA_NAMES)}
+);
+CREATE INDEX IF NOT EXISTS sessions_serial ON sessions (serial, started);
+CREATE INDEX IF NOT EXISTS sessions_cid ON sessions (cid, started);
+CREATE INDEX IF NOT EXISTS sessions_started ON sessions (started);
+"""
+
+
+def _encode_stat(stat):
+    return " ".join(str(stat.get(name, "")) for name in BLOCK_STAT_NAMES).rstrip()
+
+
+def _decode_stat(text):
+    return {name: int(value) for name, value in zip(BLOCK_STAT_NAMES, text.split(), strict=False)}
+
+
+def delta(start, end):
+    """
+    Returns the difference of the DELTA_NAMES counters between two stat
+    dictionaries. Counters missing in one of them (older kernels) are None.
+
+    If a counter went backwards, the block device has been re-created and
+    its counters restarted from zero, so the end values are returned.
+    """
+    names = [name for name in DELTA_NAMES if name in start and name in end]
+    if any(end[name] < start[name] for name in names):
+        start = {}
+    return {name: end[name] - start.get(name, 0) if name in names else None for name in DELTA_NAMES}
+
+
+class SessionLog:
+    """
+    The host sessions of all USB-SD-Muxes, stored in an SQLite database.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    @contextlib.contextmanager
+    def _connect(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+        db = sqlite3.connect(self.filename, timeout=10)
+        try:
+            db.row_factory = sqlite3.Row
+            with db:
+                db.executescript(_SCHEMA)
+                yield db
+        finally:
+            db.close()
+
+    @staticmethod
+    def _open_session(db, serial):
+        return db.execute(
+            "SELECT id, start_stat FROM sessions WHERE serial = ? AND ended IS NULL ORDER BY started DESC LIMIT 1",
+            (serial,),
+        ).fetchone()
+
+    def is_open(self, serial):
+        """
+        Returns True if the USB-SD-Mux serial is in a host session.
+        """
+        with self._connect() as db:
+            return self._open_session(db, serial) is not None
+
+    def begin(self, serial, stat, place=None, now=None):
+        """
+        Starts a host session of the USB-SD-Mux serial. Does nothing if one
+        is already open.
+
+        Arguments:
+        serial -- Serial number of the USB-SD-Mux, or its path if it has none
+        stat -- Block I/O counters as returned by read_stat()
+        place -- Labgrid place the session belongs to
+        now -- Start time, defaults to the current time
+        """
+        with self._connect() as db:
+            if self._open_session(db, serial) is not None:
+                return
+            db.execute(
+                "INSERT INTO sessions (serial, place, started, start_stat) VALUES (?, ?, ?, ?)",
+                (serial, place, time.time() if now is None else now, _encode_stat(stat)),
+            )
+
+    def end(self, serial, stat, cid=None, diskseq=None, now=None):
+        """
+        Ends the host session of the USB-SD-Mux serial and stores the I/O
+        done during it. Returns the differences of the counters or None if
+        there was no open session.
+
+        Arguments:
+        serial -- See begin()
+        stat -- Block I/O counters at the end of the session
+        cid -- CID of the SD-Card as hex string or None if unknown
+        diskseq -- diskseq of the medium or None if unknown
+        now -- End time, defaults to the current time
+        """
+        with self._connect() as db:
+            session = self._open_session(db, serial)
+            if session is None:
+                return None
+            io = delta(_decode_stat(session["start_stat"]), stat)
+            db.execute(
+                f"UPDATE sessions SET ended = ?, cid = ?, diskseq = ?, {', '.join(f'{name} = ?' for name in io)} "
+                "WHERE id = ?",
+                (time.time() if now is None else now, cid, diskseq, *io.values(), session["id"]),
+            )
+            return io
+
+    def sessions(self, serial=None, cid=None, since=None):
+        """
+        Returns the completed sessions as dictionaries, oldest first,
+        optionally only those of a USB-SD-Mux, an SD-Card or since a time.
+        """
+        conditions = ["ended IS NOT NULL"]
+        params = []
+        for column, operator, value in (("serial", "=", serial), ("cid", "=", cid), ("started", ">=", since)):
+            if value is not None:
+                conditions.append(f"{column} {operator} ?")
+                params.append(value)
+
+        with self._connect() as db:
+            rows = db.execute(
+                f"SELECT * FROM sessions WHERE {' AND '.join(conditions)} ORDER BY started",
+                params,
+            ).fetchall()
+        return [{key: value for key, value in dict(row).items() if key != "start_stat"} for row in rows]
+
+
+def read_stat(sg, sysfs=SYSFS):
+    """
+    Returns the block I/O counters and the diskseq of the block device of
+    the USB-SD-Mux at sg or (None, None) if there is none.
+    """
+    block = _block_name(os.path.basename(os.path.realpath(sg)), sysfs)
+    if block is None:
+        return None, None
+    try:
+        with open(os.path.join(sysfs, "class/block", block, "stat")) as fh:
+            values = [int(value) for value in fh.read().split()]
+    except OSError:
+        return None, None
+    stat = dict(zip(BLOCK_STAT_NAMES, values, strict=False))
+    return stat, read_int(os.path.join(sysfs, "class/block", block, "diskseq"))
+
+
+def _serial(sg, sysfs):
+    serial = usb_serial(sg, sysfs)
+    return serial if serial is not None else os.path.realpath(sg)
+
+
+def record_session(ctl, config, sg, mode, sysfs=SYSFS):
+    """
+    Starts a host session if mode is "host" or ends it otherwise, if a
+    [sessions] database is configured.
+
+    Call this after switching to the host and before switching away from
+    it, as the CID of the card can only be read in host mode.
+    """
+    if config.sessions_db is None:
+        return
+
+    # The sessions are only statistics. Do not fail the switch if they can
+    # not be recorded.
+    try:
+        stat, diskseq = read_stat(sg, sysfs)
+        if stat is None:
+            return
+
+        log = SessionLog(config.sessions_db)
+        serial = _serial(sg, sysfs)
+        if mode == "host":
+            log.begin(serial, stat, place=os.environ.get("LG_PLACE"))
+            return
+
+        if not log.is_open(serial):
+            return
+        try:
+            cid = ctl.get_card_cid().hex()
+        except (NotInHostModeException, TransactionFailed, OSError):
+            cid = None
+        log.end(serial, stat, cid=cid, diskseq=diskseq)
+    except (OSError, sqlite3.Error) as e:
+        print(f"Could not record the host session: {e}", file=sys.stderr)
@@ -0,0 +1,449 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+import collections
+import contextlib
+import ctypes
+import os
+import threading
+import time
+
+from .i2c_gpio import I2cGpio, Pca9536, Tca6408
+from .sense import (
+    ASC_LOGICAL_UNIT_NOT_READY,
+    ASC_MEDIUM_NOT_PRESENT,
+    SENSE_KEY_ILLEGAL_REQUEST,
+    SENSE_KEY_NOT_READY,
+)
+from .usb2642 import TransactionFailed, Usb2642
+from .usbsdmux import UsbSdMuxClassic, UsbSdMuxFast
+
+"""
+This module simulates the hardware of a USB-SD-Mux: The USB2642 with its
+vendor specific SCSI commands, the GPIO-expander and config EEPROM on its I2C
+bus and an SD-Card.
+
+A SimulatedTransport can be passed to Usb2642 (and all classes built on top of
+it) instead of the /dev/sg* device. Together with a fake sysfs tree created by
+SimulatedUsbSdMux.install_sysfs() the complete stack, including the driver
+selection by autoselect_driver(), can be used without any hardware, e.g. for
+tests and benchmarks.
+"""
+
+_GPIO_CLASSES = {
+    UsbSdMuxClassic: Pca9536,
+    UsbSdMuxFast: Tca6408,
+}
+
+
+class SimulatedCard:
+    """
+    The registers and timing behavior of an SD-Card.
+    """
+
+    def __init__(self, cid, csd, scr, init_time=0.0, min_off_time=0.0):
+        """
+        Arguments:
+        cid, csd, scr -- Content of the card registers as bytes
+        init_time -- Time in seconds after the card has been connected to the
+                     host during which it reports to be becoming ready
+        min_off_time -- Minimum time in seconds the card needs to be
+                        disconnected from its supply to reset. If it is
+                        reconnected earlier it does not respond anymore.
+        """
+        self.registers = {
+            Usb2642.REGISTER_CID[0]: bytes(cid),
+            Usb2642.REGISTER_CSD[0]: bytes(csd),
+            Usb2642.REGISTER_SCR[0]: bytes(scr),
+        }
+        self.init_time = init_time
+        self.min_off_time = min_off_time
+
+
+def default_card(**kwargs):
+    """
+    Returns a SimulatedCard with the registers of a real 4GB SDHC card.
+    kwargs are passed to SimulatedCard.
+    """
+    return SimulatedCard(
+        cid=bytes.fromhex("02544d53413034471027b7748500bc00"),
+        csd=bytes.fromhex("400e00325b5900001d177f800a400000"),
+        scr=bytes.fromhex("0235800001000000"),
+        **kwargs,
+    )
+
+
+class SimulatedGpioExpander:
+    """
+    Register file of a PCA9536 or TCA6408 GPIO-expander.
+    """
+
+    def __init__(self, gpio_class, pull_values):
+        """
+        Arguments:
+        gpio_class -- Pca9536 or Tca6408
+        pull_values -- Levels of the pins while they are configured as inputs
+        """
+        self.address = gpio_class._I2cAddr
+        self.pull_values = pull_values
+        self.reset()
+
+    def reset(self):
+        """
+        Restores the Power-On-Reset state, e.g. after a supply glitch.
+        """
+        self._pointer = 0
+        # Power-On-Reset defaults of both expanders
+        self.registers = {
+            I2cGpio._register_outputPort: 0xFF,
+            I2cGpio._register_polarity: 0x00,
+            I2cGpio._register_configuration: 0xFF,
+        }
+
+    @property
+    def pin_values(self):
+        """
+        Levels of the pins, as driven by the outputs or the pull resistors.
+        """
+        output = self.registers[I2cGpio._register_outputPort]
+        config = self.registers[I2cGpio._register_configuration]
+        return (output & ~config | self.pull_values & config) & 0xFF
+
+    def read(self, register):
+        if register == I2cGpio._register_inputPort:
+            return self.pin_values ^ self.registers[I2cGpio._register_polarity]
+        return self.registers[register]
+
+    def write(self, data):
+        """
+        Handles an I2C write of the register pointer and optionally a value.
+        """
+        self._pointer = data[0] & 0x03
+        if len(data) > 1 and self._pointer != I2cGpio._register_inputPort:
+            self.registers[self._pointer] = data[1]
+
+    def write_read(self, data, length):
+        if data:
+            self.write(data[:1])
+        return bytes([self.read(self._pointer)] * length)
+
+
+class SimulatedEeprom:
+    """
+    A 256 byte I2C EEPROM with an auto incrementing address pointer.
+    """
+
+    def __init__(self, address=0x50):
+        self.address = address
+        self.memory = bytearray(256)
+        self._pointer = 0
+
+    def write(self, data):
+        self._pointer = data[0]
+        for byte in data[1:]:
+            self.memory[self._pointer] = byte
+            self._pointer = (self._pointer + 1) & 0xFF
+
+    def write_read(self, data, length):
+        if data:
+            self.write(data[:1])
+        result = bytes(self.memory[(self._pointer + i) & 0xFF] for i in range(length))
+        self._pointer = (self._pointer + length) & 0xFF
+        return result
+
+
+class SimulatedUsbSdMux:
+    """
+    The hardware of a USB-SD-Mux of the model given by driver.
+
+    The mode is derived from the pins of the GPIO-expander in the same way the
+    driver does it, so every transition performed by the driver is reflected
+    in the state of the card.
+    """
+
+    def __init__(self, driver=UsbSdMuxFast, card=None, serial="000000000001", pull_values=None):
+        """
+        Arguments:
+        driver -- UsbSdMuxClassic or UsbSdMuxFast
+        card -- SimulatedCard that is inserted or None
+        serial -- USB serial number
+        pull_values -- Levels of the GPIO-expander pins while they are inputs.
+                       Defaults to the pull resistors selecting the DUT.
+        """
+        self.driver = driver
+        self.card = card
+        self.serial = serial
+        if pull_values is None:
+            pull_values = driver._pin_values("dut")
+
+        self.expander = SimulatedGpioExpander(_GPIO_CLASSES[driver], pull_values)
+        self.eeprom = SimulatedEeprom()
+        self.i2c_devices = {
+            self.expander.address: self.expander,
+            self.eeprom.address: self.eeprom,
+        }
+
+        # Last blob written using the config write command of the USB2642
+        self.config = None
+
+        # Transports may be used from different threads
+        self.lock = threading.Lock()
+
+        self._mode = self.mode
+        self._powered_off_at = None
+        self._connected_at = None
+        self._card_responding = True
+
+    @property
+    def mode(self):
+        return self.driver._decode_mode(self.expander.pin_values)
+
+    def _update_card_state(self):
+        mode = self.mode
+        if mode == self._mode:
+            return
+
+        now = time.monotonic()
+        if mode == "off":
+            self._powered_off_at = now
+        elif self._mode == "off":
+            off_time = float("inf") if self._powered_off_at is None else now - self._powered_off_at
+            self._card_responding = self.card is None or off_time >= self.card.min_off_time
+
+        self._connected_at = now if mode == "host" else None
+        self._mode = mode
+
+    def i2c_write(self, address, data):
+        """
+        Returns False if no device acknowledges address.
+        """
+        device = self.i2c_devices.get(address)
+        if device is None:
+            return False
+        device.write(data)
+        self._update_card_state()
+        return True
+
+    def i2c_write_read(self, address, data, length):
+        """
+        Returns the data read from the device or None if no device
+        acknowledges address.
+        """
+        device = self.i2c_devices.get(address)
+        if device is None:
+            return None
+        return device.write_read(data, length)
+
+    def read_card_register(self, register, size):
+        """
+        Returns a tuple of the register content and the (sense key, ASC, ASCQ)
+        of the error or None.
+        """
+        if self.card is None or self._connected_at is None:
+            return None, (SENSE_KEY_NOT_READY, ASC_MEDIUM_NOT_PRESENT, 0x00)
+        if time.monotonic() - self._connected_at < self.card.init_time:
+            return None, (SENSE_KEY_NOT_READY, ASC_LOGICAL_UNIT_NOT_READY, 0x01)
+        if not self._card_responding:
+            return None, (SENSE_KEY_NOT_READY, ASC_LOGICAL_UNIT_NOT_READY, 0x03)
+        if register not in self.card.registers:
+            return None, (SENSE_KEY_ILLEGAL_REQUEST, 0x24, 0x00)
+        return self.card.registers[register][:size], None
+
+    def install_sysfs(self, root, sg_name="sg0", block=None):
+        """
+        Creates the sysfs entries of this device below root, as the kernel
+        would for a USB-SD-Mux that is attached as /dev/<sg_name>.
+
+        Arguments:
+        root -- Directory to be used in place of /sys
+        sg_name -- Name of the sg-device, e.g. "sg0"
+        block -- Name of the block device, e.g. "sda", or None if no card is
+                 present
+        """
+        index = int(sg_name.removeprefix("sg"))
+        port = f"1-{index + 1}"
+        usb_device = os.path.join(root, "devices/pci0000:00/0000:00:14.0/usb1", port)
+        scsi_device = os.path.join(usb_device, f"{port}:1.0/host{index}/target{index}:0:0/{index}:0:0:0")
+
+        def write(path, content):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as fh:
+                fh.write(f"{content}\n")
+
+        def link(path, target):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.symlink(os.path.relpath(target, os.path.dirname(path)), path)
+
+        write(os.path.join(usb_device, "serial"), self.serial)
+        write(os.path.join(usb_device, "idVendor"), "0424")
+        write(os.path.join(usb_device, "idProduct"), "4041")
+        write(os.path.join(usb_device, "devpath"), index + 1)
+        write(os.path.join(usb_device, "busnum"), 1)
+        write(os.path.join(usb_device, "speed"), 480)
+        write(os.path.join(scsi_device, "vendor"), "Generic ")
+        write(os.path.join(scsi_device, "model"), self.driver._model)
+        write(os.path.join(scsi_device, "ioerr_cnt"), "0x0")
+
+        sg_device = os.path.join(scsi_device, "scsi_generic", sg_name)
+        write(os.path.join(sg_device, "dev"), f"21:{index}")
+        link(os.path.join(sg_device, "device"), scsi_device)
+        link(os.path.join(root, "class/scsi_generic", sg_name), sg_device)
+
+        if block is not None:
+            block_device = os.path.join(scsi_device, "block", block)
+            write(os.path.join(block_device, "size"), 0)
+            write(os.path.join(block_device, "stat"), " ".join(["0"] * 17))
+            link(os.path.join(block_device, "device"), scsi_device)
+            link(os.path.join(root, "class/block", block), block_device)
+
+
+def _fixed_sense(key, asc, ascq):
+    return bytes([0x70, 0, key, 0, 0, 0, 0, 10, 0, 0, 0, 0, asc, ascq, 0, 0, 0, 0])
+
+
+class InProcessTransport:
+    """
+    Base class for transports that answer the commands within this process
+    instead of passing them to the kernel, like usb2642.SgTransport does.
+
+    Subclasses implement _process(). Completions of submitted commands are
+    signaled on a pipe, so complete_all() and the asyncio interface work
+    unchanged.
+    """
+
+    def __init__(self):
+        self.generation = 0
+        self._pipe = None
+        self._completions = {}
+        self._timers = []
+
+    def open(self):
+        if self._pipe is None:
+            self._pipe = os.pipe()
+            self.generation += 1
+
+    def fileno(self):
+        self.open()
+        return self._pipe[0]
+
+    def close(self):
+        for timer in self._timers:
+            timer.cancel()
+        self._timers = []
+        self._completions = {}
+        if self._pipe is not None:
+            for fd in self._pipe:
+                os.close(fd)
+            self._pipe = None
+
+    def _process(self, sgio):
+        """
+        Executes the command described by sgio. Data read from the device is
+        written to the data buffer immediately.
+
+        Returns a tuple of the SCSI status, the sense data, the duration to be
+        reported in milliseconds and the time in seconds the command should
+        take to complete.
+        """
+        raise NotImplementedError()
+
+    def _complete(self, sgio, status, sense, duration):
+        sense = sense[: sgio.mx_sb_len]
+        ctypes.memmove(sgio.sbp, sense, len(sense))
+        sgio.sb_len_wr = len(sense)
+        sgio.status = status
+        sgio.masked_status = status >> 1
+        sgio.duration = duration
+
+    def execute(self, sgio):
+        self.open()
+        status, sense, duration, delay = self._process(sgio)
+        if delay:
+            time.sleep(delay)
+        self._complete(sgio, status, sense, duration)
+
+    def submit(self, sgio):
+        self.open()
+        status, sense, duration, delay = self._process(sgio)
+        self._completions[sgio.pack_id] = (status, sense, duration)
+
+        def signal(fd=self._pipe[1]):
+            # The transport may have been closed in the meantime
+            with contextlib.suppress(OSError):
+                os.write(fd, b"\0")
+
+        if delay:
+            timer = threading.Timer(delay, signal)
+            self._timers.append(timer)
+            timer.start()
+        else:
+            signal()
+
+    def receive(self, sgio):
+        os.read(self.fileno(), 1)
+        self._timers = [timer for timer in self._timers if timer.is_alive()]
+        self._complete(sgio, *self._completions.pop(sgio.pack_id))
+
+
+class SimulatedTransport(InProcessTransport):
+    """
+    Drop-in replacement for usb2642.SgTransport that executes the commands on
+    a SimulatedUsbSdMux instead of sending them to a /dev/sg* device.
+    """
+
+    def __init__(self, device, latency=0.0):
+        """
+        Arguments:
+        device -- SimulatedUsbSdMux to talk to
+        latency -- Time in seconds every transaction takes to complete
+        """
+        super().__init__()
+        self.device = device
+        self.latency = latency
+
+        # Number of commands executed per type: "i2c-write", "i2c-write-read",
+        # "read-register", "write-config" and "unknown"
+        self.transactions = collections.Counter()
+
+    def _process(self, sgio):
+        status, sense = self._execute_command(sgio)
+        return status, sense, round(self.latency * 1000), self.latency
+
+    def _execute_command(self, sgio):
+        """
+        Returns the SCSI status and the sense data of the command.
+        """
+        cmd = ctypes.string_at(sgio.cmdp, sgio.cmd_len)
+
+        if cmd[0] != Usb2642._USB2642SCSIOPCODE:
+            self.transactions["unknown"] += 1
+            return TransactionFailed.CHECK_CONDITION, _fixed_sense(SENSE_KEY_ILLEGAL_REQUEST, 0x20, 0x00)
+
+        with self.device.lock:
+            if cmd[1] == Usb2642._USB2642I2CWRITESTREAM:
+                self.transactions["i2c-write"] += 1
+                count = cmd[4] << 8 | cmd[5]
+                if not self.device.i2c_write(cmd[2] >> 1, ctypes.string_at(sgio.dxferp, count)):
+                    # The USB2642 reports an I2C NAK without sense data
+                    return TransactionFailed.CHECK_CONDITION, b""
+
+            elif cmd[1] == Usb2642._USB2642I2CWRITEREADSTREAM:
+                self.transactions["i2c-write-read"] += 1
+                count = cmd[4] << 8 | cmd[5]
+                data = self.device.i2c_write_read(cmd[2] >> 1, cmd[7 : 7 + cmd[6]], count)
+                if data is None:
+                    return TransactionFailed.CHECK_CONDITION, b""
+                ctypes.memmove(sgio.dxferp, data, len(data))
+
+            elif cmd[1] == Usb2642._USB2642WRITECONFIG:
+                self.transactions["write-config"] += 1
+                self.device.config = ctypes.string_at(sgio.dxferp, sgio.dxfer_len)
+
+            else:
+                self.transactions["read-register"] += 1
+                data, sense = self.device.read_card_register(cmd[1], cmd[4])
+                if sense is not None:
+                    return TransactionFailed.CHECK_CONDITION, _fixed_sense(*sense)
+                ctypes.memmove(sgio.dxferp, data, min(len(data), sgio.dxfer_len))
+
+        return 0, b""
@@ -0,0 +1,153 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+import contextlib
+import fcntl
+import os
+import time
+
+from .fileutil import write_atomic
+
+"""
+This module keeps the MQTT messages that could not be sent in a file, so the
+statistics survive an outage of the broker.
+
+The spool is a file with one message per line. New messages are appended. If
+the file would grow beyond its size limit, the oldest messages are evicted.
+The next successful publish takes the oldest messages out of the spool and
+sends them as well.
+
+Several processes may use the same spool at once: every access holds an
+exclusive lock on a separate lock file.
+"""
+
+DEFAULT_MAX_BYTES = 1024 * 1024
+
+# Number of spooled messages sent along with every successful publish
+BATCH_SIZE = 100
+
+
+class Spool:
+    """
+    A size-capped on-disk queue of MQTT messages.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Arguments:
+        path -- File to store the messages in
+        max_bytes -- Maximum size of the file. The oldest messages are evicted
+                     to stay below it.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.evicted = 0
+
+    @contextlib.contextmanager
+    def _locked(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def _read(self):
+        try:
+            with open(self.path, "rb") as fh:
+                return fh.read().splitlines()
+        except FileNotFoundError:
+            return []
+
+    def _write(self, records):
+        # Replace the file atomically, so a crash does not lose the spool
+        write_atomic(self.path, b"".join(record + b"\n" for record in records))
+
+    def _trim(self, records):
+        # Evict the oldest records until the rest fits into max_bytes
+        size = sum(len(record) + 1 for record in records)
+        evict = 0
+        while size > self.max_bytes and evict < len(records):
+            size -= len(records[evict]) + 1
+            evict += 1
+        self.evicted += evict
+        return records[evict:]
+
+    @staticmethod
+    def _encode(payload):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        if b"\n" in payload:
+            raise ValueError("Spooled messages must not contain newlines")
+        return payload
+
+    def extend(self, payloads):
+        """
+        Appends the given messages (str or bytes) to the spool, evicting the
+        oldest messages if the spool would grow too large.
+        """
+        new = [self._encode(payload) for payload in payloads]
+        if not new:
+            return
+
+        with self._locked():
+            try:
+                size = os.path.getsize(self.path)
+            except FileNotFoundError:
+                size = 0
+
+            if size + sum(len(record) + 1 for record in new) <= self.max_bytes:
+                with open(self.path, "ab") as fh:
+                    fh.write(b"".join(record + b"\n" for record in new))
+                return
+
+            self._write(self._trim(self._read() + new))
+
+    def append(self, payload):
+        self.extend([payload])
+
+    def take(self, limit=BATCH_SIZE):
+        """
+        Removes and returns up to limit of the oldest messages as bytes.
+        """
+        with self._locked():
+            records = self._read()
+            if not records:
+                return []
+            self._write(records[limit:])
+            return records[:limit]
+
+    def restore(self, payloads):
+        """
+        Puts messages returned by take() back to the front of the spool,
+        e.g. if sending them failed.
+        """
+        if not payloads:
+            return
+        with self._locked():
+            self._write(self._trim([self._encode(payload) for payload in payloads] + self._read()))
+
+    def __len__(self):
+        with self._locked():
+            return len(self._read())
+
+    def mark_failed(self):
+        """
+        Records that the broker was not reachable just now.
+        """
+        with open(self.path + ".failed", "w"):
+            pass
+        os.utime(self.path + ".failed")
+
+    def mark_succeeded(self):
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.path + ".failed")
+
+    def backing_off(self, interval):
+        """
+        Returns True if the broker was unreachable less than interval seconds
+        ago. Messages should then be spooled without trying to connect.
+        """
+        try:
+            failed = os.path.getmtime(self.path + ".failed")
+        except FileNotFoundError:
+            return False
+        return time.time() - failed < interval
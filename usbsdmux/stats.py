@@ -0,0 +1,287 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+import bisect
+import contextlib
+import fcntl
+import json
+import os
+
+from .fileutil import write_atomic
+
+"""
+This module collects latency statistics of the commands sent to a USB2642.
+
+For every type of command the number of commands, failures and retries as
+well as histograms of the duration reported by the kernel and of the time
+measured from issuing the command until its completion are kept. Together
+with the time spent waiting in sleeps this shows whether slow switches are
+caused by the USB link, the SD-Card or by the software itself.
+"""
+
+# Upper bounds of the histogram buckets in seconds. An additional bucket
+# collects everything above the last bound.
+BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+OPERATIONS = ("i2c-write", "i2c-write-read", "read-register", "write-config")
+
+
+class Histogram:
+    """
+    Counts values in buckets with fixed upper bounds.
+    """
+
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other):
+        for i, count in enumerate(other.buckets):
+            self.buckets[i] += count
+        self.count += other.count
+        self.sum += other.sum
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def quantile(self, q):
+        """
+        Returns the upper bound of the bucket the q-quantile falls into,
+        infinity if it is above the last bound or None if nothing has been
+        observed.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.buckets, strict=False):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def to_dict(self):
+        return {"bounds": list(self.bounds), "buckets": list(self.buckets), "count": self.count, "sum": self.sum}
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls(tuple(data["bounds"]))
+        histogram.buckets = list(data["buckets"])
+        histogram.count = data["count"]
+        histogram.sum = data["sum"]
+        return histogram
+
+
+class OperationStats:
+    """
+    Statistics of a single type of command.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.failures = 0
+        self.retries = 0
+        # Duration as reported by the kernel
+        self.duration = Histogram()
+        # Time from issuing the command until its completion has been received
+        self.latency = Histogram()
+
+    def merge(self, other):
+        self.count += other.count
+        self.failures += other.failures
+        self.retries += other.retries
+        self.duration.merge(other.duration)
+        self.latency.merge(other.latency)
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "failures": self.failures,
+            "retries": self.retries,
+            "duration": self.duration.to_dict(),
+            "latency": self.latency.to_dict(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        stats.count = data["count"]
+        stats.failures = data["failures"]
+        stats.retries = data["retries"]
+        stats.duration = Histogram.from_dict(data["duration"])
+        stats.latency = Histogram.from_dict(data["latency"])
+        return stats
+
+
+class TransactionStats:
+    """
+    Statistics of all commands sent by a Usb2642, of the time spent in sleeps,
+    e.g. waiting for the SD-Card to discharge or between retries, and of the
+    mode switches performed using these commands.
+    """
+
+    def __init__(self):
+        self.operations = {operation: OperationStats() for operation in OPERATIONS}
+        self.sleeps = {}
+        self.switches = {}
+
+    def record(self, operation, latency, duration, failed):
+        """
+        Arguments:
+        operation -- One of OPERATIONS
+        latency -- Time in seconds from issuing the command until its completion
+        duration -- Duration of the command in seconds as reported by the kernel
+        failed -- True if the command did not complete successfully
+        """
+        stats = self.operations[operation]
+        stats.count += 1
+        stats.latency.observe(latency)
+        stats.duration.observe(duration)
+        if failed:
+            stats.failures += 1
+
+    def reset(self):
+        """
+        Forgets everything recorded so far, e.g. after it has been stored.
+        """
+        self.__init__()
+
+    def record_retry(self, operation):
+        self.operations[operation].retries += 1
+
+    def record_sleep(self, reason, seconds):
+        """
+        Arguments:
+        reason -- Name of the sleep, e.g. "discharge" or "retry"
+        seconds -- Time slept
+        """
+        if reason not in self.sleeps:
+            self.sleeps[reason] = Histogram()
+        self.sleeps[reason].observe(seconds)
+
+    def record_switch(self, mode, seconds):
+        """
+        Arguments:
+        mode -- The mode that has been switched to, e.g. "host"
+        seconds -- Time the switch took, including all sleeps
+        """
+        if mode not in self.switches:
+            self.switches[mode] = Histogram()
+        self.switches[mode].observe(seconds)
+
+    def merge(self, other):
+        for operation, stats in other.operations.items():
+            self.operations.setdefault(operation, OperationStats()).merge(stats)
+        for reason, histogram in other.sleeps.items():
+            self.sleeps.setdefault(reason, Histogram(histogram.bounds)).merge(histogram)
+        for mode, histogram in other.switches.items():
+            self.switches.setdefault(mode, Histogram(histogram.bounds)).merge(histogram)
+
+    def to_dict(self):
+        return {
+            "operations": {operation: stats.to_dict() for operation, stats in self.operations.items()},
+            "sleeps": {reason: histogram.to_dict() for reason, histogram in self.sleeps.items()},
+            "switches": {mode: histogram.to_dict() for mode, histogram in self.switches.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        for operation, operation_stats in data["operations"].items():
+            stats.operations[operation] = OperationStats.from_dict(operation_stats)
+        for reason, histogram in data["sleeps"].items():
+            stats.sleeps[reason] = Histogram.from_dict(histogram)
+        # Not present in files written by older versions
+        for mode, histogram in data.get("switches", {}).items():
+            stats.switches[mode] = Histogram.from_dict(histogram)
+        return stats
+
+    def to_text(self):
+        """
+        Returns a human readable summary as list of lines.
+        """
+
+        def ms(value):
+            if value is None:
+                return "-"
+            if value == float("inf"):
+                return f">{BUCKETS[-1] * 1000:g}"
+            return f"{value * 1000:.1f}"
+
+        lines = [
+            f"{'operation':<16}{'count':>8}{'failed':>8}{'retries':>8}"
+            f"{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}{'kernel ms':>11}"
+        ]
+        for operation, stats in self.operations.items():
+            lines.append(
+                f"{operation:<16}{stats.count:>8}{stats.failures:>8}{stats.retries:>8}"
+                f"{ms(stats.latency.mean):>10}{ms(stats.latency.quantile(0.5)):>10}"
+                f"{ms(stats.latency.quantile(0.99)):>10}{ms(stats.duration.mean):>11}"
+            )
+
+        for title, histograms in (("sleep", self.sleeps), ("switch", self.switches)):
+            if not histograms:
+                continue
+            lines.append("")
+            lines.append(f"{title:<16}{'count':>8}{'total ms':>16}{'mean ms':>10}{'p99 ms':>10}")
+            for name, histogram in histograms.items():
+                lines.append(
+                    f"{name:<16}{histogram.count:>8}{ms(histogram.sum):>16}"
+                    f"{ms(histogram.mean):>10}{ms(histogram.quantile(0.99)):>10}"
+                )
+
+        return lines
+
+
+class StatsFile:
+    """
+    Accumulates the TransactionStats of several processes in a JSON file,
+    using the USB serial number of the USB-SD-Mux as key.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    @contextlib.contextmanager
+    def _locked(self):
+        dirname = os.path.dirname(os.path.abspath(self.filename))
+        os.makedirs(dirname, exist_ok=True)
+        with open(self.filename + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def _load(self):
+        try:
+            with open(self.filename) as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return {}
+
+    def get(self, serial):
+        """
+        Returns the accumulated TransactionStats of a device.
+        """
+        data = self._load().get(serial)
+        if data is None:
+            return TransactionStats()
+        return TransactionStats.from_dict(data)
+
+    def add(self, serial, stats):
+        """
+        Adds stats to the accumulated statistics of a device.
+        """
+        with self._locked():
+            data = self._load()
+            total = TransactionStats.from_dict(data[serial]) if serial in data else TransactionStats()
+            total.merge(stats)
+            data[serial] = total.to_dict()
+
+            write_atomic(self.filename, json.dumps(data))
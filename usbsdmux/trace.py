@@ -0,0 +1,231 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+# SPDX-FileCopyrightText: 2026 The USB-SD-Mux Authors
+
+import ctypes
+import struct
+import time
+
+from .simulation import InProcessTransport
+from .usb2642 import Usb2642
+
+"""
+This module records the SCSI commands exchanged with a USB-SD-Mux to a trace
+file and replays them later without the hardware.
+
+Traces taken on real setups (slow cards, flaky hubs, ...) can be used to
+reproduce timing sensitive behavior and to benchmark changes against real
+world latencies on any machine.
+
+The trace file starts with _FILE_HEADER, followed by one record per command:
+
+* _RECORD_HEADER: flags, data direction, SCSI status, length of the command,
+  sense, data-out and data-in data, the duration reported by the kernel in
+  milliseconds and the wall clock time the command took in microseconds
+* The command, data-out, data-in and sense data
+
+Trailing zeros of the data buffers are not stored, as Usb2642 pads all data
+buffers with zeros.
+"""
+
+_FILE_HEADER = b"USBSDMUX-TRACE\x00\x01"
+_RECORD_HEADER = struct.Struct("<BbBBBHHII")
+
+# Record flags
+_FLAG_ASYNC = 0x01
+
+
+class TraceMismatch(Exception):
+    pass
+
+
+class TraceRecord:
+    """
+    A single command in a trace file.
+    """
+
+    def __init__(self, asynchronous, direction, cmd, data_out, data_in, status, sense, duration, elapsed):
+        self.asynchronous = asynchronous
+        self.direction = direction
+        self.cmd = cmd
+        self.data_out = data_out
+        self.data_in = data_in
+        self.status = status
+        self.sense = sense
+        # Duration of the command as reported by the kernel in milliseconds
+        self.duration = duration
+        # Time in seconds from submitting the command until its completion
+        self.elapsed = elapsed
+
+    def pack(self):
+        flags = _FLAG_ASYNC if self.asynchronous else 0
+        header = _RECORD_HEADER.pack(
+            flags,
+            self.direction,
+            self.status,
+            len(self.cmd),
+            len(self.sense),
+            len(self.data_out),
+            len(self.data_in),
+            self.duration,
+            min(round(self.elapsed * 1_000_000), 0xFFFFFFFF),
+        )
+        return header + self.cmd + self.data_out + self.data_in + self.sense
+
+
+def read_trace(filename):
+    """
+    Yields the TraceRecords stored in a trace file.
+    """
+    with open(filename, "rb") as fh:
+        if fh.read(len(_FILE_HEADER)) != _FILE_HEADER:
+            raise TraceMismatch(f"{filename} is not a USB-SD-Mux trace file")
+
+        while header := fh.read(_RECORD_HEADER.size):
+            if len(header) != _RECORD_HEADER.size:
+                raise TraceMismatch(f"{filename} ends with a truncated record")
+            flags, direction, status, cmd_len, sense_len, out_len, in_len, duration, elapsed = _RECORD_HEADER.unpack(
+                header
+            )
+            payload = fh.read(cmd_len + out_len + in_len + sense_len)
+            if len(payload) != cmd_len + out_len + in_len + sense_len:
+                raise TraceMismatch(f"{filename} ends with a truncated record")
+
+            data_in_start = cmd_len + out_len
+            sense_start = data_in_start + in_len
+            yield TraceRecord(
+                asynchronous=bool(flags & _FLAG_ASYNC),
+                direction=direction,
+                cmd=payload[:cmd_len],
+                data_out=payload[cmd_len:data_in_start],
+                data_in=payload[data_in_start:sense_start],
+                status=status,
+                sense=payload[sense_start:],
+                duration=duration,
+                elapsed=elapsed / 1_000_000,
+            )
+
+
+def _data_out(sgio):
+    if sgio.dxfer_direction != Usb2642._SG_DXFER_TO_DEV:
+        return b""
+    return ctypes.string_at(sgio.dxferp, sgio.dxfer_len).rstrip(b"\0")
+
+
+def _data_in(sgio):
+    if sgio.dxfer_direction != Usb2642._SG_DXFER_FROM_DEV:
+        return b""
+    return ctypes.string_at(sgio.dxferp, sgio.dxfer_len).rstrip(b"\0")
+
+
+class RecordingTransport:
+    """
+    Passes all commands to another transport and records them, their results
+    and their timing to a trace file.
+    """
+
+    def __init__(self, transport, filename):
+        """
+        Arguments:
+        transport -- The transport to record, e.g. usb2642.SgTransport
+        filename -- Trace file to create. An existing file is overwritten.
+        """
+        self.transport = transport
+        self.filename = filename
+        self._fh = None
+        self._submitted = {}
+
+        with open(filename, "wb") as fh:
+            fh.write(_FILE_HEADER)
+
+    @property
+    def generation(self):
+        return self.transport.generation
+
+    def open(self):
+        self.transport.open()
+
+    def fileno(self):
+        return self.transport.fileno()
+
+    def close(self):
+        self.transport.close()
+        self._submitted = {}
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def _record(self, sgio, asynchronous, cmd, data_out, elapsed):
+        record = TraceRecord(
+            asynchronous=asynchronous,
+            direction=sgio.dxfer_direction,
+            cmd=cmd,
+            data_out=data_out,
+            data_in=_data_in(sgio),
+            status=sgio.status,
+            sense=ctypes.string_at(sgio.sbp, sgio.sb_len_wr),
+            duration=sgio.duration,
+            elapsed=elapsed,
+        )
+
+        # The trace is flushed after every record, so it is complete even if
+        # the process does not terminate cleanly.
+        if self._fh is None:
+            self._fh = open(self.filename, "ab")  # noqa: SIM115
+        self._fh.write(record.pack())
+        self._fh.flush()
+
+    def execute(self, sgio):
+        cmd = ctypes.string_at(sgio.cmdp, sgio.cmd_len)
+        data_out = _data_out(sgio)
+        start = time.monotonic()
+        self.transport.execute(sgio)
+        self._record(sgio, False, cmd, data_out, time.monotonic() - start)
+
+    def submit(self, sgio):
+        cmd = ctypes.string_at(sgio.cmdp, sgio.cmd_len)
+        data_out = _data_out(sgio)
+        start = time.monotonic()
+        self.transport.submit(sgio)
+        self._submitted[sgio.pack_id] = (cmd, data_out, start)
+
+    def receive(self, sgio):
+        self.transport.receive(sgio)
+        cmd, data_out, start = self._submitted.pop(sgio.pack_id)
+        self._record(sgio, True, cmd, data_out, time.monotonic() - start)
+
+
+class ReplayTransport(InProcessTransport):
+    """
+    Answers commands with the results stored in a trace file.
+
+    The commands have to be issued in the same order as they were recorded.
+    A TraceMismatch is raised as soon as a command or its data-out phase
+    differs from the trace.
+    """
+
+    def __init__(self, filename, realtime=False):
+        """
+        Arguments:
+        filename -- Trace file created by RecordingTransport
+        realtime -- Make every command take as long as it did while recording
+        """
+        super().__init__()
+        self.realtime = realtime
+        self._records = iter(list(read_trace(filename)))
+        self.replayed = 0
+
+    def _process(self, sgio):
+        record = next(self._records, None)
+        if record is None:
+            raise TraceMismatch(f"Trace exhausted after {self.replayed} commands")
+
+        cmd = ctypes.string_at(sgio.cmdp, sgio.cmd_len)
+        if cmd != record.cmd or _data_out(sgio) != record.data_out:
+            raise TraceMismatch(f"Command {self.replayed} ({cmd.hex()}) does not match the trace ({record.cmd.hex()})")
+
+        if sgio.dxfer_direction == Usb2642._SG_DXFER_FROM_DEV:
+            ctypes.memset(sgio.dxferp, 0, sgio.dxfer_len)
+            ctypes.memmove(sgio.dxferp, record.data_in, min(len(record.data_in), sgio.dxfer_len))
+
+        self.replayed += 1
+        return record.status, record.sense, record.duration, record.elapsed if self.realtime else 0
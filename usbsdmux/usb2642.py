@@ -4,12 +4,16 @@
 # SPDX-FileCopyrightText: 2017 The USB-SD-Mux Authors
 
 import ctypes
+import errno
 import fcntl
+import os
+import select
+import struct
+import time
 from time import sleep
 
-from .ctypehelper import (
-    list_to_uint8_array,
-)
+from .sense import SenseData
+from .stats import TransactionStats
 
 """
 This modules provides an interface to use the auxiliary and configuration
@@ -25,14 +29,321 @@ class IoctlFailed(Exception):
     pass
 
 
-class I2cTransactionFailed(Exception):
+class TransactionFailed(Exception):
+    """
+    A SCSI transaction has ended with a non-zero status.
+
+    Attributes:
+    status -- The SCSI status
+    sense -- The decoded SenseData or None if the device did not return any
+    """
+
+    """SCSI status CHECK CONDITION: Details can be found in the sense data"""
+    CHECK_CONDITION = 0x02
+
+    """SCSI status BUSY"""
+    BUSY = 0x08
+
+    """Whether a CHECK CONDITION without sense data is worth a retry"""
+    _transient_without_sense = False
+
+    def __init__(self, message, status=None, sense=None):
+        super().__init__(message)
+        self.status = status
+        self.sense = sense
+
+    @classmethod
+    def _is_transient(cls, status, sense):
+        if status == cls.BUSY:
+            return True
+        if sense is not None:
+            return sense.transient
+        return status == cls.CHECK_CONDITION and cls._transient_without_sense
+
+    @property
+    def transient(self):
+        """
+        True if retrying the transaction later may succeed, e.g. because the
+        SD-Card is still initializing. False for permanent failures like
+        a missing card or an I2C device that does not acknowledge.
+        """
+        return self._is_transient(self.status, self.sense)
+
+
+class I2cTransactionFailed(TransactionFailed):
     pass
 
 
-class SDTransactionFailed(Exception):
+class SDTransactionFailed(TransactionFailed):
+    # The USB2642 does not always provide sense data while the card is
+    # initializing.
+    _transient_without_sense = True
+
+
+class SDCardNotReady(SDTransactionFailed):
     pass
 
 
+class MediumNotPresent(SDTransactionFailed):
+    pass
+
+
+def _status_text(status, sense):
+    if sense is None:
+        return f"status {status}"
+    return f"status {status} ({sense})"
+
+
+class TransactionPending(Exception):
+    pass
+
+
+class RetryPolicy:
+    """
+    Describes how a command is retried while the SD-Card is becoming ready.
+
+    The first retry is started after initial_delay seconds. The delay is
+    multiplied by multiplier after every attempt, but never exceeds max_delay.
+    No retry is started after deadline seconds since the first attempt.
+    """
+
+    def __init__(self, initial_delay=0.005, multiplier=2.0, max_delay=0.25, deadline=3.0):
+        self.initial_delay = initial_delay
+        self.multiplier = multiplier
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def delays(self):
+        """
+        Yields the time to wait before each retry until the deadline is reached.
+        The deadline starts when this generator is created.
+        """
+        end = time.monotonic() + self.deadline
+        delay = self.initial_delay
+        while True:
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return
+            yield min(delay, remaining)
+            delay = min(delay * self.multiplier, self.max_delay)
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
+class SgRequest:
+    """
+    A SCSI command that has been submitted to a Usb2642 using one of the
+    submit_*() methods, but whose completion has not been collected yet.
+
+    Use complete_all() to wait for several requests on different devices at
+    once, or result() to wait for this request alone.
+    """
+
+    def __init__(self, usb, pack_id, finish):
+        self.usb = usb
+        self.pack_id = pack_id
+        self.done = False
+        self._finish = finish
+        self._result = None
+        self._exception = None
+
+    def fileno(self):
+        return self.usb.fileno()
+
+    def _complete(self, sgio):
+        try:
+            self._result = self._finish(sgio)
+        except Exception as e:
+            self._exception = e
+        self.done = True
+
+    def _fail(self, exception):
+        self._exception = exception
+        self.done = True
+
+    def result(self, timeout=None):
+        """
+        Returns the result of the command, waiting for its completion if
+        necessary. Raises the exception the command has failed with.
+        """
+        if not self.done:
+            complete_all([self], timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+def complete_all(requests, timeout=None):
+    """
+    Waits until all given requests have completed and returns their results
+    in the same order.
+
+    The commands are already in flight once they have been submitted, so
+    requests on different USB2642s are processed by the kernel concurrently.
+    This function only polls the file descriptors and collects the
+    completions as they arrive.
+
+    Arguments:
+    requests -- iterable of SgRequest as returned by Usb2642.submit_*()
+    timeout -- Maximum time to wait in seconds or None to wait forever
+    """
+    requests = list(requests)
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    poller = select.poll()
+    pending = {}
+    for request in requests:
+        if not request.done:
+            fd = request.fileno()
+            pending[fd] = request
+            poller.register(fd, select.POLLIN)
+
+    while pending:
+        if deadline is None:
+            events = poller.poll()
+        else:
+            remaining = deadline - time.monotonic()
+            events = poller.poll(max(0, int(remaining * 1000))) if remaining > 0 else []
+            if not events:
+                error = TimeoutError(f"{len(pending)} SCSI command(s) did not complete in time")
+                # Do not leave the devices blocked by commands nobody waits for
+                for request in pending.values():
+                    request.usb._abandon(error)
+                raise error
+
+        for fd, _ in events:
+            request = pending.pop(fd)
+            poller.unregister(fd)
+            request.usb._receive()
+
+    return [request.result() for request in requests]
+
+
+class SgTransport:
+    """
+    Passes the sg_io_hdr structures prepared by a Usb2642 to a /dev/sg* device.
+
+    Commands are either executed synchronously using the SG_IO ioctl() or
+    submitted using write() and collected using read(), so that many devices
+    can be driven at once.
+
+    The sg-device is opened on first use and kept open until close() is called.
+    """
+
+    """
+    errno values returned by the sg driver once the device behind an open file
+    descriptor has gone away (e.g. because the USB-SD-Mux was re-enumerated).
+    """
+    _STALE_ERRNOS = (errno.ENODEV, errno.ENXIO)
+
+    """IOCTL for SG_IO"""
+    _SG_IO = 0x2285  # <scsi/sg.h>
+
+    """IOCTL to make read() only return responses to a matching pack_id"""
+    _SG_SET_FORCE_PACK_ID = 0x227B  # <scsi/sg.h>
+
+    def __init__(self, sg, sysfs="/sys"):
+        """
+        Arguments:
+        sg -- The sg-device to use. E.g. "/dev/sg1"
+        sysfs -- Mount point of sysfs, used to identify the USB device
+        """
+        self.sg = sg
+        self.sysfs = sysfs
+        self._fh = None
+        # Identity of the USB device the sg-device belonged to when opened
+        self._identity = None
+
+        # Incremented every time the sg-device is (re-)opened.
+        self.generation = 0
+
+    def _usb_identity(self):
+        """
+        Returns the sysfs path and the serial number of the USB device behind
+        the sg-device or None if they can not be determined.
+        """
+        # usbsdmux.py imports this module
+        from .usbsdmux import usb_device_path
+
+        usb_path = usb_device_path(self.sg, self.sysfs)
+        if usb_path is None:
+            return None
+        try:
+            with open(os.path.join(usb_path, "serial")) as fh:
+                return usb_path, fh.read().strip()
+        except OSError:
+            return None
+
+    def open(self):
+        """
+        Opens the sg-device if it is not already open and returns the file object.
+        """
+        if self._fh is None:
+            self._identity = self._usb_identity()
+            self._fh = open(self.sg, "r+b", buffering=0)  # noqa: SIM115
+            self.generation += 1
+            # Make read() only return the response to the pack_id we ask for.
+            fcntl.ioctl(self._fh, self._SG_SET_FORCE_PACK_ID, struct.pack("i", 1))
+        return self._fh
+
+    def fileno(self):
+        """
+        Returns the file descriptor, which becomes readable once a submitted
+        command has completed.
+        """
+        return self.open().fileno()
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def _on_fd(self, operation, *args):
+        """
+        Calls operation(fd, *args) on the file descriptor of the sg-device.
+
+        If this fails because the device behind the file descriptor is gone,
+        the sg-device is reopened and the operation is tried again once, but
+        only if it still belongs to the same USB device. sg numbers are reused,
+        so after a re-enumeration the path may belong to another USB-SD-Mux.
+        """
+        try:
+            return operation(self.fileno(), *args)
+        except OSError as e:
+            if e.errno not in self._STALE_ERRNOS:
+                raise
+            identity = self._identity
+            self.close()
+            if identity is None or self._usb_identity() != identity:
+                raise IoctlFailed(f"The USB device behind {self.sg} has gone away") from e
+            return operation(self.fileno(), *args)
+
+    def execute(self, sgio):
+        """
+        Executes the command described by sgio and waits for its completion.
+        The result is stored in sgio and the buffers it points to.
+        """
+        rc = self._on_fd(fcntl.ioctl, self._SG_IO, sgio)
+        if rc != 0:
+            raise IoctlFailed(f"SG_IO ioctl() failed with non-zero exit-code {rc}")
+
+    def submit(self, sgio):
+        """
+        Starts the command described by sgio without waiting for its completion.
+        """
+        written = self._on_fd(os.write, sgio)
+        if written != ctypes.sizeof(sgio):
+            raise IoctlFailed(f"write() to sg-device returned {written} instead of {ctypes.sizeof(sgio)}")
+
+    def receive(self, sgio):
+        """
+        Waits for the completion of the submitted command with sgio.pack_id and
+        stores its result in sgio.
+        """
+        os.readv(self.fileno(), [sgio])
+
+
 class Usb2642:
     """
     This class provides an interface to interact with devices on a Microchip
@@ -63,16 +374,87 @@ class Usb2642:
     This class uses the /dev/sg* -Interface to access the SCSI-device even if no
     media is present.
     Make sure you have rw-rights :)
+
+    The sg-device is opened on first use and kept open until close() is called.
+    Instances can also be used as a context manager to make sure the file
+    descriptor is released.
     """
 
-    def __init__(self, sg):
+    def __init__(self, sg, retry_policy=DEFAULT_RETRY_POLICY, transport=None):
         """
         Create a new USB2642-Interface wrapper.
 
         Arguments:
         sg -- The sg-device to use. E.g. "/dev/sg1"
+        retry_policy -- RetryPolicy for transactions that failed with a
+                        transient error, e.g. while the card is becoming ready
+        transport -- Object that passes the commands to the device. Defaults
+                     to an SgTransport for sg. See simulation.py for an
+                     alternative that does not need any hardware.
         """
         self.sg = sg
+        self.retry_policy = retry_policy
+        self.transport = transport if transport is not None else SgTransport(sg)
+
+        # All buffers needed for a transaction are allocated once and patched
+        # in place for every command. The SCSI command is accessed via one of
+        # the overlay structures, depending on the type of command.
+        self._cmd = (ctypes.c_uint8 * self._CMD_LEN)()
+        self._i2c_write_cmd = self._USB2642I2cWriteStruct.from_buffer(self._cmd)
+        self._i2c_write_read_cmd = self._USB2642I2cReadStruct.from_buffer(self._cmd)
+
+        self._sense = ctypes.c_buffer(self._SENSE_LEN)
+
+        self._data_raw = bytearray(self._DATA_LEN)
+        self._data = (ctypes.c_uint8 * self._DATA_LEN).from_buffer(self._data_raw)
+        self._data_view = memoryview(self._data_raw)
+
+        self._sgio = self._get_SGIO(self._cmd, self._sense, self._data)
+
+        # Submitted, but not yet received command (see submit_*())
+        self._pending = None
+        self._pack_id = 0
+        self._submitted_at = None
+
+        # Latencies of all commands sent by this instance
+        self.stats = TransactionStats()
+
+    @property
+    def generation(self):
+        """
+        Incremented every time the device is (re-)opened. Allows users to
+        detect that the device may have been re-enumerated in the meantime.
+        """
+        return self.transport.generation
+
+    def open(self):
+        """
+        Opens the sg-device if it is not already open.
+        """
+        self.transport.open()
+
+    def fileno(self):
+        """
+        Returns the file descriptor of the sg-device. Opens the device if needed.
+        The descriptor becomes readable once a submitted command has completed.
+        """
+        return self.transport.fileno()
+
+    def close(self):
+        """
+        Closes the sg-device. It will be reopened on the next transaction.
+        """
+        if self._pending is not None:
+            self._pending._fail(IoctlFailed("sg-device was closed before the command completed"))
+            self._pending = None
+        self.transport.close()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     class _SgioHdrStruct(ctypes.Structure):
         """
@@ -119,9 +501,6 @@ class Usb2642:
         assert ctypes.sizeof(ctypes.c_void_p) == 8
         assert ctypes.sizeof(_SgioHdrStruct) == 88
 
-    """IOCTL for SG_IO"""
-    _SG_IO = 0x2285  # <scsi/sg.h>
-
     """SgioHdr dxfer direction constant: No direction"""
     _SG_DXFER_NONE = -1
 
@@ -149,6 +528,12 @@ class Usb2642:
     """
     _USB2642I2CWRITEREADSTREAM = 0x22
 
+    """
+    This Vendor Action writes the configuration EEPROM.
+    It was found on the USB-Bus, see write_config().
+    """
+    _USB2642WRITECONFIG = 0x54
+
     class _USB2642I2cWriteStruct(ctypes.Structure):
         """I2C-Write Data Structure for up to 512 Bytes of Data
 
@@ -188,82 +573,89 @@ class Usb2642:
 
     assert ctypes.sizeof(_USB2642I2cReadStruct) == 16
 
+    """Length of the SCSI command block"""
+    _CMD_LEN = 16
+
+    """Length of the sense buffer"""
+    _SENSE_LEN = 64
+
+    """Maximum length of the data phase of a single transaction"""
+    _DATA_LEN = 512
+
+    """Maximum length of the write phase of an I2C write-read transaction"""
+    _WRITE_READ_MAXLEN = 9
+
+    def _set_data(self, data, length):
+        """
+        Copies data to the start of the data buffer and clears the remainder of
+        the first length bytes.
+        """
+        count = min(len(data), length)
+        self._data_raw[:count] = data[:count]
+        ctypes.memset(ctypes.addressof(self._data) + count, 0, length - count)
+
     def _get_SCSI_cmd_I2C_write(self, slaveAddr, data):
         """
-        Create an I2cWrite Command Structure to write up to 512 bytes to device
-        slaveAddr.
+        Fill the I2cWrite Command Structure to write up to 512 bytes to device
+        slaveAddr and copy data to the data buffer.
 
         According to: 'Microchip: I2C_Over_USB_UserGuilde_50002283A.pdf' P.20
         """
-        MAXLEN = 512
-        count = min(len(data), MAXLEN)
-        dataArray = (ctypes.c_uint8 * MAXLEN)()
-        dataArray[:count] = data[:count]
+        count = min(len(data), self._DATA_LEN)
+        self._set_data(data, self._DATA_LEN)
 
-        slaveWriteAddr = (slaveAddr * 2) & 0xFF
-
-        cmd = self._USB2642I2cWriteStruct(
-            ScsiVendorCommand=self._USB2642SCSIOPCODE,
-            ScsiVendorActionWriteI2C=self._USB2642I2CWRITESTREAM,
-            I2cSlaveAddress=slaveWriteAddr,
-            I2cUnused=0x00,
-            I2cDataPhaseLenHigh=(count >> 8) & 0xFF,
-            I2cDataPhaseLenLow=count & 0xFF,
-            I2cCommandPhaseLen=0x00,
-            I2cCommandPayload=(ctypes.c_uint8 * 9)(),
-        )
+        ctypes.memset(self._cmd, 0, self._CMD_LEN)
+        cmd = self._i2c_write_cmd
+        cmd.ScsiVendorCommand = self._USB2642SCSIOPCODE
+        cmd.ScsiVendorActionWriteI2C = self._USB2642I2CWRITESTREAM
+        cmd.I2cSlaveAddress = (slaveAddr * 2) & 0xFF
+        cmd.I2cDataPhaseLenHigh = (count >> 8) & 0xFF
+        cmd.I2cDataPhaseLenLow = count & 0xFF
 
-        return cmd, dataArray
+        return cmd, self._data
 
     def _get_SCSI_cmd_I2C_write_read(self, slaveAddr, writeData, readLength):
         """
-        Create an I2cWriteRead Command Structure to write up to 9 bytes to device
+        Fill the I2cWriteRead Command Structure to write up to 9 bytes to device
         slaveAddr and then read back up to 512 bytes of data.
 
         According to: 'Microchip: I2C_Over_USB_UserGuilde_50002283A.pdf' P.20
         """
-        MAXLEN = 512
-        readCount = min(readLength, MAXLEN)
-        readDataArray = (ctypes.c_uint8 * MAXLEN)()
-
-        MAXLEN = 9
-        writeCount = min(len(writeData), MAXLEN)
-        writeDataArray = (ctypes.c_uint8 * MAXLEN)()
-        writeDataArray[:writeCount] = writeData[:writeCount]
+        readCount = min(readLength, self._DATA_LEN)
+        writeCount = min(len(writeData), self._WRITE_READ_MAXLEN)
+        ctypes.memset(self._data, 0, self._DATA_LEN)
 
+        ctypes.memset(self._cmd, 0, self._CMD_LEN)
         slaveWriteAddr = (slaveAddr * 2) & 0xFF
-        slaveReadAddr = slaveWriteAddr + 1
-
-        cmd = self._USB2642I2cReadStruct(
-            ScsiVendorCommand=self._USB2642SCSIOPCODE,
-            ScsiVendorActionWriteReadI2C=self._USB2642I2CWRITEREADSTREAM,
-            I2cWriteSlaveAddress=slaveWriteAddr,
-            I2cReadSlaveAddress=slaveReadAddr,
-            I2cReadPhaseLenHigh=(readCount >> 8) & 0xFF,
-            I2cReadPhaseLenLow=readCount & 0xFF,
-            I2cWritePhaseLen=writeCount,
-            I2cWritePayload=writeDataArray,
-        )
 
-        return cmd, readDataArray
+        cmd = self._i2c_write_read_cmd
+        cmd.ScsiVendorCommand = self._USB2642SCSIOPCODE
+        cmd.ScsiVendorActionWriteReadI2C = self._USB2642I2CWRITEREADSTREAM
+        cmd.I2cWriteSlaveAddress = slaveWriteAddr
+        cmd.I2cReadSlaveAddress = slaveWriteAddr + 1
+        cmd.I2cReadPhaseLenHigh = (readCount >> 8) & 0xFF
+        cmd.I2cReadPhaseLenLow = readCount & 0xFF
+        cmd.I2cWritePhaseLen = writeCount
+        cmd.I2cWritePayload[:writeCount] = writeData[:writeCount]
+
+        return cmd, self._data
 
-    def _get_SGIO(self, command, Sg_Dxfer, databuffer):
-        """Fill the SG_IO ioctl() -structure with sane defaults for the given
-        command.
-        The command will create a 64-byte sense-buffer for returned status.
+    def _get_SGIO(self, command, sense, databuffer):
+        """Create the SG_IO ioctl() -structure with sane defaults.
+        The structure is only created once per instance and points to the
+        preallocated command, sense and data buffers.
+        _call_IOCTL() patches the direction and length for each transaction.
 
         Arguments:
-        command -- SCSI-Command to use. ctypes.c_uint8
-        Sg_Dxfer -- _SG_DXFER_* to set the direction of the SCSI transfer.
+        command -- 16 byte buffer for the SCSI-Command.
+        sense -- 64 byte buffer for the returned status.
         databuffer -- 512 bytes buffer of the block to read or write.
         """
-        sense = ctypes.c_buffer(64)
-
         sgio = self._SgioHdrStruct(
             # "S" for SCSI
             interface_id=ord("S"),
             # SG_DXFER_*
-            dxfer_direction=Sg_Dxfer,
+            dxfer_direction=self._SG_DXFER_NONE,
             # length of whatever we put into cmd
             cmd_len=ctypes.sizeof(command),
             # length of sense buffer
@@ -305,30 +697,121 @@ class Usb2642:
             info=0,
         )
 
-        return sgio, sense
+        return sgio
 
-    def _call_IOCTL(self, command, sg_dxfer, databuffer):
+    def _operation(self):
+        """
+        Returns the type of the command in the command buffer as used in
+        stats.TransactionStats.
+        """
+        action = self._cmd[1]
+        if action == self._USB2642I2CWRITESTREAM:
+            return "i2c-write"
+        if action == self._USB2642I2CWRITEREADSTREAM:
+            return "i2c-write-read"
+        if action == self._USB2642WRITECONFIG:
+            return "write-config"
+        return "read-register"
+
+    def _record(self, start, sgio, failed):
+        self.stats.record(self._operation(), time.monotonic() - start, sgio.duration / 1000, failed)
+
+    def _prepare_SGIO(self, sg_dxfer, dxfer_len):
+        if self._pending is not None:
+            raise TransactionPending("A submitted command has not been received yet")
+
+        sgio = self._sgio
+        sgio.dxfer_direction = sg_dxfer
+        sgio.dxfer_len = dxfer_len
+        sgio.status = 0
+        sgio.sb_len_wr = 0
+        return sgio
+
+    def _call_IOCTL(self, sg_dxfer, dxfer_len=_DATA_LEN):
         """
         Call the ioctl()
 
-        This function will create the struct to call the ioctl() and handle return
-        codes.
+        This function will send the SCSI command currently in the command buffer
+        and handle return codes.
 
         Arguments:
-        command -- SCSI Command payload to send. 16-Byte buffer containing the SCSI
-                   command parameters.
         sg_dxfer -- _SG_DXFER_*: Direction of the SCSI transfer
-        databuffer -- 512 byte long buffer to be written or read
+        dxfer_len -- Number of bytes of the data buffer to be written or read
+        """
+        sgio = self._prepare_SGIO(sg_dxfer, dxfer_len)
+
+        start = time.monotonic()
+        try:
+            self.transport.execute(sgio)
+        except Exception:
+            self._record(start, sgio, True)
+            raise
+        self._record(start, sgio, sgio.status != 0)
+        return sgio
+
+    def _submit(self, sg_dxfer, finish, dxfer_len=_DATA_LEN):
+        """
+        Submit the SCSI command currently in the command buffer without
+        waiting for its completion.
+
+        Only one command can be in flight per instance, as all commands share
+        the same buffers.
+
+        Arguments:
+        sg_dxfer -- _SG_DXFER_*: Direction of the SCSI transfer
+        finish -- Called with the completed sg_io_hdr to create the result
+        dxfer_len -- Number of bytes of the data buffer to be written or read
+        """
+        sgio = self._prepare_SGIO(sg_dxfer, dxfer_len)
+
+        self._pack_id = (self._pack_id + 1) & 0x7FFFFFFF
+        sgio.pack_id = self._pack_id
+
+        self._submitted_at = time.monotonic()
+        self.transport.submit(sgio)
+
+        self._pending = SgRequest(self, self._pack_id, finish)
+        return self._pending
+
+    def _receive(self):
+        """
+        Collect the completion of the submitted command from the sg-device.
+        Blocks if the command has not completed yet.
+        """
+        request = self._pending
+        sgio = self._sgio
+        sgio.pack_id = request.pack_id
+
+        try:
+            self.transport.receive(sgio)
+        except OSError as e:
+            self._pending = None
+            self._record(self._submitted_at, sgio, True)
+            request._fail(e)
+            return
+
+        self._pending = None
+        self._record(self._submitted_at, sgio, sgio.status != 0)
+        if sgio.pack_id != request.pack_id:
+            request._fail(IoctlFailed(f"Received response for pack_id {sgio.pack_id} instead of {request.pack_id}"))
+        else:
+            request._complete(sgio)
+
+    def _abandon(self, exception):
         """
-        sgio, sense = self._get_SGIO(command, sg_dxfer, databuffer)
-        #    print("SGIO:")
-        #    print(self.to_pretty_hex(sgio))
+        Gives up waiting for the submitted command and fails it with exception.
 
-        with open(self.sg, "r+b", buffering=0) as fh:
-            rc = fcntl.ioctl(fh, self._SG_IO, sgio)
-            if rc != 0:
-                raise IoctlFailed(f"SG_IO ioctl() failed with non-zero exit-code {rc}")
-        return databuffer, sense, sgio
+        The command may still be in flight, so the sg-device is closed, which
+        makes the kernel discard its response. The next transaction reopens
+        the device.
+        """
+        request = self._pending
+        if request is None:
+            return
+        self._pending = None
+        self._record(self._submitted_at, self._sgio, True)
+        request._fail(exception)
+        self.transport.close()
 
     def write_config(self, data):
         """
@@ -345,22 +828,18 @@ class Usb2642:
 
         # SCSI Command was found on the USB-Bus.
         # Since most of the bytes are unknown this is used as plain magic.
-        scsiCommand = list_to_uint8_array(
-            [0xCF, 0x54, 0x04, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00], 16
-        )
+        ctypes.memset(self._cmd, 0, self._CMD_LEN)
+        self._cmd[0] = self._USB2642SCSIOPCODE
+        self._cmd[1] = self._USB2642WRITECONFIG
+        self._cmd[2] = 0x04
 
         # Data in the captured USB-transfer was suffixed with some random data.
-        # Experiments showed that 0x00 works fine too.
-        # Since the buffer is zero-ed when initialized the suffix could be removed.
-        data_suffix = list_to_uint8_array([0x00], 127)
-
-        # Copying prefix, data and suffix to the SCSI command data-section
-        payload = (ctypes.c_uint8 * 512)()
-        payload[: ctypes.sizeof(data)] = data
-        payload[ctypes.sizeof(data) : ctypes.sizeof(data) + ctypes.sizeof(data_suffix)] = data_suffix  # noqa: E203
+        # Experiments showed that 0x00 works fine too, so the remainder of the
+        # data-section is just cleared.
+        self._set_data(memoryview(data).cast("B"), self._DATA_LEN)
 
         # Perform the actual SCSI transfer
-        self._call_IOCTL(scsiCommand, self._SG_DXFER_TO_DEV, payload)
+        self._call_IOCTL(self._SG_DXFER_TO_DEV)
 
     def write_read_to(self, i2cAddr, writeData, readLength):
         """
@@ -384,28 +863,70 @@ class Usb2642:
         This transaction can (for example) be used to set the address-pointer inside
         an EEPROM and read data from it.
 
+        The data is returned as bytes, copied out of the data buffer that is
+        reused by the next transaction.
+
         Arguments:
         i2cAddr -- 7-Bit I2C Slave address (as used by Linux). Will be shifted 1 Bit
                    to the left before adding the R/W-bit.
         writeData -- iterable of bytes to write in the first phase
         readLengh -- number of bytes (0..512) to read in the second phase
         """
-        scsiCommand, data = self._get_SCSI_cmd_I2C_write_read(i2cAddr, writeData, readLength)
-        # TODO: Add error handling if length of read or write do not match
-        #       requirements
 
-        #    print("I2C-Command:")
-        #    print(self.to_pretty_hex(scsiCommand))
-        #    print("I2C-Payload:")
-        #    print(self.to_pretty_hex(data))
-        data, sense, sgio = self._call_IOCTL(scsiCommand, self._SG_DXFER_FROM_DEV, data)
+        def transaction():
+            self._get_SCSI_cmd_I2C_write_read(i2cAddr, writeData, readLength)
+            # TODO: Add error handling if length of read or write do not match
+            #       requirements
+
+            sgio = self._call_IOCTL(self._SG_DXFER_FROM_DEV)
+            return self._finish_i2c_read(sgio, readLength)
+
+        return self._retry(transaction)
 
+    def submit_write_read_to(self, i2cAddr, writeData, readLength):
+        """
+        Like write_read_to(), but only submits the command and returns an
+        SgRequest, whose result() is the data that has been read.
+        """
+        self._get_SCSI_cmd_I2C_write_read(i2cAddr, writeData, readLength)
+        return self._submit(self._SG_DXFER_FROM_DEV, lambda sgio: self._finish_i2c_read(sgio, readLength))
+
+    def _sense_data(self, sgio):
+        """
+        Returns the decoded sense data of the last command or None.
+        """
+        if sgio.status != TransactionFailed.CHECK_CONDITION:
+            return None
+        return SenseData.parse(self._sense.raw[: sgio.sb_len_wr])
+
+    def _retry(self, transaction):
+        """
+        Calls transaction() until it succeeds, fails with a permanent error or
+        the retry policy gives up.
+        """
+        delays = self.retry_policy.delays()
+        while True:
+            try:
+                return transaction()
+            except TransactionFailed as e:
+                if not e.transient:
+                    raise
+                delay = next(delays, None)
+                if delay is None:
+                    raise
+                self.stats.record_retry(self._operation())
+                self.stats.record_sleep("retry", delay)
+                sleep(delay)
+
+    def _check_i2c_status(self, sgio):
         if sgio.status != 0:
-            raise I2cTransactionFailed(
-                f"SCSI-Transaction ended with status {sgio.status}. I2C-Transaction has probably failed."
-            )
+            sense = self._sense_data(sgio)
+            message = f"SCSI-Transaction ended with {_status_text(sgio.status, sense)}."
+            raise I2cTransactionFailed(message + " I2C-Transaction has probably failed.", sgio.status, sense)
 
-        return list(data[:readLength])
+    def _finish_i2c_read(self, sgio, readLength):
+        self._check_i2c_status(sgio)
+        return bytes(self._data_view[:readLength])
 
     def write_to(self, i2cAddr, data):
         """
@@ -427,48 +948,77 @@ class Usb2642:
         i2cAddr -- 7-Bit I2C Slave address (as used by Linux). Will be shifted 1 Bit
                    to the left before adding the R/W-bit.
         data -- iterateable of bytes to write."""
-        scsiCommand, data = self._get_SCSI_cmd_I2C_write(i2cAddr, data)
-        # TODO: Add length checks
 
-        #    print("I2C-Command:")
-        #    print(self.to_pretty_hex(scsiCommand))
-        #    print("I2C-Payload:")
-        #    print(self.to_pretty_hex(data))
-        data, sense, sgio = self._call_IOCTL(scsiCommand, self._SG_DXFER_TO_DEV, data)
+        def transaction():
+            self._get_SCSI_cmd_I2C_write(i2cAddr, data)
+            # TODO: Add length checks
 
-        if sgio.status != 0:
-            raise I2cTransactionFailed(
-                f"SCSI-Transaction ended with status {sgio.status}. I2C-Transaction has probably failed."
-            )
+            sgio = self._call_IOCTL(self._SG_DXFER_TO_DEV)
+            self._check_i2c_status(sgio)
 
-    def _read_register(self, reg, size, retries=5):
-        scsiCommand = list_to_uint8_array(
-            [0xCF, reg, 0x00, 0x00, size, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00], 16
-        )
+        self._retry(transaction)
 
-        while True:
-            databuffer = ctypes.c_buffer(size)
-            _, _, sgio = self._call_IOCTL(scsiCommand, self._SG_DXFER_FROM_DEV, databuffer)
+    def submit_write_to(self, i2cAddr, data):
+        """
+        Like write_to(), but only submits the command and returns an SgRequest.
+        """
+        self._get_SCSI_cmd_I2C_write(i2cAddr, data)
+        return self._submit(self._SG_DXFER_TO_DEV, self._check_i2c_status)
+
+    def _get_SCSI_cmd_read_register(self, reg, size):
+        """
+        Fill the command buffer to read the SD-Card register reg of the given
+        size into the data buffer.
+        """
+        ctypes.memset(self._cmd, 0, self._CMD_LEN)
+        self._cmd[0] = 0xCF
+        self._cmd[1] = reg
+        self._cmd[4] = size
+        ctypes.memset(self._data, 0, size)
+
+    def _finish_read_register(self, sgio, size):
+        if sgio.status != 0:
+            sense = self._sense_data(sgio)
+            message = f"SCSI Transaction ended with {_status_text(sgio.status, sense)}."
+            if sense is not None and sense.medium_not_present:
+                raise MediumNotPresent(message, sgio.status, sense)
+            if SDTransactionFailed._is_transient(sgio.status, sense):
+                raise SDCardNotReady(message + " SD-Card is not ready.", sgio.status, sense)
+            raise SDTransactionFailed(message + " SD Transaction has probably failed.", sgio.status, sense)
+
+        return bytes(self._data_view[:size])
 
-            if retries and sgio.status == 2:
-                sleep(0.5)
-                retries -= 1
-                continue
+    def _read_register(self, reg, size):
+        def transaction():
+            self._get_SCSI_cmd_read_register(reg, size)
+            sgio = self._call_IOCTL(self._SG_DXFER_FROM_DEV, size)
+            return self._finish_read_register(sgio, size)
 
-            if sgio.status != 0:
-                raise SDTransactionFailed(
-                    f"SCSI Transaction ended with status {sgio.status}. SD Transaction has probably failed."
-                )
+        return self._retry(transaction)
 
-            break
+    def submit_read_register(self, reg, size):
+        """
+        Submits a single read of an SD-Card register and returns an SgRequest,
+        whose result() is the content of the register.
+        Other than read_cid() and friends this does not retry if the card is
+        not ready yet, but fails with SDCardNotReady.
+        The same applies to the other submit_*() methods.
+        """
+        self._get_SCSI_cmd_read_register(reg, size)
+        return self._submit(
+            self._SG_DXFER_FROM_DEV, lambda sgio: self._finish_read_register(sgio, size), dxfer_len=size
+        )
 
-        return databuffer.raw
+    """Register number and size of the SD-Card registers: (reg, size)"""
+    REGISTER_CID = (0x18, 16)
+    REGISTER_CSD = (0x1A, 16)
+    REGISTER_SCR = (0x1B, 8)
 
     def read_cid(self):
-        return self._read_register(0x18, 16)
+        return self._read_register(*self.REGISTER_CID)
 
     def read_csd(self):
-        return self._read_register(0x1A, 16)
+        return self._read_register(*self.REGISTER_CSD)
 
     def read_scr(self):
-        return self._read_register(0x1B, 8)
+        return self._read_register(*self.REGISTER_SCR)
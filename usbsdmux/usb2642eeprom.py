@@ -12,7 +12,7 @@ from .ctypehelper import (
     string_to_microchip_unicode_uint8_array,
     string_to_uint8_array,
 )
-from .usb2642 import Usb2642
+from .usb2642 import SgTransport, Usb2642
 
 """
 This module provides the high-level interface needed to write the contents of
@@ -29,7 +29,7 @@ class USB2642Eeprom:
     Provides an interface to write the configuration EEPROM of a USB2642.
     """
 
-    def __init__(self, sg, i2c_addr=0x50):
+    def __init__(self, sg, i2c_addr=0x50, transport=None):
         """
         Create a new USB2642Eeprom Instance.
 
@@ -37,10 +37,23 @@ class USB2642Eeprom:
         sg -- /dev/sg* to use
         i2c_addr -- 7-Bit Address of the EEPROM to use. Defaults to 0x50 for the
                     configuration-EEPROM. You probably do NOT want to override this.
+        transport -- See Usb2642.__init__()
         """
-        self.i2c = Usb2642(sg)
+        self.i2c = Usb2642(sg, transport=transport)
         self.addr = i2c_addr
 
+    def close(self):
+        """
+        Closes the underlying sg-device.
+        """
+        self.i2c.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     class _EepromStruct(ctypes.Structure):
         """
         Struct that contains the Configuration of the Card Reader and USB Hub.
@@ -263,21 +276,27 @@ def main():
     parser.add_argument("--ScsiManufacturer", help="Sets the ScsiManufacturer that will be written.", default="PTX")
     parser.add_argument("--ScsiProduct", help="Sets the ScsiProduct that will be written.", default="sdmux")
     parser.add_argument("--PID", help="Sets the USB-PIC that will be written.", default="0x4041")
+    parser.add_argument("--record-trace", help="Record all commands sent to the USB2642 to a trace file.")
     parser.add_argument("serial", help="Sets the Serial Number that will be written.")
 
     args = parser.parse_args()
 
-    c = USB2642Eeprom(args.sg)
+    transport = None
+    if args.record_trace:
+        from .trace import RecordingTransport
 
-    c.write(
-        VID=int(args.VID, base=16),
-        PID=int(args.PID, base=16),
-        product_string=args.productString,
-        vendor_string=args.manufacturerString,
-        serial=args.serial,
-        scsi_mfg=args.ScsiManufacturer,
-        scsi_product=args.ScsiProduct,
-    )
+        transport = RecordingTransport(SgTransport(args.sg), args.record_trace)
+
+    with USB2642Eeprom(args.sg, transport=transport) as c:
+        c.write(
+            VID=int(args.VID, base=16),
+            PID=int(args.PID, base=16),
+            product_string=args.productString,
+            vendor_string=args.manufacturerString,
+            serial=args.serial,
+            scsi_mfg=args.ScsiManufacturer,
+            scsi_product=args.ScsiProduct,
+        )
 
     print("Write completed")
 
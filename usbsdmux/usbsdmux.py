@@ -8,6 +8,7 @@ import time
 
 from . import sd_regs
 from .i2c_gpio import Pca9536, Tca6408
+from .usb2642 import complete_all
 
 
 class UnknownUsbSdMuxRevisionException(Exception):
@@ -18,54 +19,350 @@ class NotInHostModeException(Exception):
     pass
 
 
-def autoselect_driver(sg):
-    """
-    Create a new UsbSdMux with the correct driver for the device at /dev/<sg>
+SYSFS = "/sys"
 
-    Arguments:
-    sg -- /dev/sg* to use
+
+def _driver_class(sg, sysfs=SYSFS):
+    """
+    Returns the UsbSdMux subclass that matches the device at /dev/<sg>.
     """
 
     base_sg = os.path.realpath(sg)
     sg_name = os.path.basename(base_sg)
-    model_filename = f"/sys/class/scsi_generic/{sg_name}/device/model"
+    model_filename = os.path.join(sysfs, f"class/scsi_generic/{sg_name}/device/model")
     try:
         with open(model_filename) as fh:
             model = fh.read().strip()
-        if model == "sdmux HS-SD/MMC":
-            return UsbSdMuxClassic(sg)
-        elif model == "sdFST HS-SD/MMC":
-            return UsbSdMuxFast(sg)
-        else:
-            raise UnknownUsbSdMuxRevisionException(
-                f"Could not determine type of USB-SD-Mux. Found unknown SCSI model '{model}'."
-            )
+        for driver in (UsbSdMuxClassic, UsbSdMuxFast):
+            if model == driver._model:
+                return driver
+        raise UnknownUsbSdMuxRevisionException(
+            f"Could not determine type of USB-SD-Mux. Found unknown SCSI model '{model}'."
+        )
     except FileNotFoundError as e:
         raise UnknownUsbSdMuxRevisionException(
             f"Could not determine type of USB-SD-Mux. Does {model_filename} exist?"
         ) from e
 
 
+def autoselect_driver(sg, cache_registers=False, discharge_time=None, transport=None, sysfs=SYSFS):
+    """
+    Create a new UsbSdMux with the correct driver for the device at /dev/<sg>
+
+    Arguments:
+    sg -- /dev/sg* to use
+    cache_registers -- See UsbSdMux.__init__()
+    discharge_time -- See UsbSdMux.__init__()
+    transport -- See UsbSdMux.__init__()
+    sysfs -- Mount point of sysfs to look up the model in
+    """
+    driver = _driver_class(sg, sysfs)
+    return driver(sg, cache_registers=cache_registers, discharge_time=discharge_time, transport=transport)
+
+
+def usb_device_path(sg, sysfs=SYSFS):
+    """
+    Returns the sysfs path of the USB device the sg-device belongs to or None
+    if it can not be found.
+    """
+    sg_name = os.path.basename(os.path.realpath(sg))
+    usb_path = os.path.realpath(os.path.join(sysfs, f"class/scsi_generic/{sg_name}"))
+
+    max_depth = 10
+    while not os.path.isfile(os.path.join(usb_path, "serial")):
+        if max_depth == 0:
+            return None
+        usb_path = os.path.dirname(usb_path)
+        max_depth -= 1
+
+    return usb_path
+
+
+def usb_serial(sg, sysfs=SYSFS):
+    """
+    Returns the USB serial number of the USB-SD-Mux at /dev/<sg> or None if it
+    can not be found.
+    """
+    usb_path = usb_device_path(sg, sysfs)
+    if usb_path is None:
+        return None
+    with open(os.path.join(usb_path, "serial")) as fh:
+        return fh.read().strip()
+
+
+def decode_card_info(scr, cid, csd):
+    """
+    Decodes the raw SCR, CID and CSD registers of an SD-Card into the
+    dictionary returned by UsbSdMux.get_card_info().
+    """
+    return {
+        "scr": sd_regs.SCR(scr.hex()).decode(),
+        "cid": sd_regs.CID(cid.hex()).decode(),
+        "csd": sd_regs.decode_csd(csd.hex()).decode(),
+    }
+
+
+def get_modes(muxes, timeout=None):
+    """
+    Returns the currently selected modes of several USB-SD-Muxes as a list of
+    strings.
+
+    The read commands for all devices are submitted at once, so the whole
+    sweep takes roughly one USB round trip instead of one per device.
+
+    Arguments:
+    muxes -- iterable of UsbSdMux
+    timeout -- Maximum time to wait in seconds or None to wait forever
+    """
+    muxes = list(muxes)
+    results = complete_all([mux._gpio.submit_get_input_values() for mux in muxes], timeout)
+    return [mux._decode_mode(result[0]) for mux, result in zip(muxes, results, strict=True)]
+
+
+def find_usbsdmuxes(sysfs=SYSFS):
+    """
+    Returns the /dev/sg* paths of all USB-SD-Muxes found in sysfs.
+    See discovery.scan() for more details on each of them.
+    """
+    # discovery.py imports this module
+    from .discovery import scan
+
+    return [device.sg for device in scan(sysfs)]
+
+
 class UsbSdMux:
     """
     Class to provide an interface for the multiplexer on an usb-sd-mux.
     """
 
-    def __init__(self, sg):
+    # Time in seconds the supply of the SD-Card needs to discharge after it
+    # has been disconnected. This is the safe default for the model. It can be
+    # overridden per instance.
+    _discharge_time = 1
+
+    # time.monotonic() when this instance has disconnected the card from its
+    # supply or None if it has not.
+    _powered_off_at = None
+
+    def __init__(self, sg, cache_registers=False, discharge_time=None, transport=None):
         """
         Create a new UsbSdMux.
 
         Arguments:
         sg -- /dev/sg* to use
+        cache_registers -- Keep shadow copies of the GPIO-expander registers
+                           to save the reads of read-modify-write operations.
+                           Only enable this if no other process uses the
+                           USB-SD-Mux while this instance exists.
+        discharge_time -- Time in seconds to wait for the supply of the
+                          SD-Card to discharge, e.g. as determined by
+                          calibration.calibrate_discharge_time().
+                          Defaults to a safe value for the model.
+        transport -- Object that passes the commands to the USB-SD-Mux, see
+                     Usb2642.__init__(). Defaults to the sg-device itself.
         """
         raise NotImplementedError()
 
+    def close(self):
+        """
+        Closes the sg-device used to talk to the USB-SD-Mux.
+        """
+        self._usb.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def stats(self):
+        """
+        stats.TransactionStats of the commands sent to this USB-SD-Mux.
+        """
+        return self._usb.stats
+
     def get_mode(self):
         """
         Returns currently selected mode as string
         """
         raise NotImplementedError()
 
+    @classmethod
+    def _decode_mode(cls, val):
+        """
+        Returns the mode as string for a value read from the input register.
+        """
+        # If the SD-Card is disabled, we do not need to check for the selected mode.
+        # PWR_disable and DAT_disable are always switched at the same time.
+        # Let's assume it is sufficient to check one of both.
+        if val & cls._PWR_disable:
+            return "off"
+
+        if val & cls._select_DUT:
+            return "dut"
+
+        return "host"
+
+    @classmethod
+    def _pin_values(cls, state):
+        """
+        Returns the values of the mux pins for a given state.
+
+        Arguments:
+        state -- One of the modes "off", "dut" and "host" or "dut-select":
+                 The card is still disconnected, but already selected to the DUT.
+        """
+        if state == "off":
+            return cls._DAT_disable | cls._PWR_disable | cls._select_HOST | cls._card_removed
+        if state == "dut-select":
+            return cls._DAT_disable | cls._PWR_disable | cls._select_DUT | cls._card_removed
+        if state == "dut":
+            return cls._DAT_enable | cls._PWR_enable | cls._select_DUT | cls._card_removed
+        if state == "host":
+            return cls._DAT_enable | cls._PWR_enable | cls._select_HOST | cls._card_inserted
+        raise ValueError(f"Unknown state '{state}'")
+
+    @classmethod
+    def _plan_transition(cls, current, outputs_configured, target):
+        """
+        Returns the shortest glitch-free sequence of steps to get from the
+        current state of the mux pins to the target mode.
+
+        Every step is a tuple of:
+
+        * ("output", value) -- Write value to the mux pins
+        * ("direction", None) -- Configure the mux pins as outputs
+        * ("wait", None) -- Wait until the supply of the SD-Card is discharged
+
+        Arguments:
+        current -- Value of the input register
+        outputs_configured -- True if the mux pins are already configured as
+                              outputs. Otherwise the input register only
+                              shows the levels set by the pull resistors.
+        target -- One of "off", "dut" or "host"
+        """
+        current &= cls._mux_pins
+        target_value = cls._pin_values(target)
+        steps = []
+
+        if not outputs_configured:
+            # Set the output registers to known values and activate them
+            # afterward. We do not know for how long the card has been
+            # supplied, so we need to wait for it to discharge.
+            steps.append(("output", cls._pin_values("off")))
+            steps.append(("direction", None))
+            steps.append(("wait", None))
+            current = cls._pin_values("off")
+
+        elif cls._decode_mode(current) == target and target != "off":
+            # Already connected to the target: Nothing to do, unless one of the
+            # other pins has an unexpected value.
+            if current != target_value:
+                steps.append(("output", target_value))
+            return steps
+
+        elif cls._decode_mode(current) != "off":
+            # Disconnect the card from the other side first. This also switches
+            # the selection back to the host.
+            steps.append(("output", cls._pin_values("off")))
+            steps.append(("wait", None))
+            current = cls._pin_values("off")
+
+        if target == "off":
+            if current != target_value:
+                steps.append(("output", target_value))
+                steps.append(("wait", None))
+
+        else:
+            if target == "dut" and current & cls._select_DUT != cls._select_DUT:
+                # switch selection to DUT first to prevent glitches on power and
+                # data-lines
+                steps.append(("output", cls._pin_values("dut-select")))
+            elif target == "host" and current & cls._select_DUT != cls._select_HOST:
+                # Switch the selection back to the host before connecting.
+                steps.append(("output", cls._pin_values("off")))
+
+            # The card may have been disconnected only shortly before (e.g. by
+            # mode_disconnect(wait=False)), so make sure it had time to discharge.
+            if ("wait", None) not in steps:
+                steps.append(("wait", None))
+
+            # now connect data and power
+            steps.append(("output", target_value))
+
+        return steps
+
+    @classmethod
+    def _transition(cls, mux, current, outputs_configured, target):
+        """
+        Yields the steps of _plan_transition() for the caller to perform and
+        records in mux._powered_off_at when a step has disconnected the
+        SD-Card from its supply.
+
+        Arguments:
+        mux -- The UsbSdMux, or its asyncio variant, performing the steps
+        current, outputs_configured, target -- See _plan_transition()
+        """
+        powered = cls._decode_mode(current) != "off"
+        for step, value in cls._plan_transition(current, outputs_configured, target):
+            yield step, value
+            if step == "output":
+                if powered and value & cls._PWR_disable:
+                    mux._powered_off_at = time.monotonic()
+                powered = not value & cls._PWR_disable
+            elif step == "direction":
+                mux._powered_off_at = time.monotonic()
+
+    def _outputs_configured(self):
+        """
+        Returns True if the mux pins of the GPIO-expander are configured as outputs.
+        """
+        return self._gpio.get_gpio_config() & self._mux_pins == 0
+
+    def _discharge_remaining(self):
+        """
+        Returns the time in seconds until the SD-Card is discharged, zero or
+        less if it already is.
+        If this instance has not disconnected the SD-Card from its supply
+        itself it may just have been disconnected by someone else, so the full
+        discharge time is returned.
+        """
+        if self._powered_off_at is None:
+            return self._discharge_time
+        return self._discharge_time - (time.monotonic() - self._powered_off_at)
+
+    def _wait_discharged(self):
+        """
+        Waits until the SD-Card has been disconnected from its supply by this
+        instance for at least _discharge_time seconds.
+        If it has been disconnected before this instance was created the full
+        discharge time is waited for.
+        """
+        remaining = self._discharge_remaining()
+        if remaining > 0:
+            self._usb.stats.record_sleep("discharge", remaining)
+            time.sleep(remaining)
+
+    def _switch(self, target, wait=True):
+        """
+        Brings the USB-SD-Mux into the target mode with as few register
+        accesses as possible. If it already is in the target mode nothing is
+        written.
+        """
+        start = time.monotonic()
+        current = self._gpio.get_input_values()
+
+        for step, value in self._transition(self, current, self._outputs_configured(), target):
+            if step == "output":
+                self._gpio.output_values(value, self._output_mask)
+            elif step == "direction":
+                self._gpio.set_pin_to_output(self._mux_pins)
+            elif step == "wait" and wait:
+                self._wait_discharged()
+
+        self._usb.stats.record_switch(target, time.monotonic() - start)
+
     def mode_disconnect(self, wait=True):
         """
         Will disconnect the Micro-SD Card from both host and DUT.
@@ -74,25 +371,62 @@ class UsbSdMux:
         wait -- Command will block for some time until the voltage-supply of
         the sd-card is known to be close to zero
         """
-        raise NotImplementedError()
+        self._switch("off", wait)
 
-    def mode_DUT(self, wait=True):
+    def mode_DUT(self, wait=True, flush=False):
         """
         Switches the MicroSD-Card to the DUT.
 
-        This Command will issue a disconnect first to make sure the SD-card
-        has been properly disconnected from both sides and its supply was off.
+        If the card is connected to the host, it is disconnected first to make
+        sure the SD-card has been properly disconnected from both sides and
+        its supply was off.
+        If the card is already connected to the DUT nothing is done.
+
+        Arguments:
+        flush -- Write the data cached by the host to the card and drop the
+                 cache before switching, see blockdev.flush_card().
+                 Raises blockdev.BlockDeviceBusy if the card is mounted.
         """
-        raise NotImplementedError()
+        if flush:
+            # blockdev.py imports this module
+            from .blockdev import flush_card
+
+            flush_card(self._usb.sg)
+        self._switch("dut", wait)
 
-    def mode_host(self, wait=True):
+    def mode_host(self, wait=True, wait_for_block=False, timeout=10, invalidate=False):
         """
         Switches the MicroSD-Card to the Host.
 
-        This Command will issue a disconnect first to make sure the SD-card
-        has been properly disconnected from both sides and its supply was off.
+        If the card is connected to the DUT, it is disconnected first to make
+        sure the SD-card has been properly disconnected from both sides and
+        its supply was off.
+        If the card is already connected to the host nothing is done.
+
+        Arguments:
+        wait_for_block -- Wait until the block device of the card is usable
+                          and return its path, see hotplug.wait_for_block()
+        timeout -- Maximum time in seconds to wait for the block device
+        invalidate -- Drop the data the host has cached for the card, as the
+                      DUT may have modified it, see blockdev.flush_card().
+                      This is done for the block devices present right
+                      after the switch, combine it with wait_for_block to
+                      do it once the card reader has detected the card.
+                      Nothing is done if there is no card.
         """
-        raise NotImplementedError()
+        self._switch("host", wait)
+        block = None
+        if wait_for_block:
+            # hotplug.py imports this module
+            from .hotplug import wait_for_block as wait_for_block_device
+
+            block = wait_for_block_device(self._usb.sg, timeout)
+        if invalidate:
+            # blockdev.py imports this module
+            from .blockdev import flush_card
+
+            flush_card(self._usb.sg, check_mounted=False)
+        return block
 
     def gpio_get(self, gpio):
         """
@@ -112,25 +446,49 @@ class UsbSdMux:
         """
         raise NotImplementedError()
 
-    def get_card_info(self):
-        if self.get_mode() != "host":
+    def get_card_cid(self, check_mode=True, retry=True):
+        """
+        Returns the raw CID register of the SD-Card, which identifies it.
+
+        Arguments:
+        check_mode -- Raise NotInHostModeException if not in host mode. Only
+                      skip this check if the mode is known to be "host".
+        retry -- Retry while the SD-Card is becoming ready. Otherwise a single
+                 read is done, which fails right away with an
+                 SDTransactionFailed, e.g. if the card is not connected to
+                 the host.
+        """
+        if check_mode and self.get_mode() != "host":
             raise NotInHostModeException()
 
-        result = {}
+        if not retry:
+            return self._usb.submit_read_register(*self._usb.REGISTER_CID).result()
+        return self._usb.read_cid()
 
-        scr = self._usb.read_scr()
-        result["scr"] = sd_regs.SCR(scr.hex()).decode()
+    def get_card_info(self, check_mode=True, cid=None):
+        """
+        Returns the decoded SCR, CID and CSD registers of the SD-Card.
 
-        cid = self._usb.read_cid()
-        result["cid"] = sd_regs.CID(cid.hex()).decode()
+        Arguments:
+        check_mode -- See get_card_cid()
+        cid -- Raw CID register returned by get_card_cid(), so it is not read
+               again
+        """
+        if check_mode and self.get_mode() != "host":
+            raise NotInHostModeException()
 
+        scr = self._usb.read_scr()
+        if cid is None:
+            cid = self._usb.read_cid()
         csd = self._usb.read_csd()
-        result["csd"] = sd_regs.decode_csd(csd.hex()).decode()
 
-        return result
+        return decode_card_info(scr, cid, csd)
 
 
 class UsbSdMuxClassic(UsbSdMux):
+    # SCSI model reported by the USB2642 of this hardware revision
+    _model = "sdmux HS-SD/MMC"
+
     _DAT_enable = 0x00
     _DAT_disable = Pca9536.gpio_0
 
@@ -143,53 +501,23 @@ class UsbSdMuxClassic(UsbSdMux):
     _card_inserted = 0x00
     _card_removed = Pca9536.gpio_3
 
-    def __init__(self, sg):
-        self._pca = Pca9536(sg)
+    _mux_pins = Pca9536.gpio_0 | Pca9536.gpio_1 | Pca9536.gpio_2 | Pca9536.gpio_3
+    _output_mask = 0xFF
+
+    def __init__(self, sg, cache_registers=False, discharge_time=None, transport=None):
+        if discharge_time is not None:
+            self._discharge_time = discharge_time
+        self._pca = Pca9536(sg, cache_registers, transport)
+        self._gpio = self._pca
         self._usb = self._pca.get_usb()
 
     def get_mode(self):
-        val = self._pca.get_input_values()
-
-        # If the SD-Card is disabled, we do not need to check for the selected mode.
-        # PWR_disable and DAT_disable are always switched at the same time.
-        # Let's assume it is sufficient to check one of both.
-        if val & self._PWR_disable:
-            return "off"
-
-        if val & self._select_DUT:
-            return "dut"
-
-        return "host"
-
-    def mode_disconnect(self, wait=True):
-        # Set the output registers to known values and activate them afterward
-        self._pca.output_values(self._DAT_disable | self._PWR_disable | self._select_HOST | self._card_removed)
-        self._pca.set_pin_to_output(Pca9536.gpio_0 | Pca9536.gpio_1 | Pca9536.gpio_2 | Pca9536.gpio_3)
-
-        if wait:
-            time.sleep(1)
-
-    def mode_DUT(self, wait=True):
-        self.mode_disconnect(wait)
-
-        # switch selection to DUT first to prevent glitches on power and
-        # data-lines
-        self._pca.output_values(self._DAT_disable | self._PWR_disable | self._select_DUT | self._card_removed)
-
-        # now connect data and power
-        self._pca.output_values(self._DAT_enable | self._PWR_enable | self._select_DUT | self._card_removed)
-
-    def mode_host(self, wait=True):
-        self.mode_disconnect(wait)
-
-        # The disconnect-command has already switched the card to the host.
-        # Thus, we don't need to worry about glitches anymore.
-
-        # now connect data and power
-        self._pca.output_values(self._DAT_enable | self._PWR_enable | self._select_HOST | self._card_inserted)
+        return self._decode_mode(self._pca.get_input_values())
 
 
 class UsbSdMuxFast(UsbSdMux):
+    _model = "sdFST HS-SD/MMC"
+
     _DAT_enable = 0x00
     _DAT_disable = Tca6408.gpio_2
 
@@ -202,13 +530,28 @@ class UsbSdMuxFast(UsbSdMux):
     _card_inserted = 0x00
     _card_removed = Tca6408.gpio_3
 
+    _mux_pins = Tca6408.gpio_0 | Tca6408.gpio_1 | Tca6408.gpio_2 | Tca6408.gpio_3
+    _output_mask = _mux_pins
+
     gpio0 = Tca6408.gpio_5
     gpio1 = Tca6408.gpio_4
 
-    def __init__(self, sg):
-        self._tca = Tca6408(sg)
-        self._assure_default_state()
+    def __init__(self, sg, cache_registers=False, discharge_time=None, transport=None):
+        if discharge_time is not None:
+            self._discharge_time = discharge_time
+        self._tca = Tca6408(sg, cache_registers, transport)
+        self._gpio = self._tca
         self._usb = self._tca.get_usb()
+        self._assure_default_state()
+
+    def _assure_default_state_after_reopen(self):
+        """
+        Calls _assure_default_state() again if the device has been reopened
+        since, e.g. after a re-enumeration. The GPIO-expander may have been
+        reset in the meantime.
+        """
+        if self._usb.generation != self._default_state_generation:
+            self._assure_default_state()
 
     def _assure_default_state(self):
         # If the USB-SD-Mux has just been powered on, its default ("DUT") is defined by pull-resistors.
@@ -224,57 +567,15 @@ class UsbSdMuxFast(UsbSdMux):
             self._tca.set_pin_to_output(
                 Tca6408.gpio_0 | Tca6408.gpio_1 | Tca6408.gpio_2 | Tca6408.gpio_3 | Tca6408.gpio_4 | Tca6408.gpio_5
             )
+        self._default_state_generation = self._usb.generation
 
     def get_mode(self):
-        val = self._tca.get_input_values()
+        return self._decode_mode(self._tca.get_input_values())
 
-        # If the SD-Card is disabled, we do not need to check for the selected mode.
-        # PWR_disable and DAT_disable are always switched at the same time.
-        # Let's assume it is sufficient to check one of both.
-        if val & self._PWR_disable:
-            return "off"
-
-        if val & self._select_DUT:
-            return "dut"
-
-        return "host"
-
-    def mode_disconnect(self, wait=True):
-        self._tca.output_values(
-            values=self._DAT_disable | self._PWR_disable | self._select_HOST | self._card_removed,
-            bitmask=self._tca.gpio_0 | self._tca.gpio_1 | self._tca.gpio_2 | self._tca.gpio_3,
-        )
-
-        if wait:
-            time.sleep(1)
-
-    def mode_DUT(self, wait=True):
-        self.mode_disconnect(wait)
-
-        # switch selection to DUT first to prevent glitches on power and
-        # data-lines
-        self._tca.output_values(
-            values=self._DAT_disable | self._PWR_disable | self._select_DUT | self._card_removed,
-            bitmask=self._tca.gpio_0 | self._tca.gpio_1 | self._tca.gpio_2 | self._tca.gpio_3,
-        )
-
-        # now connect data and power
-        self._tca.output_values(
-            values=self._DAT_enable | self._PWR_enable | self._select_DUT | self._card_removed,
-            bitmask=self._tca.gpio_0 | self._tca.gpio_1 | self._tca.gpio_2 | self._tca.gpio_3,
-        )
-
-    def mode_host(self, wait=True):
-        self.mode_disconnect(wait)
-
-        # The disconnect-command has already switched the card to the host.
-        # Thus, we don't need to worry about glitches anymore.
-
-        # now connect data and power
-        self._tca.output_values(
-            values=self._DAT_enable | self._PWR_enable | self._select_HOST | self._card_inserted,
-            bitmask=self._tca.gpio_0 | self._tca.gpio_1 | self._tca.gpio_2 | self._tca.gpio_3,
-        )
+    def _outputs_configured(self):
+        # _assure_default_state() has configured the pins when the device was opened.
+        self._assure_default_state_after_reopen()
+        return True
 
     @staticmethod
     def _map_gpio(gpio):
@@ -296,8 +597,10 @@ class UsbSdMuxFast(UsbSdMux):
 
     def gpio_set_high(self, gpio):
         gpio = UsbSdMuxFast._map_gpio(gpio)
+        self._assure_default_state_after_reopen()
         self._tca.output_values(0x0, gpio)
 
     def gpio_set_low(self, gpio):
         gpio = UsbSdMuxFast._map_gpio(gpio)
+        self._assure_default_state_after_reopen()
         self._tca.output_values(gpio, gpio)